@@ -0,0 +1,9 @@
+"""
+Offline benchmarks for Lovelace. The benchmarks are run as modules from the
+webapp directory with a settings file marked with TEST_SETTINGS, e.g.
+
+DJANGO_SETTINGS_MODULE=lovelace.settings.unittest python -m benchmarks.checking_concurrency
+
+Each benchmark creates a throwaway test database the same way the unit tests
+do and destroys it afterwards.
+"""
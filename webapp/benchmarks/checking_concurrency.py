@@ -0,0 +1,76 @@
+"""
+Compares the wall-clock time of checking a multi-test file exercise with the
+serial test loop against the concurrent checking mode. Concurrent checking
+requires the sandbox runner service, so CHECKING_RUNNER_SOCKET must be set and
+the service running.
+"""
+
+import os
+import argparse
+import statistics
+import time
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lovelace.settings")
+
+import django
+django.setup()
+
+from django.conf import settings
+from django.test import override_settings
+from django.utils import translation
+
+from courses.tasks import run_tests
+from benchmarks.fixtures import benchmark_database, create_benchmark_exercise,\
+    create_benchmark_answer, create_benchmark_context
+
+def time_checking(exercise, revision, user, instance, code, rounds):
+    timings = []
+    for _ in range(rounds):
+        answer = create_benchmark_answer(exercise, revision, user, instance, code)
+        start = time.perf_counter()
+        result = run_tests.s(
+            user_id=user.id,
+            instance_id=instance.id,
+            exercise_id=exercise.id,
+            answer_id=answer.id,
+            lang_code=translation.get_language(),
+            revision=None
+        ).apply()
+        result.get()
+        timings.append(time.perf_counter() - start)
+        result.forget()
+    return timings
+
+def main(args):
+    if not getattr(settings, "CHECKING_RUNNER_SOCKET", None):
+        raise SystemExit("CHECKING_RUNNER_SOCKET is not set, the tests would be run one at a time")
+
+    with benchmark_database():
+        user, instance = create_benchmark_context()
+        exercise, revision, code = create_benchmark_exercise(
+            test_count=args.tests, delay=args.delay
+        )
+
+        modes = [("serial", 1, False)]
+        for runs in args.concurrency:
+            modes.append(("concurrent, {} runs".format(runs), runs, False))
+            modes.append(("concurrent pairs, {} runs".format(runs), runs, True))
+
+        print("{} tests, {:.2f} s per program run, {} rounds".format(args.tests, args.delay, args.rounds))
+        baseline = None
+        for name, runs, pairs in modes:
+            with override_settings(CHECKING_MAX_CONCURRENT_RUNS=runs, CHECKING_CONCURRENT_PAIRS=pairs):
+                timings = time_checking(exercise, revision, user, instance, code, args.rounds)
+            median = statistics.median(timings)
+            baseline = baseline or median
+            print("{:<30} median {:7.3f} s  min {:7.3f} s  speedup {:5.2f}x".format(
+                name, median, min(timings), baseline / median
+            ))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tests", type=int, default=6, help="number of tests in the exercise")
+    parser.add_argument("--delay", type=float, default=0.2, help="seconds each program run sleeps")
+    parser.add_argument("--rounds", type=int, default=5, help="answers checked per mode")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[2, 4],
+                        help="values of CHECKING_MAX_CONCURRENT_RUNS to compare")
+    main(parser.parse_args())
@@ -0,0 +1,205 @@
+"""
+Benchmarks the whole file exercise checking pipeline (run_tests, run_test,
+run_command and generate_results) on synthetic exercises:
+
+baseline -- a few tests with short outputs
+many-tests -- an exercise with many tests
+many-stages -- tests with many stages of several commands
+large-output -- long outputs that match the reference
+large-diff -- long outputs that differ from the reference everywhere
+json-output -- a tester that reports its results as JSON
+
+The answers are checked in-process with run_tests.apply(), so no broker or
+worker is needed, but the Redis result store must be available. For each
+scenario the benchmark reports the throughput, median and 95th percentile
+latency, median number of database queries and the peak Python memory
+allocated while checking an answer.
+
+The results can be saved with --output and compared against a previous run
+with --baseline, which makes the benchmark exit with status 1 if any metric
+got worse by more than --tolerance. Run it on the same machine with the same
+arguments for both commits to get comparable numbers.
+"""
+
+import os
+import argparse
+import json
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lovelace.settings")
+
+import django
+django.setup()
+
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import translation
+
+from courses import evaluation_cache
+from courses.tasks import run_tests
+from benchmarks.fixtures import benchmark_database, create_benchmark_exercise,\
+    create_benchmark_answer, create_benchmark_context, JSON_PROGRAM
+
+SCENARIOS = {
+    "baseline": {"test_count": 4},
+    "many-tests": {"test_count": 24},
+    "many-stages": {"test_count": 2, "stage_count": 6, "command_count": 2},
+    "large-output": {"test_count": 2, "lines": 20000},
+    "large-diff": {"test_count": 2, "lines": 20000, "answer_lines": 20001, "answer_offset": 1},
+    "json-output": {"test_count": 4, "lines": 500, "program": JSON_PROGRAM, "json_output": True},
+}
+
+# Metrics compared against the baseline; bigger is worse for all of them
+COMPARED_METRICS = ("p50", "p95", "queries", "peak_memory")
+
+# The answer prints the same lines as the reference, shifted by offset
+WRONG_PROGRAM = """
+for i in range({lines}):
+    print("line", i + {offset})
+"""
+
+def check_answer(answer, user, instance, exercise):
+    result = run_tests.s(
+        user_id=user.id,
+        instance_id=instance.id,
+        exercise_id=exercise.id,
+        answer_id=answer.id,
+        lang_code=translation.get_language(),
+        revision=None
+    ).apply()
+    result.get()
+    result.forget()
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def run_scenario(user, instance, scenario, rounds, delay):
+    scenario = dict(scenario)
+    answer_lines = scenario.pop("answer_lines", None)
+    answer_offset = scenario.pop("answer_offset", 0)
+    exercise, revision, code = create_benchmark_exercise(delay=delay, **scenario)
+    if answer_lines is not None:
+        code = WRONG_PROGRAM.format(lines=answer_lines, offset=answer_offset)
+
+    # Exercise ids are reused between runs of the benchmark, so anything
+    # cached by an earlier run must not be found
+    evaluation_cache.invalidate_exercise(exercise.id)
+
+    def new_answer():
+        return create_benchmark_answer(exercise, revision, user, instance, code)
+
+    # The first answer fills the reference cache and the test plan cache
+    check_answer(new_answer(), user, instance, exercise)
+
+    latencies = []
+    queries = []
+    start = time.perf_counter()
+    for _ in range(rounds):
+        answer = new_answer()
+        with CaptureQueriesContext(connection) as context:
+            answer_start = time.perf_counter()
+            check_answer(answer, user, instance, exercise)
+            latencies.append(time.perf_counter() - answer_start)
+        queries.append(len(context.captured_queries))
+    elapsed = time.perf_counter() - start
+
+    # Tracing allocations slows checking down, so memory is measured
+    # separately from the latencies
+    answer = new_answer()
+    tracemalloc.start()
+    try:
+        check_answer(answer, user, instance, exercise)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "answers": rounds,
+        "throughput": rounds / elapsed,
+        "p50": _percentile(latencies, 0.5),
+        "p95": _percentile(latencies, 0.95),
+        "max": max(latencies),
+        "queries": statistics.median(queries),
+        "peak_memory": peak,
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the change of each metric from the baseline and returns the
+    metrics that got worse by more than the tolerance.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if not old[metric]:
+                continue
+            change = metrics[metric] / old[metric] - 1
+            flag = ""
+            if change > tolerance:
+                flag = "  REGRESSION"
+                regressions.append((name, metric))
+            print("  {:<14} {:<12} {:+7.1%}{}".format(name, metric, change, flag))
+    return regressions
+
+def main(args):
+    names = args.scenarios or list(SCENARIOS.keys())
+    results = {}
+    with benchmark_database():
+        user, instance = create_benchmark_context()
+        with override_settings(CHECKING_REFERENCE_CACHE=not args.no_reference_cache):
+            for name in names:
+                results[name] = run_scenario(user, instance, SCENARIOS[name], args.rounds, args.delay)
+                metrics = results[name]
+                print("{:<14} {:6.2f} answers/s  p50 {:7.3f} s  p95 {:7.3f} s  "
+                      "{:5.0f} queries  peak {:8.1f} KiB".format(
+                    name, metrics["throughput"], metrics["p50"], metrics["p95"],
+                    metrics["queries"], metrics["peak_memory"] / 1024
+                ))
+
+    print("Max RSS of the benchmark process {} KiB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({
+                "revision": git_revision(),
+                "arguments": vars(args),
+                "results": results,
+            }, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        print("Compared to {}:".format(baseline.get("revision") or args.baseline))
+        if compare(results, baseline["results"], args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS.keys()),
+                        help="scenarios to run, all by default")
+    parser.add_argument("--rounds", type=int, default=10, help="answers checked per scenario")
+    parser.add_argument("--delay", type=float, default=0, help="seconds each program run sleeps")
+    parser.add_argument("--no-reference-cache", action="store_true",
+                        help="run the reference for every answer")
+    parser.add_argument("--output", help="file to save the results in as JSON")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative change of a metric that counts as a regression")
+    main(parser.parse_args())
@@ -0,0 +1,70 @@
+"""
+Compares the bounded diff engine of courses.evaluation_diff against the plain
+prettydiff HtmlDiff on large synthetic program outputs: identical outputs,
+outputs with a few changed lines and completely different outputs.
+
+The plain HtmlDiff can take minutes on the completely different outputs, so it
+is skipped for them unless --full is given.
+"""
+
+import os
+import argparse
+import random
+import statistics
+import time
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lovelace.settings")
+
+import django
+django.setup()
+
+import prettydiff.difflib as difflib
+
+from courses.evaluation_diff import make_diff_table
+
+def generate_outputs(lines, seed):
+    rng = random.Random(seed)
+    reference = ["Result {}: {}".format(i, rng.randint(0, 10 ** 6)) for i in range(lines)]
+    near = list(reference)
+    for i in rng.sample(range(lines), min(5, lines)):
+        near[i] += " (wrong)"
+    different = ["{:x}".format(rng.getrandbits(64)) for _ in range(lines)]
+    return {
+        "identical": (list(reference), reference),
+        "near-identical": (near, reference),
+        "different": (different, reference),
+    }
+
+def time_diff(make_table, fromlines, tolines, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        make_table(fromlines, tolines)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def plain_table(fromlines, tolines):
+    return difflib.HtmlDiff().make_table(fromlines=fromlines, tolines=tolines)
+
+def main(args):
+    engines = [("bounded", make_diff_table), ("HtmlDiff", plain_table)]
+    for lines in args.lines:
+        print("{} lines, {} rounds".format(lines, args.rounds))
+        for case, (fromlines, tolines) in generate_outputs(lines, args.seed).items():
+            for name, make_table in engines:
+                if name == "HtmlDiff" and case == "different" and not args.full:
+                    print("  {:<16} {:<10} skipped".format(case, name))
+                    continue
+                timings = time_diff(make_table, fromlines, tolines, args.rounds)
+                print("  {:<16} {:<10} median {:8.4f} s  max {:8.4f} s".format(
+                    case, name, statistics.median(timings), max(timings)
+                ))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, nargs="+", default=[1000, 10000],
+                        help="numbers of output lines to compare")
+    parser.add_argument("--rounds", type=int, default=3, help="diffs per case")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic outputs")
+    parser.add_argument("--full", action="store_true",
+                        help="also run plain HtmlDiff on completely different outputs")
+    main(parser.parse_args())
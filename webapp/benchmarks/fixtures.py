@@ -0,0 +1,138 @@
+"""
+Synthetic fixtures and database setup shared by the benchmarks.
+"""
+
+import datetime
+import shutil
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core import files
+from django.test.utils import setup_databases, teardown_databases, setup_test_environment,\
+    teardown_test_environment
+from reversion import revisions as reversion
+from reversion.models import Version
+
+from courses.models import *
+from courses.tests.testhelpers import create_admin_user, create_course_with_instance,\
+    TestSettingsNotUsed
+
+# A program that produces a predictable amount of output after a short wait.
+# Used both as the student's answer and as the reference implementation.
+SLEEPY_PROGRAM = """
+import time
+time.sleep({delay})
+for i in range({lines}):
+    print("line", i)
+"""
+
+# A tester that reports its results as JSON, with one test run per line of
+# the usual output.
+JSON_PROGRAM = """
+import json
+import time
+time.sleep({delay})
+print(json.dumps({{
+    "tester": "benchmark",
+    "tests": [{{
+        "title": "benchmark test",
+        "runs": [
+            {{"output": [{{"msg": "line " + str(i), "flag": 1, "triggers": [], "hints": []}}]}}
+            for i in range({lines})
+        ]
+    }}]
+}}))
+"""
+
+@contextmanager
+def benchmark_database(verbosity=0):
+    """
+    Creates the test databases for the duration of a benchmark. Refuses to run
+    without TEST_SETTINGS for the same reason as the unit tests: the media root
+    is removed afterwards.
+    """
+    if not getattr(settings, "TEST_SETTINGS", False):
+        raise TestSettingsNotUsed(
+            "Using a settings file without TEST_SETTINGS set to True is not allowed."
+        )
+
+    setup_test_environment()
+    old_config = setup_databases(verbosity=verbosity, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=verbosity)
+        teardown_test_environment()
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+def create_benchmark_exercise(test_count=4, stage_count=1, command_count=1,
+                              program=SLEEPY_PROGRAM, delay=0.2, lines=10, json_output=False):
+    """
+    Creates a file upload exercise with test_count tests, each running
+    stage_count stages of command_count commands. The commands run the
+    returned file (or the reference when checking the reference) and compare
+    its output to the reference, or with json_output, read the results from
+    the output.
+    """
+    code = program.format(delay=delay, lines=lines)
+    with reversion.create_revision():
+        exercise = FileUploadExercise(
+            name="benchmark exercise {}".format(FileUploadExercise.objects.count()),
+            content="benchmark content",
+            default_points=1,
+        )
+        exercise.save()
+
+        file_settings = IncludeFileSettings(name="reference.py", purpose="REFERENCE")
+        file_settings.save()
+        reference = FileExerciseTestIncludeFile(
+            exercise=exercise,
+            file_settings=file_settings,
+            default_name="reference.py",
+        )
+        reference.fileinfo = files.base.ContentFile(code, "reference.py")
+        reference.save()
+
+        for t in range(test_count):
+            test = FileExerciseTest(exercise=exercise, name="benchmark test {}".format(t))
+            test.save()
+            for s in range(stage_count):
+                stage = FileExerciseTestStage(test=test, name="stage {}".format(s), ordinal_number=s + 1)
+                stage.save()
+                for c in range(command_count):
+                    command = FileExerciseTestCommand(
+                        stage=stage,
+                        command_line="python3 $RETURNABLES",
+                        significant_stdout=not json_output,
+                        json_output=json_output,
+                        ordinal_number=c + 1,
+                    )
+                    command.save()
+
+    revision = Version.objects.get_for_object(exercise).latest("revision__date_created").revision_id
+    return exercise, revision, code
+
+def create_benchmark_answer(exercise, revision, user, instance, code):
+    answer = UserFileUploadExerciseAnswer(
+        instance=instance,
+        exercise=exercise,
+        revision=revision,
+        user=user,
+        answer_date=datetime.datetime.now(),
+        answerer_ip="127.0.0.1",
+    )
+    answer.save()
+
+    return_file = FileUploadExerciseReturnFile(answer=answer)
+    return_file.fileinfo = files.base.ContentFile(code, "answer.py")
+    return_file.save()
+    return answer
+
+def create_benchmark_context():
+    """
+    Creates the user and the course instance that the benchmark answers are
+    attributed to.
+    """
+    user = create_admin_user()
+    course, instance = create_course_with_instance()
+    return user, instance
@@ -0,0 +1,90 @@
+"""
+Compares the single-pass inline markup parser of courses.blockparser against
+the multi-pass parser it replaced on the text of the content pages in the
+database, or on synthetic paragraphs if there are none. Checks that both
+produce the same HTML for every block and reports the blocks that differ.
+
+Blocks with markup the single scan can't parse the same way are passed to the
+multi-pass parser; the share of those is reported too.
+"""
+
+import os
+import argparse
+import statistics
+import time
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lovelace.settings")
+
+import django
+django.setup()
+
+from courses import blockparser
+from courses import models as cm
+
+SYNTHETIC_BLOCKS = [
+    "A paragraph of plain text that doesn't have any markup in it, which is what most of the text is.",
+    "Some '''bold''' and ''italic'' text with `{enter}` and [[https://docs.python.org/3/|a link]].",
+    "A [!hint=example!]hinted part[!hint!], a [!term=Example!]term[!term!] and !!!marked!!! text.",
+    "Code like {{{print(x)}}} in the middle of a sentence.",
+    "'''Bold with ''italic'' inside''' falls back to the multi-pass parser.",
+]
+
+def collect_blocks(limit):
+    blocks = []
+    for content in cm.ContentPage.objects.values_list("content", flat=True).iterator():
+        blocks.extend(line.strip() for line in content.splitlines() if line.strip())
+        if limit and len(blocks) >= limit:
+            return blocks[:limit]
+    return blocks
+
+def parse(parser, block, context):
+    try:
+        return parser(block, context)
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e)
+
+def time_parser(parser, blocks, context, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for block in blocks:
+            parse(parser, block, context)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def main(args):
+    context = None
+    if args.instance:
+        instance = cm.CourseInstance.objects.get(slug=args.instance)
+        context = {"course": instance.course, "instance": instance}
+
+    blocks = collect_blocks(args.limit) or SYNTHETIC_BLOCKS * 200
+    fallbacks = sum(1 for block in blocks if blockparser.tokenize(block) is None)
+    print("{} blocks, {} ({:.1f} %) parsed with the multi-pass parser".format(
+        len(blocks), fallbacks, 100 * fallbacks / len(blocks)
+    ))
+
+    differing = 0
+    for block in blocks:
+        single = parse(blockparser.parseblock, block, context)
+        multi = parse(blockparser.parseblock_multipass, block, context)
+        if single != multi:
+            differing += 1
+            if differing <= args.show:
+                print("Different HTML for {!r}:\n  single: {!r}\n  multi:  {!r}".format(block, single, multi))
+    print("{} blocks with different HTML".format(differing))
+
+    for name, parser in [("single-pass", blockparser.parseblock), ("multi-pass", blockparser.parseblock_multipass)]:
+        timings = time_parser(parser, blocks, context, args.rounds)
+        print("  {:<12} median {:8.4f} s  max {:8.4f} s".format(name, statistics.median(timings), max(timings)))
+
+    if differing:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--limit", type=int, default=None, help="blocks taken from the database at most")
+    parser.add_argument("--instance", default=None,
+                        help="slug of the course instance used to resolve internal links")
+    parser.add_argument("--rounds", type=int, default=5, help="passes over the blocks per parser")
+    parser.add_argument("--show", type=int, default=10, help="differing blocks printed at most")
+    main(parser.parse_args())
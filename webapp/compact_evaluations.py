@@ -0,0 +1,72 @@
+"""
+Converts the test results of evaluations stored as plain JSON in
+Evaluation.test_results to the compact storage of courses/evaluation_storage.py
+and deletes the stored outputs no evaluation refers to anymore.
+"""
+
+import os
+import argparse
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lovelace.settings")
+
+import django
+django.setup()
+
+import datetime
+import json
+
+from django.conf import settings
+from django.db import transaction
+
+import courses.models as c_models
+from courses import evaluation_storage
+
+def compact_evaluations(args):
+    if not getattr(settings, "CHECKING_COMPACT_RESULTS", True):
+        print("CHECKING_COMPACT_RESULTS is not set, nothing to do")
+        return
+
+    converted = 0
+    saved_bytes = 0
+    last_id = 0
+    while args.limit is None or converted < args.limit:
+        batch_size = args.batch_size if args.limit is None else min(args.batch_size, args.limit - converted)
+        evaluations = list(
+            c_models.Evaluation.objects.filter(id__gt=last_id).exclude(test_results="").order_by("id")[:batch_size]
+        )
+        if not evaluations:
+            break
+        last_id = evaluations[-1].id
+
+        with transaction.atomic():
+            for evaluation in evaluations:
+                old_size = len(evaluation.test_results)
+                try:
+                    results = json.loads(evaluation.test_results)
+                except ValueError:
+                    print("Evaluation {} has invalid test results, skipped".format(evaluation.id))
+                    continue
+                evaluation_storage.store_results(evaluation, results)
+                evaluation.save(update_fields=["test_results", "packed_results"])
+                saved_bytes += old_size - len(evaluation.packed_results or b"")
+                converted += 1
+        print("Converted {} evaluations, {:.1f} MiB smaller rows".format(converted, saved_bytes / 1024 ** 2))
+
+        if len(evaluations) < batch_size:
+            break
+
+    if not args.keep_orphans:
+        deleted = evaluation_storage.delete_orphaned_outputs(
+            datetime.timedelta(hours=args.grace_hours), args.batch_size
+        )
+        print("Deleted {} outputs no evaluation refers to".format(deleted))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=500, help="evaluations converted per transaction")
+    parser.add_argument("--limit", type=int, default=None, help="stop after converting this many evaluations")
+    parser.add_argument("--keep-orphans", action="store_true",
+                        help="don't delete the outputs no evaluation refers to")
+    parser.add_argument("--grace-hours", type=float, default=24,
+                        help="keep outputs used within this many hours even if no evaluation refers to them")
+    args = parser.parse_args()
+    compact_evaluations(args)
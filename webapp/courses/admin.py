@@ -1,6 +1,7 @@
 import django.conf
 
 from courses.models import *
+import courses.tasks as rpc_tasks
 
 from django.contrib import admin
 from django.contrib.auth.models import User
@@ -860,5 +861,8 @@ class CourseInstanceAdmin(TranslationAdmin, VersionAdmin):
         else:
             for cg in ContentGraph.objects.filter(instance=obj):
                 cg.content.update_embedded_links(obj, cg.revision)
+
+        if obj.frozen or obj.visible:
+            rpc_tasks.warm_page_cache.delay(obj.id)
             
 admin.site.register(CourseInstance, CourseInstanceAdmin)
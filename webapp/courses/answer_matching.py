@@ -0,0 +1,175 @@
+"""
+Matching of given answers against the answer choices of textfield and
+repeated template exercises.
+
+An AnswerMatcher compiles the regular expressions of the choices and the
+patterns that substitute the named groups of a match into the hints and
+comments ({name} in the text) once, and can then evaluate any number of
+given answers. Matchers are cached in-process by get_matcher under a key
+that identifies an immutable set of choices, e.g. an exercise revision.
+
+The current choices of an exercise are identified by a generation stored in
+the Django cache, so that every process sees when they change. Saving the
+exercise or its choices starts a new generation with invalidate_exercise.
+"""
+
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+
+
+class MatchResult:
+    """
+    Evaluation of one given answer.
+
+    correct -- whether the answer is correct
+    hints, comments -- texts of the matching choices, groups substituted
+    errors -- (choice, re.error) pairs of choices with a broken regexp
+    matches -- (choice, error message) pairs of the matching and broken
+        choices in the order of the choices, the message empty for matches
+    """
+
+    def __init__(self):
+        self.correct = False
+        self.hints = []
+        self.comments = []
+        self.errors = []
+        self.matches = []
+
+    @property
+    def hinted(self):
+        """
+        Whether an incorrect choice with a hint matched the answer.
+        """
+        return any(choice.hint and not choice.correct for choice, error in self.matches if not error)
+
+
+class _CompiledChoice:
+
+    def __init__(self, choice):
+        self.choice = choice
+        self.pattern = None
+        self.error = None
+        self.placeholders = None
+        if choice.regexp:
+            try:
+                self.pattern = re.compile(choice.answer)
+            except re.error as e:
+                self.error = e
+                return
+            if self.pattern.groupindex:
+                self.placeholders = re.compile("|".join(
+                    re.escape("{{{k}}}".format(k=k)) for k in self.pattern.groupindex
+                ))
+
+    def match(self, given_answer):
+        if self.pattern is None:
+            return self.choice.answer == given_answer, None
+        m = self.pattern.match(given_answer)
+        return m is not None, m
+
+    def substitute(self, text, m):
+        if not text or m is None or self.placeholders is None:
+            return text
+        groups = {"{{{k}}}".format(k=k): v for k, v in m.groupdict().items() if v is not None}
+        if not groups:
+            return text
+        return self.placeholders.sub(lambda mo: groups.get(mo.group(0), mo.group(0)), text)
+
+
+class AnswerMatcher:
+    """
+    Evaluates given answers against answer choices that have the attributes
+    correct, regexp, answer, hint and comment.
+    """
+
+    def __init__(self, choices):
+        self.choices = [_CompiledChoice(choice) for choice in choices]
+
+    def evaluate(self, given_answer):
+        """
+        Evaluates a given answer and returns a MatchResult.
+        """
+        result = MatchResult()
+        for compiled in self.choices:
+            choice = compiled.choice
+            if compiled.error is not None:
+                result.errors.append((choice, compiled.error))
+                result.matches.append((choice, "{}".format(compiled.error)))
+                result.correct = False
+                continue
+
+            match, m = compiled.match(given_answer)
+            hint = compiled.substitute(choice.hint, m)
+            comment = compiled.substitute(choice.comment, m)
+
+            if match:
+                result.matches.append((choice, ""))
+            if match and choice.correct:
+                result.correct = True
+                if comment:
+                    result.comments.append(comment)
+            elif match and not choice.correct:
+                if hint:
+                    result.hints.append(hint)
+                if comment:
+                    result.comments.append(comment)
+            elif not match and choice.correct:
+                if hint:
+                    result.hints.append(hint)
+        return result
+
+    def evaluate_many(self, given_answers):
+        """
+        Evaluates many given answers. Returns a dictionary of the distinct
+        answers mapped to their MatchResults.
+        """
+        return {given_answer: self.evaluate(given_answer) for given_answer in set(given_answers)}
+
+
+_matchers = OrderedDict()
+_lock = threading.Lock()
+
+def get_matcher(key, get_choices):
+    """
+    Returns the cached matcher of the key, or creates one from the choices
+    returned by get_choices. The key must identify choices that don't change,
+    and its first item must be the exercise id. Keys with None in them are
+    never cached.
+    """
+    if None in key:
+        return AnswerMatcher(get_choices())
+
+    with _lock:
+        matcher = _matchers.get(key)
+        if matcher is not None:
+            _matchers.move_to_end(key)
+            return matcher
+
+    matcher = AnswerMatcher(get_choices())
+    with _lock:
+        _matchers[key] = matcher
+        while len(_matchers) > getattr(django_settings, "ANSWER_MATCHER_CACHE_SIZE", 512):
+            _matchers.popitem(last=False)
+    return matcher
+
+def get_choices_generation(exercise_id):
+    """
+    Returns the generation of the current choices of the exercise.
+    """
+    key = "answer_choices_gen_{}".format(exercise_id)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        cache.set(key, generation, timeout=None)
+    return generation
+
+def invalidate_exercise(exercise_id):
+    cache.set("answer_choices_gen_{}".format(exercise_id), uuid.uuid4().hex, timeout=None)
+    with _lock:
+        for key in [key for key in _matchers if key[0] == exercise_id]:
+            del _matchers[key]
@@ -12,6 +12,7 @@ from django.utils.text import slugify
 from django.urls import reverse
 from pygments.lexers import get_lexer_by_name, get_all_lexers
 from pygments.formatters import HtmlFormatter
+from courses import highlight_cache
 
 class Tag:
     """One markup tag type."""
@@ -61,6 +62,46 @@ tags = {
     "term":   Tag("div", '[!term=term_name!]', '[!term!]', re.compile(r"\[\!term\=(?P<term_name>[^!]+)\!\](?P<term_text>.+?)\[\!term\!\]")),
 }
 
+# The order in which the multi-pass parser applies the tags
+PASS_ORDER = ("pre", "bold", "italic", "mark", "kbd", "anchor", "hint", "term")
+
+# All the tags in one regex for the single-pass tokenizer. The lookahead lets
+# the scan skip quickly to the characters that can begin a tag.
+inline_re = re.compile(r"(?=['{!`\[])(?:" + "|".join(
+    "(?P<tag_{}>{})".format(tagname, tags[tagname].re.pattern) for tagname in PASS_ORDER
+) + ")")
+
+# Lengths of the beginning and ending markup of the tags
+delimiter_lengths = {
+    "pre": (3, 3),
+    "bold": (3, 3),
+    "italic": (2, 2),
+    "mark": (3, 3),
+    "kbd": (1, 1),
+    "anchor": (2, 2),
+    "hint": (7, 8),
+    "term": (7, 8),
+}
+
+# Text that begins a tag, and characters that could make one with the
+# markup of a tag next to them
+tag_starts = re.compile(r"''|\{\{\{|!!!|`|\[\[|\[!hint=|\[!term=")
+delimiter_chars = frozenset("'{}`[]")
+
+key_mini_lang = {
+    "{apple}": " Apple",
+    "{arrowdown}": "↓",
+    "{arrowleft}": "←",
+    "{arrowright}": "→",
+    "{arrowup}": "↑",
+    "{enter}": "↵ Enter",
+    "{cmd}": "⌘ Command",
+    "{meta}": "◆ Meta",
+    "{option}": "⌥ Option",
+    "{shift}": "⇧ Shift",
+    "{win}": "⊞ Win",
+}
+
 def parse_pre_tag(parsed_string, tag, hilite, match):
     code_string = match.group(0)[tag.lb()+len(hilite):-tag.le()]
     for escaped, unescaped in {"&lt;":"<", "&gt;":">", "&amp;":"&"}.items():
@@ -69,12 +110,12 @@ def parse_pre_tag(parsed_string, tag, hilite, match):
     
     parsed_string += tag.htmlbegin({"class":"highlight " + hilite})
     try:
-        lexer = get_lexer_by_name(hilite)
+        highlighted = highlight_cache.highlight(code_string, hilite, nowrap=True)
     except pygments.util.ClassNotFound as e:
         parsed_string += "no such highlighter: %s; " % hilite
         parsed_string += code_string
     else:    
-        parsed_string += highlight(code_string, lexer, HtmlFormatter(nowrap=True)).rstrip("\n")
+        parsed_string += highlighted.rstrip("\n")
     parsed_string += tag.htmlend()
 
     return parsed_string
@@ -95,7 +136,7 @@ def parse_anchor_tag(parsed_string, tag, address, link_text, context):
         if server_side.startswith("file:"):
             file_slug = server_side.split("file:", 1)[1]
             try:
-                mediafile = courses.models.File.objects.get(name=file_slug)
+                mediafile = courses.markupparser.get_link_lookup(context).file(file_slug)
             except courses.models.File.DoesNotExist:
                 parsed_string += "<span>-- WARNING: BROKEN LINK --</span>"
                 final_address = ""
@@ -111,7 +152,7 @@ def parse_anchor_tag(parsed_string, tag, address, link_text, context):
             if server_side == slugified and context is not None:
                 # internal address
                 try:
-                    content = courses.models.ContentPage.objects.get(slug=slugified)
+                    content = courses.markupparser.get_link_lookup(context).page(slugified)
                 except courses.models.ContentPage.DoesNotExist:
                     parsed_string += "<span>-- WARNING: BROKEN LINK --</span>"
                     final_address = ""
@@ -151,79 +192,88 @@ def parse_term_tag(parsed_string, tag, term_name, term_text, context):
     parsed_string += tag.htmlend()
     return parsed_string
 
+def parsematch(tagname, m, context=None):
+    """Generates the HTML of one tag matched by its regex or inline_re."""
+    tag = tags[tagname]
+    if tagname == "pre" and m.group("highlight"):
+        return parse_pre_tag("", tag, m.group("highlight"), m)
+    elif tagname == "anchor":
+        return parse_anchor_tag("", tag, m.group("address"), m.group("link_text"), context)
+    elif tagname == "hint":
+        return parse_hint_tag("", tag, m.group("hint_id"), m.group("hint_text"))
+    elif tagname == "term":
+        return parse_term_tag("", tag, m.group("term_name"), m.group("term_text"), context)
+
+    contents = m.group(0)[tag.lb():-tag.le()]
+    if tagname == "kbd":
+        contents = key_mini_lang.get(contents, contents)
+    return tag.htmlbegin() + contents + tag.htmlend()
+
 def parsetag(tagname, unparsed_string, context=None):
     """Parses one tag and applies it's settings. Generates the HTML."""
     tag = tags[tagname]
-    hilite = address = link_text = hint_id = hint_text = term_name = term_text = None
-    parsed_string = ""
+    parsed = []
     cursor = 0
     for m in re.finditer(tag.re, unparsed_string):
-        parsed_string += unparsed_string[cursor:m.start()]
-
-        # Get code
-        try:
-            hilite = m.group("highlight")
-        except IndexError:
-            pass
-
-        # Get anchor
-        try:
-            address = m.group("address")
-            link_text = m.group("link_text")
-        except IndexError:
-            pass
-
-        # Get hint
-        try:
-            hint_id = m.group("hint_id")
-            hint_text = m.group("hint_text")
-        except IndexError:
-            pass
-
-        try:
-            term_name = m.group("term_name")
-            term_text = m.group("term_text")
-        except IndexError:
-            pass
-        
-        if hilite:
-            parsed_string = parse_pre_tag(parsed_string, tag, hilite, m)
-        elif address:
-            parsed_string = parse_anchor_tag(parsed_string, tag, address, link_text, context)
-        elif hint_id:
-            parsed_string = parse_hint_tag(parsed_string, tag, hint_id, hint_text)
-        elif term_name:
-            parsed_string = parse_term_tag(parsed_string, tag, term_name, term_text, context)
-        else:
-            contents = m.group(0)[tag.lb():-tag.le()]
-
-            if tagname == "kbd":
-                key_mini_lang = {
-                    "{apple}": " Apple",
-                    "{arrowdown}": "↓",
-                    "{arrowleft}": "←",
-                    "{arrowright}": "→",
-                    "{arrowup}": "↑",
-                    "{enter}": "↵ Enter",
-                    "{cmd}": "⌘ Command",
-                    "{meta}": "◆ Meta",
-                    "{option}": "⌥ Option",
-                    "{shift}": "⇧ Shift",
-                    "{win}": "⊞ Win",
-                }
-                contents = key_mini_lang.get(contents, contents)
-            
-            parsed_string += tag.htmlbegin()
-            parsed_string += contents
-            parsed_string += tag.htmlend()
-
+        parsed.append(unparsed_string[cursor:m.start()])
+        parsed.append(parsematch(tagname, m, context))
         cursor = m.end()
-        hilite = False
-    parsed_string += unparsed_string[cursor:]
+    parsed.append(unparsed_string[cursor:])
 
-    return parsed_string
+    return "".join(parsed)
+
+def tokenize(blockstring):
+    """
+    Splits a block into text and tags in one scan. Returns a list of
+    (tagname, match) pairs with None as the tagname of text and the text
+    itself as the match, or None if tags are nested in or next to other tags
+    or the text has tag markup that doesn't make a complete tag. Those the
+    passes of parseblock_multipass can parse differently than a single scan.
+    """
+    tokens = []
+    cursor = 0
+    for m in inline_re.finditer(blockstring):
+        tagname = m.lastgroup[len("tag_"):]
+        start, end = m.span()
+        begin, finish = delimiter_lengths[tagname]
+        inner_start, inner_end = start + begin, end - finish
+        if tag_starts.search(blockstring, cursor, start) \
+           or tag_starts.search(blockstring, inner_start, inner_end):
+            return None
+        for i in (start - 1, end, inner_start, inner_end - 1):
+            if 0 <= i < len(blockstring) and blockstring[i] in delimiter_chars:
+                return None
+
+        if cursor < start:
+            tokens.append((None, blockstring[cursor:start]))
+        tokens.append((tagname, m))
+        cursor = end
+
+    if tag_starts.search(blockstring, cursor):
+        return None
+    if cursor < len(blockstring):
+        tokens.append((None, blockstring[cursor:]))
+    return tokens
 
 def parseblock(blockstring, context=None):
+    """
+    A parser for inline markup language inside paragraphs. Recognizes all
+    the tags in one scan and falls back to the multi-pass parser for blocks
+    that the scan can't parse the same way.
+    """
+    if not tag_starts.search(blockstring):
+        return blockstring
+
+    tokens = tokenize(blockstring)
+    if tokens is None:
+        return parseblock_multipass(blockstring, context)
+
+    return "".join(
+        m if tagname is None else parsematch(tagname, m, context)
+        for tagname, m in tokens
+    )
+
+def parseblock_multipass(blockstring, context=None):
     """A multi-pass parser for inline markup language inside paragraphs."""
     # TODO: Start with pre tags to prevent formatting inside pre
     #       - Perhaps use a state machine to determine, whether inside pre
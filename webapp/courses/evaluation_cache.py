@@ -0,0 +1,226 @@
+"""
+Caching of reference results for file upload exercise evaluation tasks.
+
+For a given exercise revision, set of tests and include files, running the
+reference implementation always produces the same output. The results are
+therefore stored in the Django cache under a key that consists of the
+exercise id, the revision and a content hash of the test plan, which covers
+everything that goes into the reference run.
+
+Everything cached for an exercise also carries the current cache generation of
+the exercise. Saving a new revision of the exercise through reversion starts
+a new generation, which invalidates the cached test plans and reference
+results of that exercise.
+
+Answers to file upload exercises carry a submission hash over the returned
+files and the test plan. A resubmission of byte-identical files to the same
+exercise revision and instance reuses the automatic evaluation of the earlier
+answer instead of being checked again. The lookups are counted in the Django
+cache and can be read with get_duplicate_stats.
+
+The rendered report of an evaluation, i.e. the output diffs and the messages
+of the checker, never changes once the evaluation has been made. It's cached
+under the evaluation id, the exercise revision of the answer and the language
+it was rendered in, so that viewing old answers doesn't regenerate it.
+"""
+
+import hashlib
+import json
+import uuid
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+
+from courses import evaluation_storage
+from courses import models as cm
+
+
+def get_exercise_generation(exercise_id):
+    """
+    Returns the current cache generation of the exercise. A new generation is
+    started every time the exercise is saved, which makes everything cached
+    for the previous generation of the exercise unreachable.
+    """
+    key = "file_exercise_gen_{}".format(exercise_id)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        cache.set(key, generation, timeout=None)
+    return generation
+
+def compute_reference_hash(plan):
+    """
+    Computes a content hash over the test plan, i.e. the tests, stages and
+    commands of the exercise and the metadata and content hashes of the
+    exercise and instance include files.
+    """
+    plan_json = json.dumps(plan, sort_keys=True, default=str)
+    return hashlib.sha256(plan_json.encode("utf-8")).hexdigest()
+
+def get_reference_cache_key(plan):
+    return "reference_results_{exercise}_{revision}_{generation}_{content}".format(
+        exercise=plan["exercise_id"],
+        revision=plan["revision"],
+        generation=get_exercise_generation(plan["exercise_id"]),
+        content=compute_reference_hash(plan),
+    )
+
+def get_reference_results(key):
+    """
+    Returns the cached reference results as a dictionary of test ids mapped to
+    the results of the reference run of that test. Tests that haven't been
+    cached yet are missing from the dictionary.
+    """
+    return cache.get(key) or {}
+
+def is_unreliable_command(command):
+    """
+    Whether the results of a command say more about the checking server than
+    about the program: the command timed out, or it couldn't be run at all
+    because e.g. spawning it failed or the runner service was unreachable.
+    """
+    return bool(command.get("timedout") or command.get("error"))
+
+def _unreliable(test_results):
+    for test in test_results.values():
+        for stage in test["stages"].values():
+            for command in stage["commands"].values():
+                if is_unreliable_command(command):
+                    return True
+    return False
+
+def save_reference_results(key, reference_results):
+    """
+    Stores the reference results of the tests. Results of reference runs that
+    are unreliable (see is_unreliable_command) are left out, so that they are
+    run again for the next answer instead of failing every answer.
+    """
+    cacheable = {
+        test_id: test_results for test_id, test_results in reference_results.items()
+        if not _unreliable(test_results)
+    }
+    cache.set(key, cacheable, timeout=getattr(django_settings, "REDIS_LONG_EXPIRE", None))
+
+def compute_submission_hash(plan, student_files):
+    """
+    Computes a content hash over the files returned by the student, given as
+    a dictionary of file names mapped to their contents, and the test plan,
+    which covers the exercise revision and the instance include files.
+    """
+    h = hashlib.sha256(compute_reference_hash(plan).encode("utf-8"))
+    for name, contents in sorted(student_files.items()):
+        h.update(b"\0" + name.encode("utf-8") + b"\0")
+        h.update(hashlib.sha256(contents).digest())
+    return h.hexdigest()
+
+def find_duplicate_evaluation(answer):
+    """
+    Returns the automatic evaluation of an earlier answer with the same
+    submission hash, or None if there's none that can be reused. Evaluations
+    with unreliable student or reference results (see is_unreliable_command)
+    are not reused, so that resubmitting an answer after e.g. the runner
+    service was down gets it checked again.
+    """
+    earlier_answers = cm.UserFileUploadExerciseAnswer.objects.filter(
+        exercise_id=answer.exercise_id,
+        instance_id=answer.instance_id,
+        revision=answer.revision,
+        content_hash=answer.content_hash,
+        evaluation__isnull=False,
+        evaluation__evaluator__isnull=True,
+    ).exclude(id=answer.id).exclude(
+        evaluation__test_results="", evaluation__packed_results__isnull=True
+    ).select_related("evaluation")
+
+    for earlier in earlier_answers.order_by("-answer_date")[:1]:
+        evaluation = earlier.evaluation
+        try:
+            results = evaluation_storage.load_results(evaluation, outputs=False)
+        except ValueError:
+            return None
+        if results is None:
+            return None
+        if _unreliable(results.get("student", {})) or _unreliable(results.get("reference", {})):
+            return None
+        return evaluation
+    return None
+
+def count_duplicate_lookup(hit):
+    key = "duplicate_submission_{}".format("hits" if hit else "misses")
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted in between
+        cache.set(key, 1, timeout=None)
+
+def get_duplicate_stats():
+    """
+    Returns the number of resubmissions that reused an earlier evaluation
+    (hits) and the number of answers that had to be checked (misses).
+    """
+    hits = cache.get("duplicate_submission_hits") or 0
+    misses = cache.get("duplicate_submission_misses") or 0
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+    }
+
+def get_report_cache_key(evaluation_id, revision, lang_code):
+    return "evaluation_report_{evaluation}_{revision}_{lang}".format(
+        evaluation=evaluation_id,
+        revision=revision,
+        lang=lang_code,
+    )
+
+def get_report(evaluation_id, revision, lang_code):
+    """
+    Returns the cached rendered report of an evaluation, or None if it's not
+    cached.
+    """
+    if not getattr(django_settings, "CHECKING_REPORT_CACHE", True):
+        return None
+    return cache.get(get_report_cache_key(evaluation_id, revision, lang_code))
+
+def save_report(evaluation_id, revision, lang_code, report):
+    if not getattr(django_settings, "CHECKING_REPORT_CACHE", True):
+        return
+    cache.set(
+        get_report_cache_key(evaluation_id, revision, lang_code), report,
+        timeout=getattr(django_settings, "CHECKING_REPORT_CACHE_TIMEOUT", None)
+    )
+
+def invalidate_exercise(exercise_id):
+    cache.set("file_exercise_gen_{}".format(exercise_id), uuid.uuid4().hex, timeout=None)
+
+def get_revision_exercise_ids(versions):
+    """
+    Finds out which file upload exercises are affected by the objects saved in
+    a reversion revision.
+    """
+    exercise_ids = set()
+    for version in versions:
+        model = version.content_type.model_class()
+        if model is None:
+            continue
+        object_id = version.object_id
+        if issubclass(model, cm.ContentPage):
+            if version.field_dict.get("content_type") == "FILE_UPLOAD_EXERCISE":
+                exercise_ids.add(int(object_id))
+        elif issubclass(model, (cm.FileExerciseTest, cm.FileExerciseTestIncludeFile)):
+            exercise_ids.add(version.field_dict.get("exercise_id", version.field_dict.get("exercise")))
+        elif issubclass(model, cm.FileExerciseTestStage):
+            exercise_ids.update(cm.FileExerciseTest.objects.filter(
+                fileexerciseteststage__id=object_id
+            ).values_list("exercise_id", flat=True))
+        elif issubclass(model, cm.FileExerciseTestCommand):
+            exercise_ids.update(cm.FileExerciseTest.objects.filter(
+                fileexerciseteststage__fileexercisetestcommand__id=object_id
+            ).values_list("exercise_id", flat=True))
+        elif issubclass(model, cm.InstanceIncludeFile):
+            exercise_ids.update(cm.InstanceIncludeFileToExerciseLink.objects.filter(
+                include_file__id=object_id
+            ).values_list("exercise_id", flat=True))
+    exercise_ids.discard(None)
+    return exercise_ids
@@ -0,0 +1,147 @@
+"""
+Bounded output diffs for file upload exercise evaluation results.
+
+The stdout and stderr diffs shown to the student are HTML tables made by
+prettydiff's HtmlDiff. Its SequenceMatcher based differencing is quadratic in
+the worst case, both in the number of differing lines and in the length of the
+lines it compares character by character, so a badly misbehaving submission
+could keep a worker busy for seconds. BoundedHtmlDiff produces the same table
+but:
+
+- compares the common leading and trailing lines of the outputs without
+  SequenceMatcher, which makes identical and near-identical outputs cheap
+- only gives the differing middle part to SequenceMatcher if it's within the
+  size budget, and gives up on it if the time budget runs out
+- otherwise compares the middle part line by line in order, showing at most
+  max_lines of it, and summarizes the rest
+"""
+
+import time
+
+from django.conf import settings as django_settings
+
+import prettydiff.difflib as difflib
+
+FILLER = ("", "\n")
+
+
+def _common_prefix(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+def _common_suffix(a, b, prefix):
+    n = min(len(a), len(b)) - prefix
+    i = 0
+    while i < n and a[-1 - i] == b[-1 - i]:
+        i += 1
+    return i
+
+def _mark(key, text):
+    return "\0" + key + (text or " ") + "\1"
+
+
+class BoundedHtmlDiff(difflib.HtmlDiff):
+    """
+    HtmlDiff with a fast path for equal lines and a size and time budget
+    for the actual differencing.
+
+    max_cells -- largest product of the differing line counts of the two
+        outputs that is given to SequenceMatcher
+    max_chars -- largest total length of the differing lines that is given
+        to SequenceMatcher
+    time_budget -- seconds SequenceMatcher may use before the differing part
+        is compared line by line instead
+    max_lines -- number of differing lines shown when comparing line by line
+    """
+
+    def __init__(self, max_cells=250000, max_chars=100000, time_budget=1.0, max_lines=500, **kwargs):
+        super().__init__(**kwargs)
+        self.max_cells = max_cells
+        self.max_chars = max_chars
+        self.time_budget = time_budget
+        self.max_lines = max_lines
+        self.summarized = False
+
+    def _make_diffs(self, fromlines, tolines, context_lines):
+        if context_lines is not None:
+            return super()._make_diffs(fromlines, tolines, context_lines)
+
+        prefix = _common_prefix(fromlines, tolines)
+        suffix = _common_suffix(fromlines, tolines, prefix)
+        from_mid = fromlines[prefix:len(fromlines) - suffix]
+        to_mid = tolines[prefix:len(tolines) - suffix]
+
+        rows = [((i + 1, line), (i + 1, line), False) for i, line in enumerate(fromlines[:prefix])]
+        if from_mid or to_mid:
+            rows.extend(self._diff_middle(from_mid, to_mid, prefix))
+        from_offset = len(fromlines) - suffix
+        to_offset = len(tolines) - suffix
+        rows.extend(
+            ((from_offset + i + 1, line), (to_offset + i + 1, line), False)
+            for i, line in enumerate(fromlines[from_offset:])
+        )
+        return iter(rows)
+
+    def _diff_middle(self, from_mid, to_mid, offset):
+        if (from_mid and to_mid
+                and len(from_mid) * len(to_mid) <= self.max_cells
+                and sum(map(len, from_mid)) + sum(map(len, to_mid)) <= self.max_chars):
+            rows = []
+            deadline = time.time() + self.time_budget
+            for fromdata, todata, flag in difflib._mdiff(from_mid, to_mid, None,
+                                                         linejunk=self._linejunk,
+                                                         charjunk=self._charjunk):
+                if time.time() > deadline:
+                    break
+                rows.append((self._shift(fromdata, offset), self._shift(todata, offset), flag))
+            else:
+                return rows
+        elif not from_mid or not to_mid:
+            # Pure additions or deletions are cheap to show as they are
+            return self._compare_in_order(from_mid, to_mid, offset, len(from_mid) + len(to_mid))
+        self.summarized = True
+        return self._compare_in_order(from_mid, to_mid, offset, self.max_lines)
+
+    @staticmethod
+    def _shift(data, offset):
+        num, text = data
+        if isinstance(num, int):
+            return num + offset, text
+        return data
+
+    @staticmethod
+    def _compare_in_order(from_mid, to_mid, offset, max_lines):
+        rows = []
+        total = max(len(from_mid), len(to_mid))
+        for i in range(min(total, max_lines)):
+            num = offset + i + 1
+            if i < len(from_mid) and i < len(to_mid):
+                if from_mid[i] == to_mid[i]:
+                    rows.append(((num, from_mid[i]), (num, to_mid[i]), False))
+                else:
+                    rows.append(((num, _mark("^", from_mid[i])), (num, _mark("^", to_mid[i])), True))
+            elif i < len(from_mid):
+                rows.append(((num, _mark("-", from_mid[i])), FILLER, True))
+            else:
+                rows.append((FILLER, (num, _mark("+", to_mid[i])), True))
+        if total > max_lines:
+            summary = "... {} more differing lines not shown".format(total - max_lines)
+            rows.append((("", summary), ("", summary), True))
+        return rows
+
+
+def make_diff_table(fromlines, tolines, fromdesc="", todesc=""):
+    """
+    Returns the HTML diff table of two outputs, using the diff budget
+    settings.
+    """
+    differ = BoundedHtmlDiff(
+        max_cells=getattr(django_settings, "CHECKING_DIFF_MAX_CELLS", 250000),
+        max_chars=getattr(django_settings, "CHECKING_DIFF_MAX_CHARS", 100000),
+        time_budget=getattr(django_settings, "CHECKING_DIFF_TIME_BUDGET", 1.0),
+        max_lines=getattr(django_settings, "CHECKING_DIFF_MAX_LINES", 500),
+    )
+    return differ.make_table(fromlines=fromlines, tolines=tolines, fromdesc=fromdesc, todesc=todesc)
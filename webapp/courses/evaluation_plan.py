@@ -0,0 +1,255 @@
+"""
+Test plans for file upload exercise evaluation tasks.
+
+A test plan is a snapshot of everything needed for running the tests of a
+file upload exercise: the tests, their stages and commands, the expected
+outputs and the metadata of the files written into the test directory. The
+plan is built once per exercise, revision, course instance and language (test
+names, command lines and inputs are translated) with a fixed number of
+queries, and cached both in the worker process and in the Django
+cache. Checking an answer against a cached plan doesn't touch the database
+apart from fetching the answer itself.
+
+The plan only contains plain dictionaries, lists and scalars. It is shared
+between the threads of a checking task and must not be modified.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import translation
+
+from reversion.models import Version
+
+from courses import models as cm
+from courses import evaluation_cache
+
+# The number of queries build_test_plan makes at most, regardless of the
+# number of tests, stages, commands and files in the exercise.
+PLAN_QUERY_BUDGET = 13
+
+# Purposes of the include files that are written into the test directory
+# when the test requires them.
+TEST_FILE_PURPOSES = ("INPUT", "WRAPPER", "TEST", "LIBRARY")
+
+_LOCAL_PLAN_COUNT = 64
+_local_plans = OrderedDict()
+_local_plans_lock = threading.Lock()
+
+
+def _file_entry(file_obj, file_settings):
+    with open(file_obj.fileinfo.path, "rb") as f:
+        contents_hash = hashlib.sha256(f.read()).hexdigest()
+    return {
+        "name": file_settings.name,
+        "purpose": file_settings.purpose,
+        "chmod": file_settings.chmod_settings,
+        "chown": file_settings.chown_settings,
+        "chgrp": file_settings.chgrp_settings,
+        "path": file_obj.fileinfo.path,
+        "fileinfo": str(file_obj.fileinfo),
+        "sha256": contents_hash,
+    }
+
+def build_test_plan(exercise_id, instance_id, revision=None):
+    """
+    Builds the test plan of an exercise for a course instance. If a revision
+    is given, the tests, stages, commands and exercise include files are
+    taken from that revision and the ones missing from it are left out.
+    """
+    if revision is not None:
+        versions = {
+            (version.content_type.model_class(), str(version.object_id)): version
+            for version in Version.objects.filter(revision_id=revision).select_related("content_type")
+        }
+    else:
+        versions = None
+
+    def resolve(model, obj):
+        if versions is None:
+            return obj
+        version = versions.get((model, str(obj.pk)))
+        if version is None:
+            return None
+        return version._object_version.object
+
+    tests = cm.FileExerciseTest.objects.filter(exercise=exercise_id).order_by("id")
+    stages = cm.FileExerciseTestStage.objects.filter(test__exercise=exercise_id).order_by("ordinal_number")
+    commands = cm.FileExerciseTestCommand.objects.filter(stage__test__exercise=exercise_id).order_by("ordinal_number")
+    expected_outputs = cm.FileExerciseTestExpectedOutput.objects.filter(
+        command__stage__test__exercise=exercise_id
+    ).values("command_id", "correct", "regexp", "expected_answer", "hint", "output_type")
+    required_files = cm.FileExerciseTest.required_files.through.objects.filter(
+        fileexercisetest__exercise=exercise_id
+    ).values_list("fileexercisetest_id", "fileexercisetestincludefile_id")
+    required_instance_files = cm.FileExerciseTest.required_instance_files.through.objects.filter(
+        fileexercisetest__exercise=exercise_id
+    ).values_list("fileexercisetest_id", "instanceincludefile_id")
+
+    plan = {
+        "exercise_id": exercise_id,
+        "instance_id": instance_id,
+        "revision": revision,
+        "language": translation.get_language(),
+        "tests": [],
+        "files": {},
+        "reference_files": [],
+    }
+
+    # Exercise include files
+    exercise_files = {}
+    for ex_file in cm.FileExerciseTestIncludeFile.objects.filter(exercise=exercise_id).select_related("file_settings"):
+        old_file = resolve(cm.FileExerciseTestIncludeFile, ex_file)
+        if old_file is None:
+            continue
+        if old_file.file_settings_id == ex_file.file_settings_id:
+            file_settings = ex_file.file_settings
+        else:
+            file_settings = old_file.file_settings
+        key = "exercise-{}".format(ex_file.id)
+        plan["files"][key] = _file_entry(old_file, file_settings)
+        exercise_files[ex_file.id] = key
+        if file_settings.purpose == "REFERENCE":
+            plan["reference_files"].append(key)
+
+    # Instance include files, in the revision the instance is linked to
+    instance_files = {}
+    exercise_links = list(cm.InstanceIncludeFileToExerciseLink.objects.filter(
+        exercise=exercise_id
+    ).select_related("file_settings", "include_file"))
+    instance_links = {
+        link.include_file_id: link for link in cm.InstanceIncludeFileToInstanceLink.objects.filter(
+            instance__id=instance_id, include_file__in=[link.include_file_id for link in exercise_links]
+        )
+    }
+    linked_revisions = Q()
+    for link in instance_links.values():
+        if link.revision is not None:
+            linked_revisions |= Q(object_id=str(link.include_file_id), revision_id=link.revision)
+    if linked_revisions:
+        file_versions = {
+            (version.object_id, version.revision_id): version
+            for version in Version.objects.get_for_model(cm.InstanceIncludeFile).filter(linked_revisions)
+        }
+    else:
+        file_versions = {}
+
+    for if_link in exercise_links:
+        instance_link = instance_links.get(if_link.include_file_id)
+        if instance_link is None:
+            continue
+        if instance_link.revision is None:
+            file_obj = if_link.include_file
+        else:
+            version = file_versions.get((str(if_link.include_file_id), instance_link.revision))
+            if version is None:
+                continue
+            file_obj = version._object_version.object
+        key = "instance-{}".format(if_link.include_file_id)
+        plan["files"][key] = _file_entry(file_obj, if_link.file_settings)
+        instance_files[if_link.include_file_id] = key
+
+    # Tests, stages and commands
+    outputs_by_command = {}
+    for output in expected_outputs:
+        outputs_by_command.setdefault(output["command_id"], []).append(output)
+
+    commands_by_stage = {}
+    for command in commands:
+        old_command = resolve(cm.FileExerciseTestCommand, command)
+        if old_command is None:
+            continue
+        commands_by_stage.setdefault(command.stage_id, []).append({
+            "id": command.id,
+            "command_line": old_command.command_line,
+            "input_text": old_command.input_text,
+            "return_value": old_command.return_value,
+            "timeout": old_command.timeout.total_seconds(),
+            "signal": old_command.signal,
+            "significant_stdout": old_command.significant_stdout,
+            "significant_stderr": old_command.significant_stderr,
+            "json_output": old_command.json_output,
+            "ordinal_number": old_command.ordinal_number,
+            "expected_outputs": outputs_by_command.get(command.id, []),
+        })
+
+    stages_by_test = {}
+    for stage in stages:
+        old_stage = resolve(cm.FileExerciseTestStage, stage)
+        if old_stage is None:
+            continue
+        stages_by_test.setdefault(stage.test_id, []).append({
+            "id": stage.id,
+            "name": old_stage.name,
+            "ordinal_number": old_stage.ordinal_number,
+            "depends_on": old_stage.depends_on_id,
+            "commands": commands_by_stage.get(stage.id, []),
+        })
+
+    test_files = {}
+    for test_id, file_id in required_files:
+        key = exercise_files.get(file_id)
+        if key is not None and plan["files"][key]["purpose"] in TEST_FILE_PURPOSES:
+            test_files.setdefault(test_id, []).append(key)
+    for test_id, file_id in required_instance_files:
+        key = instance_files.get(file_id)
+        if key is not None and plan["files"][key]["purpose"] in TEST_FILE_PURPOSES:
+            test_files.setdefault(test_id, []).append(key)
+
+    for test in tests:
+        old_test = resolve(cm.FileExerciseTest, test)
+        if old_test is None:
+            continue
+        plan["tests"].append({
+            "id": test.id,
+            "name": old_test.name,
+            "stages": stages_by_test.get(test.id, []),
+            "files": test_files.get(test.id, []),
+        })
+
+    return plan
+
+def get_test_plan(exercise_id, instance_id, revision=None):
+    """
+    Returns the test plan of an exercise for a course instance in the active
+    language from the process local cache, the Django cache or by building it,
+    in that order.
+    """
+    key = "test_plan_{exercise}_{revision}_{instance}_{lang}_{generation}".format(
+        exercise=exercise_id,
+        revision=revision,
+        instance=instance_id,
+        lang=translation.get_language(),
+        generation=evaluation_cache.get_exercise_generation(exercise_id),
+    )
+
+    with _local_plans_lock:
+        plan = _local_plans.get(key)
+        if plan is not None:
+            _local_plans.move_to_end(key)
+            return plan
+
+    plan = cache.get(key)
+    if plan is None:
+        plan = build_test_plan(exercise_id, instance_id, revision)
+        cache.set(key, plan, timeout=getattr(django_settings, "REDIS_LONG_EXPIRE", None))
+
+    with _local_plans_lock:
+        _local_plans[key] = plan
+        while len(_local_plans) > _LOCAL_PLAN_COUNT:
+            _local_plans.popitem(last=False)
+    return plan
+
+def get_plan_test(plan, test_id):
+    for test in plan["tests"]:
+        if test["id"] == test_id:
+            return test
+    raise KeyError(test_id)
+
+def read_plan_file(plan, key):
+    with open(plan["files"][key]["path"], "rb") as f:
+        return f.read()
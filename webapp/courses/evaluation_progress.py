@@ -0,0 +1,172 @@
+"""
+Progress reporting for file upload exercise evaluation tasks.
+
+The checking task publishes its progress and finally the id of the saved
+evaluation to a Redis pub/sub channel of its own. The latest message is also
+stored under a key, so that a client connecting late still gets the current
+state. Views deliver the messages to the browser either as server-sent events
+or by long-polling, instead of asking Celery for the task state over and over
+again.
+
+Messages are dictionaries with a running sequence number, the task state and
+the task's progress metadata. The final message has the state SUCCESS or
+FAILURE and, on success, the evaluation id. A task that was superseded by a
+newer answer before it started ends with the state SUPERSEDED.
+
+Whether checking workers are available is told by a heartbeat the workers
+write into the Django cache for each queue they consume, which is far cheaper
+than broadcasting an inspect request to every worker.
+"""
+
+import json
+import socket
+import threading
+import time
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+
+from courses import evaluation_store
+
+FINAL_STATES = ("SUCCESS", "FAILURE", "SUPERSEDED")
+
+HEARTBEAT_KEY = "checking_worker_heartbeat_{queue}"
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 30
+
+_heartbeat_thread = None
+
+
+def _redis():
+    return evaluation_store.get_connection()
+
+def _channel(task_id):
+    return "checking_progress_{}".format(task_id)
+
+def _latest_key(task_id):
+    return "checking_progress_latest_{}".format(task_id)
+
+def _seq_key(task_id):
+    return "checking_progress_seq_{}".format(task_id)
+
+def publish_progress(task_id, state, metadata=None, evaluation_id=None):
+    """
+    Publishes a progress message of the task and stores it as the latest one.
+    """
+    r = _redis()
+    seq = r.incr(_seq_key(task_id))
+    message = json.dumps({
+        "seq": seq,
+        "state": state,
+        "metadata": metadata,
+        "evaluation_id": evaluation_id,
+    })
+    expire = django_settings.REDIS_RESULT_EXPIRE
+    pipe = r.pipeline()
+    pipe.expire(_seq_key(task_id), expire)
+    pipe.set(_latest_key(task_id), message, ex=expire)
+    pipe.publish(_channel(task_id), message)
+    pipe.execute()
+
+def get_progress(task_id):
+    """
+    Returns the latest progress message of the task or None if the task
+    hasn't reported anything yet.
+    """
+    message = _redis().get(_latest_key(task_id))
+    if message is None:
+        return None
+    return json.loads(message.decode("utf-8"))
+
+def iter_progress(task_id, since=0, timeout=60):
+    """
+    Yields the progress messages of the task newer than the sequence number
+    since, as they are published, until the final message or until nothing
+    has been published for timeout seconds. Yields None every few seconds
+    while waiting, which can be used for keeping connections alive.
+    """
+    pubsub = _redis().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(_channel(task_id))
+    try:
+        # Subscribe before checking the latest message so that nothing
+        # published in between is missed
+        latest = get_progress(task_id)
+        if latest is not None and latest["seq"] > since:
+            since = latest["seq"]
+            yield latest
+            if latest["state"] in FINAL_STATES:
+                return
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            raw = pubsub.get_message(timeout=min(5, max(deadline - time.time(), 0)))
+            if raw is None:
+                yield None
+                continue
+            message = json.loads(raw["data"].decode("utf-8"))
+            if message["seq"] <= since:
+                continue
+            since = message["seq"]
+            deadline = time.time() + timeout
+            yield message
+            if message["state"] in FINAL_STATES:
+                return
+    finally:
+        pubsub.close()
+
+def wait_for_progress(task_id, since=0, timeout=10):
+    """
+    Waits for a progress message newer than the sequence number since and
+    returns it, or returns the latest message (None if there's none) after
+    timeout seconds. With a zero timeout, returns the latest message at once.
+    """
+    if timeout <= 0:
+        return get_progress(task_id)
+    for message in iter_progress(task_id, since, timeout):
+        if message is not None:
+            return message
+    return get_progress(task_id)
+
+def clear_progress(task_id):
+    _redis().delete(_latest_key(task_id), _seq_key(task_id))
+
+def write_heartbeat(hostname, queues):
+    heartbeat = {"hostname": hostname, "time": time.time()}
+    cache.set_many(
+        {HEARTBEAT_KEY.format(queue=queue): heartbeat for queue in queues}, timeout=HEARTBEAT_TIMEOUT
+    )
+
+def _beat(hostname, queues):
+    while True:
+        try:
+            write_heartbeat(hostname, queues)
+        except Exception as e:
+            print("Unable to write the worker heartbeat: {}".format(e))
+        time.sleep(HEARTBEAT_INTERVAL)
+
+def start_heartbeat(queues, hostname=None):
+    """
+    Starts writing the worker heartbeat for the queues the worker consumes in
+    a background thread of this process. Called when a Celery worker has
+    started.
+    """
+    global _heartbeat_thread
+    if _heartbeat_thread is None:
+        _heartbeat_thread = threading.Thread(
+            target=_beat, args=(hostname or socket.gethostname(), list(queues)), daemon=True
+        )
+        _heartbeat_thread.start()
+
+def get_worker_status(queue=None):
+    """
+    Tells whether any worker consuming the queue, by default CHECKING_QUEUE,
+    has written its heartbeat recently. Returns the heartbeat, or a
+    dictionary with an errors key if no worker is alive, like
+    get_celery_worker_status in courses.tasks.
+    """
+    if queue is None:
+        queue = getattr(django_settings, "CHECKING_QUEUE", "checking")
+    heartbeat = cache.get(HEARTBEAT_KEY.format(queue=queue))
+    if heartbeat is None:
+        return {"errors": "No running Celery workers were found."}
+    return heartbeat
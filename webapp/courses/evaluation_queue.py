@@ -0,0 +1,246 @@
+"""
+Scheduling of file upload exercise checking tasks.
+
+Checking tasks have a queue of their own, CHECKING_QUEUE, declared with
+message priorities. The priority of each task is chosen when the answer is
+sent for checking, from token buckets kept in Redis:
+
+- every course instance has a bucket that refills at
+  CHECKING_QUEUE_INSTANCE_RATE tasks per second up to
+  CHECKING_QUEUE_INSTANCE_BURST tasks
+- every user has a bucket that refills at CHECKING_QUEUE_USER_RATE up to
+  CHECKING_QUEUE_USER_BURST
+
+While both buckets have tokens the task gets the normal priority. Tasks over
+the instance's share go behind the tasks of other instances, and tasks of a
+user who keeps resubmitting go behind everyone else's. A course with a
+deadline rush is therefore mostly competing with itself, while the other
+courses' answers keep being checked quickly. Staff answers are checked first.
+
+The time each task waited in the queue is recorded and can be read with
+get_queue_wait_stats.
+
+Before that, answers pass admission control: each user has a token bucket per
+exercise that refills at CHECKING_SUBMISSION_RATE answers per second up to
+CHECKING_SUBMISSION_BURST, and answers sent with an empty bucket are rejected
+without being saved. An answer that is still waiting in the queue when the
+same user sends a newer answer to the same exercise is superseded: the task
+is marked so that it won't run, and its progress channel gets a final
+SUPERSEDED message.
+"""
+
+import json
+import math
+import time
+
+from django.conf import settings as django_settings
+
+from courses import evaluation_progress
+from courses import evaluation_store
+
+PRIORITY_STAFF = 9
+PRIORITY_NORMAL = 6
+PRIORITY_INSTANCE_OVER = 3
+PRIORITY_USER_OVER = 1
+
+QUEUE_WAIT_KEY = "checking_queue_wait"
+QUEUE_WAIT_SAMPLES = 1000
+
+# Takes a token from a bucket stored as a hash of the token count and the
+# time it was last refilled. Returns 1 if a token was available.
+_TAKE_TOKEN = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call("HMGET", KEYS[1], "tokens", "time")
+local tokens = tonumber(state[1]) or burst
+local last = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local taken = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    taken = 1
+end
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "time", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return taken
+"""
+
+
+class TokenBucket:
+    """
+    Token buckets of the given name, one per key, that refill at rate tokens
+    per second up to burst tokens. The buckets are shared by all processes
+    through the Redis result store.
+    """
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    def _key(self, key):
+        return "token_bucket_{}_{}".format(self.name, key)
+
+    def take(self, key):
+        """
+        Takes a token from the bucket of the key. Returns False if the bucket
+        is empty.
+        """
+        r = evaluation_store.get_connection()
+        taken = r.eval(_TAKE_TOKEN, 1, self._key(key), self.rate, self.burst, time.time())
+        return bool(taken)
+
+    def reset(self, key):
+        evaluation_store.get_connection().delete(self._key(key))
+
+
+def get_instance_bucket():
+    return TokenBucket(
+        "checking_instance",
+        getattr(django_settings, "CHECKING_QUEUE_INSTANCE_RATE", 1.0),
+        getattr(django_settings, "CHECKING_QUEUE_INSTANCE_BURST", 30),
+    )
+
+def get_user_bucket():
+    return TokenBucket(
+        "checking_user",
+        getattr(django_settings, "CHECKING_QUEUE_USER_RATE", 0.1),
+        getattr(django_settings, "CHECKING_QUEUE_USER_BURST", 5),
+    )
+
+def get_checking_priority(user, instance_id):
+    """
+    Returns the priority of a checking task sent by the user in the course
+    instance, taking a token from both of their buckets.
+    """
+    if user.is_staff:
+        return PRIORITY_STAFF
+    # Both buckets are charged, so that a user's resubmissions also count
+    # towards the share of their course
+    instance_ok = get_instance_bucket().take(instance_id)
+    user_ok = get_user_bucket().take(user.id)
+    if not user_ok:
+        return PRIORITY_USER_OVER
+    if not instance_ok:
+        return PRIORITY_INSTANCE_OVER
+    return PRIORITY_NORMAL
+
+def get_checking_options(user, instance_id):
+    """
+    Returns the apply_async options for sending a checking task.
+    """
+    return {
+        "queue": getattr(django_settings, "CHECKING_QUEUE", "checking"),
+        "priority": get_checking_priority(user, instance_id),
+    }
+
+def record_queue_wait(queued_at, priority=None):
+    """
+    Records how long a checking task waited in the queue, given the time it
+    was sent.
+    """
+    wait = max(time.time() - queued_at, 0)
+    sample = json.dumps({"wait": wait, "priority": priority, "time": time.time()})
+    pipe = evaluation_store.get_connection().pipeline(transaction=False)
+    pipe.lpush(QUEUE_WAIT_KEY, sample)
+    pipe.ltrim(QUEUE_WAIT_KEY, 0, QUEUE_WAIT_SAMPLES - 1)
+    pipe.execute()
+    print("Checking task waited {:.3f} s in the queue".format(wait))
+    return wait
+
+def _percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def get_queue_wait_stats():
+    """
+    Returns the number, mean, median, 95th percentile and maximum of the
+    queue wait times of the most recent checking tasks, overall and for each
+    priority.
+    """
+    samples = [json.loads(raw.decode("utf-8")) for raw in
+               evaluation_store.get_connection().lrange(QUEUE_WAIT_KEY, 0, -1)]
+
+    def summarize(waits):
+        if not waits:
+            return {"count": 0}
+        waits = sorted(waits)
+        return {
+            "count": len(waits),
+            "mean": sum(waits) / len(waits),
+            "p50": _percentile(waits, 0.5),
+            "p95": _percentile(waits, 0.95),
+            "max": waits[-1],
+        }
+
+    by_priority = {}
+    for sample in samples:
+        by_priority.setdefault(sample["priority"], []).append(sample["wait"])
+    stats = summarize([sample["wait"] for sample in samples])
+    stats["priorities"] = {priority: summarize(waits) for priority, waits in by_priority.items()}
+    return stats
+
+def get_submission_bucket():
+    return TokenBucket(
+        "submission",
+        getattr(django_settings, "CHECKING_SUBMISSION_RATE", 0.2),
+        getattr(django_settings, "CHECKING_SUBMISSION_BURST", 5),
+    )
+
+def admit_submission(user, exercise_id):
+    """
+    Tells whether the user may send an answer to the exercise now. Returns
+    None if the answer is admitted, otherwise the number of seconds after
+    which the user may try again. Staff are always admitted.
+    """
+    if user.is_staff or not getattr(django_settings, "CHECKING_SUBMISSION_LIMIT", True):
+        return None
+    bucket = get_submission_bucket()
+    if bucket.take("{}_{}".format(user.id, exercise_id)):
+        return None
+    return math.ceil(1 / bucket.rate)
+
+def _latest_task_key(user_id, exercise_id, instance_id):
+    return "checking_latest_task_{}_{}_{}".format(user_id, exercise_id, instance_id)
+
+def _claim_key(task_id):
+    return "checking_claim_{}".format(task_id)
+
+def supersede_previous(user_id, exercise_id, instance_id, task_id):
+    """
+    Registers task_id as the latest checking task of the user for the
+    exercise and supersedes the previous one if it hasn't started yet.
+    Returns the id of the superseded task or None.
+    """
+    r = evaluation_store.get_connection()
+    expire = getattr(django_settings, "REDIS_LONG_EXPIRE", None)
+    previous = r.getset(_latest_task_key(user_id, exercise_id, instance_id), task_id)
+    if expire:
+        r.expire(_latest_task_key(user_id, exercise_id, instance_id), expire)
+    if previous is None:
+        return None
+    previous = previous.decode("utf-8")
+    if previous == task_id:
+        return None
+
+    # Whichever comes first, the task starting or being superseded, wins
+    if not r.set(_claim_key(previous), "superseded", nx=True, ex=expire):
+        return None
+    evaluation_progress.publish_progress(previous, "SUPERSEDED")
+    print("Checking task {} was superseded by {}".format(previous, task_id))
+    return previous
+
+def claim_task(task_id):
+    """
+    Marks the checking task as started. Returns False if the task has been
+    superseded and must not run.
+    """
+    r = evaluation_store.get_connection()
+    expire = getattr(django_settings, "REDIS_LONG_EXPIRE", None)
+    if r.set(_claim_key(task_id), "started", nx=True, ex=expire):
+        return True
+    return not is_superseded(task_id)
+
+def is_superseded(task_id):
+    return evaluation_store.get_connection().get(_claim_key(task_id)) == b"superseded"
+
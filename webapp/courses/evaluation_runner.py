@@ -0,0 +1,277 @@
+"""
+Running the commands of file upload exercise tests, either in the checking
+worker itself or through a separate sandbox runner service.
+
+Starting a command with subprocess.Popen forks the whole Celery worker, which
+is slow for a process of Django's size, and the preexec_fn that sets up the
+sandbox in the child is not safe to use while other threads of the worker run
+tests concurrently. The runner service avoids both: it's a small process that
+doesn't load Django, listens on a Unix socket and pre-forks a number of
+runner processes that accept commands on the socket, one at a time. The runner
+processes can drop their privileges to the student user once at start, so
+they are already demoted when a command arrives.
+
+A command is described by a spec dictionary with the argument list, working
+directory, environment, standard input and limits of the command. execute
+runs a spec in the calling process and request sends it to the service. Both
+return the same results: the return value, signal, resource usage and the
+captured and possibly truncated output of the command.
+
+Start the service with e.g.
+
+    python -m courses.evaluation_runner --socket /run/lovelace/runner.sock --workers 4
+
+and point CHECKING_RUNNER_SOCKET at the socket.
+"""
+
+import argparse
+import base64
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import tempfile
+
+from courses import evaluation_sec as sec
+from courses.evaluation_utils import OutputCapture
+
+_HEADER = struct.Struct("!I")
+_MAX_MESSAGE = 64 * 1024 ** 2
+# Seconds added to the command timeout when waiting for the service to reply
+_REPLY_MARGIN = 30
+
+
+class RunnerError(Exception):
+    """
+    Raised when the runner service can't be reached or doesn't reply
+    properly.
+    """
+
+
+def execute(spec):
+    """
+    Runs the command described by spec in a sandbox and waits for it. The
+    spec has the keys:
+
+    args -- argument list of the command
+    cwd, env -- working directory and environment of the command
+    stdin -- the standard input as bytes
+    timeout -- seconds after which the command is terminated
+    limits -- dictionary with the keys cgroup_root, memory_max, pids_max and
+        cpu_max for the sandbox, max_output for the number of output bytes
+        kept of each stream and output_limit_kill for stopping the command
+        once it has written more
+    temp_dir -- directory for the standard input file
+
+    Returns the results as a dictionary and the captured stdout and stderr.
+    If the command couldn't be started, the results have an error key.
+    """
+    limits = spec["limits"]
+    sandbox = sec.create_sandbox(
+        cgroup_root=limits["cgroup_root"],
+        memory_max=limits["memory_max"],
+        pids_max=limits["pids_max"],
+        cpu_max=limits["cpu_max"],
+    )
+    demote_process = sec.get_demote_process_fun(sandbox=sandbox)
+
+    # The output is captured through pipes and cut at the byte limit, and
+    # optionally the process is stopped as soon as it writes too much
+    waiter = None
+    def output_limit_exceeded():
+        if limits["output_limit_kill"] and waiter is not None:
+            waiter.stop()
+    stdout = OutputCapture(limits["max_output"], output_limit_exceeded)
+    stderr = OutputCapture(limits["max_output"], output_limit_exceeded)
+
+    with tempfile.TemporaryFile(dir=spec.get("temp_dir")) as stdin:
+        stdin.write(spec["stdin"])
+        stdin.seek(0)
+        try:
+            proc = subprocess.Popen(
+                args=spec["args"], bufsize=-1, executable=None,
+                stdin=stdin, stdout=stdout, stderr=stderr, # Standard fds
+                preexec_fn=demote_process,                 # Demote before fork
+                close_fds=True,                            # Don't inherit fds
+                shell=False,                               # Don't run in shell
+                cwd=spec["cwd"], env=spec["env"],
+                universal_newlines=False                   # Binary stdout
+            )
+        except (FileNotFoundError, PermissionError) as e:
+            # In case the executable is not found or permission to run the
+            # file didn't exist.
+            sandbox.remove()
+            stdout.close()
+            stderr.close()
+            return {"error": str(e)}, b"", b""
+
+    # Wait for the process and collect the statistics on the resources
+    # consumed by the student's process. Everything the process leaves
+    # running is killed with the sandbox.
+    sandbox.started(proc.pid)
+    waiter = sec.ProcessWaiter(proc, spec["timeout"], kill=sandbox.kill)
+    stdout.start()
+    stderr.start()
+    try:
+        usage = waiter.wait()
+        oom_killed = sandbox.oom_killed()
+    finally:
+        sandbox.remove()
+        read_stdout = stdout.finish()
+        read_stderr = stderr.finish()
+
+    usage.update({
+        "oom_killed": oom_killed,
+        "stdout_truncated": stdout.truncated,
+        "stderr_truncated": stderr.truncated,
+    })
+    return usage, read_stdout, read_stderr
+
+def _send_message(sock, message):
+    data = json.dumps(message).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise RunnerError("Connection closed in the middle of a message")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def _recv_message(sock):
+    size, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    if size > _MAX_MESSAGE:
+        raise RunnerError("Message of {} bytes is too large".format(size))
+    return json.loads(_recv_exactly(sock, size).decode("utf-8"))
+
+def request(socket_path, spec):
+    """
+    Sends the spec to the runner service listening on socket_path and returns
+    the results like execute. Raises RunnerError if the service can't be
+    reached or fails to reply.
+    """
+    message = dict(spec, stdin=base64.b64encode(spec["stdin"]).decode("ascii"))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(spec["timeout"] + _REPLY_MARGIN)
+    try:
+        sock.connect(socket_path)
+        _send_message(sock, message)
+        reply = _recv_message(sock)
+    except (OSError, ValueError) as e:
+        raise RunnerError("Sandbox runner at {} failed: {}".format(socket_path, e))
+    finally:
+        sock.close()
+
+    if "runner_error" in reply:
+        raise RunnerError(reply["runner_error"])
+    return reply["results"], base64.b64decode(reply["stdout"]), base64.b64decode(reply["stderr"])
+
+def _handle(conn):
+    try:
+        spec = _recv_message(conn)
+        spec["stdin"] = base64.b64decode(spec["stdin"])
+        results, stdout, stderr = execute(spec)
+        reply = {
+            "results": results,
+            "stdout": base64.b64encode(stdout).decode("ascii"),
+            "stderr": base64.b64encode(stderr).decode("ascii"),
+        }
+    except Exception as e:
+        reply = {"runner_error": "{}: {}".format(type(e).__name__, e)}
+    _send_message(conn, reply)
+
+def _drop_privileges(uid, gid):
+    if gid is not None:
+        os.setgroups([])
+        os.setresgid(gid, gid, gid)
+    if uid is not None:
+        os.setresuid(uid, uid, uid)
+
+def _work(listener, uid, gid, max_requests):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    _drop_privileges(uid, gid)
+    for _ in range(max_requests):
+        conn, _ = listener.accept()
+        try:
+            _handle(conn)
+        except OSError as e:
+            print("Runner {} lost a connection: {}".format(os.getpid(), e))
+        finally:
+            conn.close()
+
+def serve(socket_path, workers=4, uid=None, gid=None, max_requests=1000):
+    """
+    Listens on socket_path and keeps workers runner processes accepting
+    commands on it. Each runner process is replaced after max_requests
+    commands. Runs until terminated with SIGTERM or SIGINT.
+    """
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    # The checking workers connect as the group of the service
+    os.chmod(socket_path, 0o660)
+    listener.listen(128)
+
+    children = set()
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                _work(listener, uid, gid, max_requests)
+            except BaseException as e:
+                print("Runner {} failed: {}".format(os.getpid(), e))
+                status = 1
+            finally:
+                os._exit(status)
+        children.add(pid)
+
+    print("Sandbox runner listening on {} with {} workers".format(socket_path, workers))
+    try:
+        for _ in range(workers):
+            spawn()
+        while children:
+            try:
+                pid, _ = os.wait()
+            except InterruptedError:
+                continue
+            except ChildProcessError:
+                break
+            children.discard(pid)
+            if not stopping:
+                spawn()
+    finally:
+        listener.close()
+        os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", required=True, help="path of the Unix socket to listen on")
+    parser.add_argument("--workers", type=int, default=4, help="number of pre-forked runner processes")
+    parser.add_argument("--uid", type=int, default=None, help="user id the runner processes run as")
+    parser.add_argument("--gid", type=int, default=None, help="group id the runner processes run as")
+    parser.add_argument("--max-requests", type=int, default=1000,
+                        help="commands a runner process runs before it's replaced")
+    args = parser.parse_args()
+    serve(args.socket, args.workers, args.uid, args.gid, args.max_requests)
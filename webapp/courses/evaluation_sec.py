@@ -9,27 +9,43 @@ safe environment to run unsafe code in.
 import os
 import signal
 import resource
+import tempfile
+import threading
+import time
 
-from signal import SIGKILL, SIGSTOP
+from signal import SIGKILL, SIGSTOP, SIGTERM
 
 _CONCURRENT_PROCESSES = 40
 _NUMBER_OF_FILES = 100
 _FILE_SIZE = 4 * (1024 ** 2)  # 4 MiB
 _CPU_TIME = 20
+_GRACE_PERIOD = 0.5
+_MEMORY_MAX = 512 * (1024 ** 2)  # 512 MiB
+_CPU_MAX = "100000 100000"  # One CPU
 
 def get_demote_process_fun(concurrent_processes=_CONCURRENT_PROCESSES,
                            number_of_files=_NUMBER_OF_FILES,
                            file_size=_FILE_SIZE,
-                           cpu_time=_CPU_TIME):
+                           cpu_time=_CPU_TIME,
+                           sandbox=None):
     """
     Creates and returns a function that demotes the process based on given
     arguments. Allows setting of custom limits based on, e.g., database values. 
+
+    If a sandbox is given, the process enters it before anything else. A
+    sandbox that limits the number of processes replaces the per-user
+    RLIMIT_NPROC, which would be shared by all the concurrently running tests.
     """
+    if sandbox is not None and sandbox.limits_processes:
+        concurrent_processes = None
+
     def demote_process():
         """
         Execute a number of security measures to limit the possible scope of harm
         available for the spawned processes to exploit.
         """
+        if sandbox is not None:
+            sandbox.enter()
         #close_fds()
         #drop_privileges()
         limit_resources(concurrent_processes=concurrent_processes,
@@ -89,7 +105,8 @@ def limit_resources(concurrent_processes=_CONCURRENT_PROCESSES,
     """
     # Prevent the scope of fork bombs by limiting the total number of concurrent
     # processes
-    resource.setrlimit(resource.RLIMIT_NPROC, (concurrent_processes, concurrent_processes))
+    if concurrent_processes is not None:
+        resource.setrlimit(resource.RLIMIT_NPROC, (concurrent_processes, concurrent_processes))
 
     # Prevent filling up memory and file system by limiting the total number of
     # allowed files that the process is allowed to create
@@ -113,9 +130,11 @@ def secure_kill(pid):
     whack-a-mole. By using SIGSTOP first to freeze the forking processes and
     KILLing them after that, the fork bomb clean up should be more reliable.
 
-    The 'killall' command alone doesn't solve the problem, since the operation
-    of killing all the processes is not atomic, i.e., single processes are
-    signalled one by one by iterating over a list of them.
+    The processes are signalled as a process group, the one led by the
+    process with the given pid. Tested programs are started in a session of
+    their own, so this only reaches the processes of one test run instead of
+    every process of the student user on the host. Processes that have left
+    the process group can only be reached with a cgroup, see CgroupSandbox.
 
     Neither SIGKILL nor SIGSTOP can be captured or blocked by any process.
 
@@ -124,15 +143,267 @@ def secure_kill(pid):
 
     [1] https://linux.die.net/man/3/kill
     """
-    # DEBUG
-    user = "student"
-    timeout = 5
+    try:
+        os.killpg(pid, SIGSTOP)
+        os.killpg(pid, SIGKILL)
+    except ProcessLookupError:
+        # The whole process group has already exited
+        pass
+
+
+class ProcessGroupSandbox:
+    """
+    Fallback sandbox used when cgroups are not available. The tested program
+    runs in a session and process group of its own, and the per-process
+    resource limits of limit_resources apply.
+    """
+
+    limits_processes = False
+
+    def __init__(self):
+        self.pid = None
+
+    def enter(self):
+        os.setsid()
+
+    def started(self, pid):
+        self.pid = pid
+
+    def kill(self):
+        if self.pid is not None:
+            secure_kill(self.pid)
+
+    def oom_killed(self):
+        return False
+
+    def remove(self):
+        pass
+
+
+class CgroupSandbox:
+    """
+    Runs the tested program in a cgroup (v2) of its own with limits for
+    memory, the number of processes and CPU bandwidth. All processes of the
+    test run stay in the cgroup regardless of how they fork or daemonize, and
+    they are killed together with a single write to cgroup.kill, or by
+    freezing the cgroup before killing its processes on kernels that don't
+    have cgroup.kill.
+    """
+
+    limits_processes = True
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def create(cls, root, memory_max, pids_max, cpu_max):
+        path = tempfile.mkdtemp(prefix="run-", dir=root)
+        sandbox = cls(path)
+        try:
+            sandbox._write("memory.max", memory_max)
+            try:
+                sandbox._write("memory.swap.max", 0)
+            except FileNotFoundError:
+                # Swap accounting is off, so there is no swap to limit
+                pass
+            sandbox._write("pids.max", pids_max)
+            sandbox._write("cpu.max", cpu_max)
+        except OSError:
+            os.rmdir(path)
+            raise
+        return sandbox
+
+    def _write(self, name, value):
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write(str(value))
+
+    def _read(self, name):
+        with open(os.path.join(self.path, name)) as f:
+            return f.read()
+
+    def _populated(self):
+        for line in self._read("cgroup.events").splitlines():
+            key, value = line.split()
+            if key == "populated":
+                return value == "1"
+        return False
+
+    def enter(self):
+        # Called in the forked child: "0" moves the writing process itself
+        self._write("cgroup.procs", 0)
+
+    def started(self, pid):
+        pass
+
+    def kill(self):
+        try:
+            self._write("cgroup.kill", 1)
+            return
+        except FileNotFoundError:
+            pass
+        self._write("cgroup.freeze", 1)
+        for pid in self._read("cgroup.procs").split():
+            try:
+                os.kill(int(pid), SIGKILL)
+            except ProcessLookupError:
+                pass
+        self._write("cgroup.freeze", 0)
+
+    def oom_killed(self):
+        try:
+            for line in self._read("memory.events").splitlines():
+                key, value = line.split()
+                if key == "oom_kill":
+                    return int(value) > 0
+        except OSError:
+            pass
+        return False
+
+    def remove(self, timeout=1.0):
+        """
+        Kill whatever is left in the cgroup and remove it. A cgroup can only
+        be removed once its processes are gone.
+        """
+        try:
+            if self._populated():
+                self.kill()
+            deadline = time.time() + timeout
+            while self._populated() and time.time() < deadline:
+                time.sleep(0.01)
+            os.rmdir(self.path)
+        except OSError as e:
+            print("Unable to remove cgroup {}: {}".format(self.path, e))
+
+
+_cgroup_roots = {}
+
+def cgroups_available(root):
+    """
+    Checks once per process whether test run cgroups can be created under the
+    given root. The root must be a cgroup v2 directory delegated to the user
+    running the checking worker, and it must not contain any processes itself,
+    so that the memory, pids and cpu controllers can be enabled for its
+    children.
+    """
+    if root not in _cgroup_roots:
+        try:
+            with open(os.path.join(root, "cgroup.subtree_control"), "w") as f:
+                f.write("+memory +pids +cpu")
+            available = True
+        except OSError as e:
+            print("Cgroups unavailable under {}, using rlimits only: {}".format(root, e))
+            available = False
+        _cgroup_roots[root] = available
+    return _cgroup_roots[root]
 
-    kill_age = timeout + 5
+def create_sandbox(cgroup_root=None, memory_max=_MEMORY_MAX, pids_max=_CONCURRENT_PROCESSES,
+                   cpu_max=_CPU_MAX):
+    """
+    Creates the sandbox for one command run: a cgroup under cgroup_root if
+    one is given and cgroups are available there, otherwise a process group
+    with the rlimits of limit_resources.
+    """
+    if cgroup_root and cgroups_available(cgroup_root):
+        try:
+            return CgroupSandbox.create(cgroup_root, memory_max, pids_max, cpu_max)
+        except OSError as e:
+            print("Unable to create a cgroup under {}, using rlimits only: {}".format(cgroup_root, e))
+    return ProcessGroupSandbox()
 
-    # Iterate through the processes and issue SIGSTOP
-    os.system("killall -STOP --verbose --user {user} --younger-than {kill_age}s".format(user=user, kill_age=kill_age))
+class ProcessWaiter:
+    """
+    Waits for a process to exit and reaps it with wait4. Unlike the difference
+    of two getrusage(RUSAGE_CHILDREN) calls, the resource usage returned by
+    wait4 only covers the process itself and the children it has waited for,
+    which keeps the accounting exact when several commands run concurrently
+    in the same worker.
+
+    The process is sent SIGTERM after timeout seconds and SIGKILL if it's still
+    running grace_period seconds later. If a kill function is given, it's
+    called instead of sending SIGKILL to the process alone, e.g. to kill the
+    whole sandbox of the process, and once more after the process has exited
+    to clean up anything it left running. The process is only waited for with
+    WNOWAIT until it has exited, so that neither it nor its process group is
+    signalled after its pid has been released for reuse.
 
-    # Iterate through the processes again and issue SIGKILL
-    os.system("killall -KILL --verbose --user {user} --younger-than {kill_age}s".format(user=user, kill_age=kill_age))
-    
+    Other threads can stop the process early with stop, e.g. when it has
+    written more output than is allowed.
+    """
+
+    def __init__(self, proc, timeout, grace_period=_GRACE_PERIOD, kill=None):
+        self.proc = proc
+        self.timeout = timeout
+        self.grace_period = grace_period
+        self.kill = kill
+        self._lock = threading.Lock()
+        self._state = {"exited": False, "timedout": False, "killed": False, "stopped": False}
+
+    def _send_signal(self, sig, flag):
+        with self._lock:
+            if not self._state["exited"]:
+                self._state[flag] = True
+                if sig == SIGKILL and self.kill is not None:
+                    self.kill()
+                else:
+                    os.kill(self.proc.pid, sig)
+
+    def stop(self):
+        self._send_signal(SIGKILL, "stopped")
+
+    def wait(self):
+        """
+        Returns a dictionary with the return code (negative signal number if
+        the process was ended by a signal, like subprocess uses), the name of
+        the signal that ended the process, wall time, user and system CPU
+        time, peak resident set size in kilobytes and whether the process
+        timed out, had to be killed or was stopped.
+        """
+        pid = self.proc.pid
+        timers = [
+            threading.Timer(self.timeout, self._send_signal, (SIGTERM, "timedout")),
+            threading.Timer(self.timeout + self.grace_period, self._send_signal, (SIGKILL, "killed")),
+        ]
+        start_time = time.time()
+        for timer in timers:
+            timer.daemon = True
+            timer.start()
+        try:
+            os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+            with self._lock:
+                self._state["exited"] = True
+        finally:
+            for timer in timers:
+                timer.cancel()
+        runtime = time.time() - start_time
+
+        if self.kill is not None:
+            self.kill()
+
+        _, status, rusage = os.wait4(pid, 0)
+        if os.WIFSIGNALED(status):
+            exit_signal = signal.Signals(os.WTERMSIG(status)).name
+            returncode = -os.WTERMSIG(status)
+        else:
+            exit_signal = None
+            returncode = os.WEXITSTATUS(status)
+
+        # The process has been reaped, Popen mustn't try to wait for it anymore
+        self.proc.returncode = returncode
+
+        return {
+            "returncode": returncode,
+            "exit_signal": exit_signal,
+            "runtime": runtime,
+            "usermodetime": rusage.ru_utime,
+            "kernelmodetime": rusage.ru_stime,
+            "max_rss": rusage.ru_maxrss,
+            "timedout": self._state["timedout"],
+            "killed": self._state["killed"],
+            "stopped": self._state["stopped"],
+        }
+
+def wait_for_process(proc, timeout, grace_period=_GRACE_PERIOD, kill=None):
+    """
+    Waits for the process with a ProcessWaiter and returns its results.
+    """
+    return ProcessWaiter(proc, timeout, grace_period, kill).wait()
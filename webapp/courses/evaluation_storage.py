@@ -0,0 +1,196 @@
+"""
+Compact storage of the test results of file upload exercise evaluations.
+
+The test results of an evaluation contain the complete stdout and stderr of
+every command run for both the student's answer and the reference, which used
+to make Evaluation.test_results by far the largest column of the database.
+With CHECKING_COMPACT_RESULTS the results are stored in
+Evaluation.packed_results instead:
+
+- outputs longer than CHECKING_STORED_OUTPUT_MAX_BYTES are cut
+- outputs longer than CHECKING_STORED_OUTPUT_INLINE_BYTES are moved to
+  EvaluationOutput rows keyed by the SHA-256 of the output, so that outputs
+  that are the same in many evaluations (e.g. those of the reference) are
+  stored only once, and replaced with {"$output": digest}
+- the rest of the results is stored as zlib compressed JSON
+
+The outputs are loaded only when the results are needed with them, in one
+query. Evaluations stored before are read from test_results as they were and
+can be converted with compact_evaluations.py, which also deletes the outputs
+no evaluation refers to anymore.
+"""
+
+import datetime
+import hashlib
+import json
+import zlib
+
+from django.conf import settings as django_settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from courses import models as cm
+
+OUTPUT_KEYS = ("stdout", "stderr")
+OUTPUT_REF = "$output"
+OUTPUT_CAPPED_MARKER = "\n[Stored output cut after {} bytes]"
+OUTPUT_MISSING_MARKER = "[Stored output {} is missing]"
+
+
+def _iter_commands(results):
+    for side in ("student", "reference"):
+        for test in results.get(side, {}).values():
+            for stage in test.get("stages", {}).values():
+                yield from stage.get("commands", {}).values()
+
+def _iter_output_refs(results):
+    for command in _iter_commands(results):
+        for key in OUTPUT_KEYS:
+            value = command.get(key)
+            if isinstance(value, dict) and OUTPUT_REF in value:
+                yield command, key, value[OUTPUT_REF]
+
+def _cap_output(text, max_bytes):
+    data = text.encode("utf-8")
+    if len(data) <= max_bytes:
+        return text
+    return data[:max_bytes].decode("utf-8", errors="ignore") + OUTPUT_CAPPED_MARKER.format(max_bytes)
+
+def pack_results(results, inline_bytes=512, max_bytes=64 * 1024):
+    """
+    Packs test results for storage. Returns the compressed results and a
+    dictionary of the digests of the moved out outputs mapped to the
+    compressed outputs. The given results are not modified.
+    """
+    packed = json.loads(json.dumps(results))
+    outputs = {}
+    for command in _iter_commands(packed):
+        for key in OUTPUT_KEYS:
+            text = command.get(key)
+            if not isinstance(text, str):
+                continue
+            text = _cap_output(text, max_bytes)
+            data = text.encode("utf-8")
+            if len(data) <= inline_bytes:
+                command[key] = text
+                continue
+            digest = hashlib.sha256(data).hexdigest()
+            outputs.setdefault(digest, zlib.compress(data))
+            command[key] = {OUTPUT_REF: digest}
+    return zlib.compress(json.dumps(packed).encode("utf-8")), outputs
+
+def _save_outputs(outputs):
+    # Reused outputs are marked used before the evaluation referring to them
+    # is saved, which keeps delete_orphaned_outputs from deleting them. An
+    # output deleted before it was marked is not found below and saved again.
+    cm.EvaluationOutput.objects.filter(digest__in=list(outputs.keys())).update(last_used=timezone.now())
+    existing = set(cm.EvaluationOutput.objects.filter(
+        digest__in=list(outputs.keys())
+    ).values_list("digest", flat=True))
+    new_outputs = [
+        cm.EvaluationOutput(digest=digest, data=data)
+        for digest, data in outputs.items() if digest not in existing
+    ]
+    if not new_outputs:
+        return
+    try:
+        with transaction.atomic():
+            cm.EvaluationOutput.objects.bulk_create(new_outputs)
+    except IntegrityError:
+        # Another worker stored some of the same outputs at the same time
+        for output in new_outputs:
+            cm.EvaluationOutput.objects.get_or_create(digest=output.digest, defaults={"data": output.data})
+
+def store_results(evaluation, results):
+    """
+    Sets the test results of an unsaved evaluation, packed if
+    CHECKING_COMPACT_RESULTS is set. The outputs are saved right away.
+    """
+    if not getattr(django_settings, "CHECKING_COMPACT_RESULTS", True):
+        evaluation.test_results = json.dumps(results)
+        return
+
+    packed, outputs = pack_results(
+        results,
+        inline_bytes=getattr(django_settings, "CHECKING_STORED_OUTPUT_INLINE_BYTES", 512),
+        max_bytes=getattr(django_settings, "CHECKING_STORED_OUTPUT_MAX_BYTES", 64 * 1024),
+    )
+    _save_outputs(outputs)
+    evaluation.packed_results = packed
+    evaluation.test_results = ""
+
+def copy_results(source, target):
+    """
+    Gives the target evaluation the stored test results of the source. The
+    outputs are shared.
+    """
+    target.test_results = source.test_results
+    target.packed_results = source.packed_results
+
+def load_results(evaluation, outputs=True):
+    """
+    Returns the test results of an evaluation, or None if it has none. Without
+    outputs, moved out outputs are left as {"$output": digest}, which saves
+    loading them when only e.g. the return values are needed. Outputs that
+    are missing from the database are replaced with OUTPUT_MISSING_MARKER.
+    """
+    if evaluation.packed_results:
+        results = json.loads(zlib.decompress(bytes(evaluation.packed_results)).decode("utf-8"))
+    elif evaluation.test_results:
+        return json.loads(evaluation.test_results)
+    else:
+        return None
+
+    if not outputs:
+        return results
+
+    refs = list(_iter_output_refs(results))
+    if refs:
+        stored = dict(cm.EvaluationOutput.objects.filter(
+            digest__in={digest for command, key, digest in refs}
+        ).values_list("digest", "data"))
+        missing = set()
+        for command, key, digest in refs:
+            data = stored.get(digest)
+            if data is None:
+                missing.add(digest)
+                command[key] = OUTPUT_MISSING_MARKER.format(digest)
+            else:
+                command[key] = zlib.decompress(bytes(data)).decode("utf-8")
+        if missing:
+            print("Evaluation {} refers to missing outputs {}".format(evaluation.id, ", ".join(sorted(missing))))
+    return results
+
+def delete_orphaned_outputs(grace=datetime.timedelta(days=1), batch_size=500):
+    """
+    Deletes the outputs no stored evaluation refers to and returns how many
+    were deleted. Outputs used within grace are kept even if no evaluation
+    refers to them yet, since the outputs of an evaluation are saved before
+    the evaluation is.
+    """
+    cutoff = timezone.now() - grace
+    orphans = set(cm.EvaluationOutput.objects.filter(last_used__lt=cutoff).values_list("digest", flat=True))
+    last_id = 0
+    while orphans:
+        batch = list(cm.Evaluation.objects.filter(
+            id__gt=last_id
+        ).order_by("id").values_list("id", "packed_results")[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        for evaluation_id, packed in batch:
+            if packed:
+                results = json.loads(zlib.decompress(bytes(packed)).decode("utf-8"))
+                orphans.difference_update(digest for command, key, digest in _iter_output_refs(results))
+
+    deleted = 0
+    orphans = sorted(orphans)
+    for i in range(0, len(orphans), batch_size):
+        # Outputs used since the scan started have been marked used. Locking
+        # the rest makes _save_outputs wait and save them again if needed.
+        with transaction.atomic():
+            digests = list(cm.EvaluationOutput.objects.select_for_update().filter(
+                digest__in=orphans[i:i + batch_size], last_used__lt=cutoff
+            ).values_list("digest", flat=True))
+            deleted += cm.EvaluationOutput.objects.filter(digest__in=digests).delete()[0]
+    return deleted
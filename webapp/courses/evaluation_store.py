@@ -0,0 +1,98 @@
+"""
+Access to the Redis result store shared by the checking workers and the web
+server processes.
+
+All connections to the result store come from one connection pool per
+process, configured with REDIS_RESULT_CONFIG and REDIS_RESULT_POOL. This saves
+the TCP connection setup of every checking task and evaluation request and
+keeps the number of open file descriptors steady. The pool is created on first
+use, and redis-py replaces it in forked processes by itself, so Celery worker
+processes don't share connections with their parent.
+
+Results are written with their expiry in a single pipelined round trip and
+read and deleted in one transaction. The operation counts of the process are
+collected along with the pool state and can be read with get_metrics.
+"""
+
+import threading
+
+import redis
+
+from django.conf import settings as django_settings
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_metrics = {"sets": 0, "gets": 0, "hits": 0, "misses": 0}
+_metrics_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            options = dict(django_settings.REDIS_RESULT_CONFIG)
+            options.update(getattr(django_settings, "REDIS_RESULT_POOL", {}))
+            _pool = redis.ConnectionPool(**options)
+        return _pool
+
+def get_connection():
+    """
+    Returns a client of the result store that uses the shared pool.
+    """
+    return redis.StrictRedis(connection_pool=get_pool())
+
+def _count(**counts):
+    with _metrics_lock:
+        for name, count in counts.items():
+            _metrics[name] += count
+
+def set_results(results, expire=None):
+    """
+    Stores the given key, value pairs with an expiry of expire seconds
+    (REDIS_RESULT_EXPIRE by default) in one round trip.
+    """
+    if expire is None:
+        expire = django_settings.REDIS_RESULT_EXPIRE
+    pipe = get_connection().pipeline(transaction=False)
+    for key, value in results.items():
+        pipe.set(key, value, ex=expire)
+    pipe.execute()
+    _count(sets=len(results))
+
+def set_result(key, value, expire=None):
+    set_results({key: value}, expire)
+
+def pop_result(key):
+    """
+    Returns the value stored under the key and deletes it atomically. Returns
+    None if there's no such key, e.g. because the result has expired or has
+    already been read.
+    """
+    pipe = get_connection().pipeline(transaction=True)
+    pipe.get(key)
+    pipe.delete(key)
+    value, _ = pipe.execute()
+    if value is None:
+        _count(gets=1, misses=1)
+    else:
+        _count(gets=1, hits=1)
+    return value
+
+def get_metrics():
+    """
+    Returns the operation counts of this process and the state of its
+    connection pool.
+    """
+    with _metrics_lock:
+        metrics = dict(_metrics)
+    pool = _pool
+    if pool is not None:
+        available = len(pool._available_connections)
+        in_use = len(pool._in_use_connections)
+        metrics.update({
+            "connections": available + in_use,
+            "connections_in_use": in_use,
+            "max_connections": pool.max_connections,
+        })
+    return metrics
@@ -0,0 +1,168 @@
+"""
+Per-phase timing of file upload exercise checking tasks.
+
+Every run_tests invocation measures how long it spends in each phase:
+
+lookup -- fetching the exercise, user and answer from the database
+files -- reading the returned files
+plan -- getting the test plan and the cached reference results
+tests -- running all the tests, of which
+    setup -- preparing the workspaces and writing the files under test
+    execution -- running the commands (wall time, summed over all commands)
+results -- comparing the outputs and generating the diffs
+serialize -- encoding the results as JSON
+store -- storing the rendered results in Redis
+save -- saving the evaluation into the database
+
+The timings are saved with the Evaluation (except save, which isn't known
+before the evaluation is saved) and added to per-exercise histograms in the
+Redis result store. The histograms are shown on the statistics page of the
+exercise and on the checking timings page for staff.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from courses import evaluation_store
+
+PHASES = ("lookup", "files", "plan", "tests", "setup", "execution", "results", "serialize", "store", "save")
+
+# Upper bounds of the histogram buckets in seconds
+HISTOGRAM_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_EXERCISES_KEY = "checking_timing_exercises"
+
+
+class PhaseTimer:
+    """
+    Accumulates the time spent in named phases. A phase can be entered
+    several times, and threads may add to the same timer.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def as_dict(self):
+        with self._lock:
+            return {name: round(seconds, 6) for name, seconds in self.timings.items()}
+
+    def total(self):
+        """
+        Total time of the top level phases, i.e. not counting setup and
+        execution twice.
+        """
+        with self._lock:
+            return sum(seconds for name, seconds in self.timings.items() if name not in ("setup", "execution"))
+
+
+def sum_test_times(test_results):
+    """
+    Returns the total setup time and command run time in test results given
+    as a dictionary of test ids mapped to the results of the test.
+    """
+    setup = 0
+    execution = 0
+    for test in test_results.values():
+        setup += test.get("setup_time") or 0
+        for stage in test["stages"].values():
+            for command in stage["commands"].values():
+                execution += command.get("runtime") or 0
+    return setup, execution
+
+def _histogram_key(exercise_id):
+    return "checking_timing_{}".format(exercise_id)
+
+def _bucket_name(seconds):
+    for bound in HISTOGRAM_BUCKETS:
+        if seconds <= bound:
+            return str(bound)
+    return "+Inf"
+
+def record_timings(exercise_id, timings):
+    """
+    Adds the phase timings of one checking task to the histograms of the
+    exercise.
+    """
+    key = _histogram_key(exercise_id)
+    pipe = evaluation_store.get_connection().pipeline(transaction=False)
+    for name, seconds in timings.items():
+        pipe.hincrby(key, "{}:{}".format(name, _bucket_name(seconds)), 1)
+        pipe.hincrby(key, "{}:count".format(name), 1)
+        pipe.hincrbyfloat(key, "{}:sum".format(name), seconds)
+    pipe.sadd(_EXERCISES_KEY, exercise_id)
+    pipe.execute()
+
+def _estimate_quantile(buckets, count, fraction):
+    """
+    Estimates a quantile as the upper bound of the bucket it falls in.
+    """
+    target = count * fraction
+    seen = 0
+    for bound, bucket_count in buckets:
+        seen += bucket_count
+        if seen >= target:
+            return bound
+    return buckets[-1][0]
+
+def get_timing_histograms(exercise_id):
+    """
+    Returns the histograms of the exercise as a list of dictionaries, one per
+    phase in the order of PHASES, with the count, total and mean time, the
+    bucket counts and the estimated median and 95th percentile.
+    """
+    raw = evaluation_store.get_connection().hgetall(_histogram_key(exercise_id))
+    fields = {name.decode("utf-8"): value.decode("utf-8") for name, value in raw.items()}
+
+    histograms = []
+    for phase in PHASES:
+        count = int(fields.get("{}:count".format(phase), 0))
+        if not count:
+            continue
+        total = float(fields.get("{}:sum".format(phase), 0))
+        buckets = [
+            (bound, int(fields.get("{}:{}".format(phase, bound), 0)))
+            for bound in [str(bound) for bound in HISTOGRAM_BUCKETS] + ["+Inf"]
+        ]
+        histograms.append({
+            "phase": phase,
+            "count": count,
+            "sum": total,
+            "mean": total / count,
+            "buckets": buckets,
+            "p50": _estimate_quantile(buckets, count, 0.5),
+            "p95": _estimate_quantile(buckets, count, 0.95),
+        })
+    return histograms
+
+def get_timed_exercise_ids():
+    return sorted(int(exercise_id) for exercise_id in evaluation_store.get_connection().smembers(_EXERCISES_KEY))
+
+def reset_timings(exercise_id):
+    pipe = evaluation_store.get_connection().pipeline(transaction=False)
+    pipe.delete(_histogram_key(exercise_id))
+    pipe.srem(_EXERCISES_KEY, exercise_id)
+    pipe.execute()
+
+def parse_timings(evaluation):
+    """
+    Returns the phase timings saved with an evaluation, or an empty
+    dictionary for evaluations made before timings were recorded.
+    """
+    if not evaluation.timings:
+        return {}
+    return json.loads(evaluation.timings)
@@ -2,6 +2,12 @@
 Miscellaneous utility functions for file upload exercise evaluation tasks.
 """
 
+import os
+import selectors
+import threading
+
+_READ_SIZE = 65536
+
 def cp437_decoder(input_bytes):
     """
     Reference:
@@ -23,3 +29,94 @@ def cp437_decoder(input_bytes):
     CRLF = b'\x0d\x0a'
     return "\n".join(byt_ln.decode('ibm437').translate(tr_table)
                      for byt_ln in input_bytes.split(CRLF))
+
+def decode_output(output_bytes, truncated=False):
+    """
+    Decodes the output of a command as UTF-8, falling back to code page 437
+    for binary output. Returns the decoded string and whether the output was
+    binary. If the output was truncated, an incomplete UTF-8 sequence at the
+    end is left out rather than making the whole output binary.
+    """
+    try:
+        return output_bytes.decode("utf-8"), False
+    except UnicodeDecodeError as e:
+        if truncated and e.start >= len(output_bytes) - 3:
+            try:
+                return output_bytes[:e.start].decode("utf-8"), False
+            except UnicodeDecodeError:
+                pass
+    return cp437_decoder(output_bytes), True
+
+
+class OutputCapture:
+    """
+    Captures an output stream of a command through a pipe. The pipe is read
+    in a thread of its own while the command runs, keeping at most max_bytes
+    of the output. The rest is read and thrown away so that the command
+    doesn't block on a full pipe. If on_limit is given, it's called once when
+    the limit is exceeded, e.g. to stop the command early.
+
+    Pass the capture as stdout or stderr to Popen, then call start right
+    after starting the process and finish after the process has exited.
+    """
+
+    def __init__(self, max_bytes, on_limit=None):
+        self.max_bytes = max_bytes
+        self.on_limit = on_limit
+        self.truncated = False
+        self._chunks = []
+        self._size = 0
+        self._abandon = threading.Event()
+        self._read_fd, self._write_fd = os.pipe()
+        self._thread = threading.Thread(target=self._read, daemon=True)
+
+    def fileno(self):
+        return self._write_fd
+
+    def start(self):
+        # The child has its own copy of the write end, the pipe reaches EOF
+        # once every process of the command has closed it
+        os.close(self._write_fd)
+        self._write_fd = None
+        self._thread.start()
+
+    def _read(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._read_fd, selectors.EVENT_READ)
+            while not self._abandon.is_set():
+                if not selector.select(timeout=0.1):
+                    continue
+                chunk = os.read(self._read_fd, _READ_SIZE)
+                if not chunk:
+                    break
+                room = self.max_bytes - self._size
+                if len(chunk) > room:
+                    chunk = chunk[:max(room, 0)]
+                    if not self.truncated:
+                        self.truncated = True
+                        if self.on_limit is not None:
+                            self.on_limit()
+                if chunk:
+                    self._chunks.append(chunk)
+                    self._size += len(chunk)
+        os.close(self._read_fd)
+
+    def finish(self, timeout=1.0):
+        """
+        Waits until the whole output has been read and returns it. Output
+        still held open by processes that escaped killing is not waited for
+        longer than timeout seconds.
+        """
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print("Output pipe still open after the command exited, abandoning it")
+            self._abandon.set()
+            self._thread.join()
+        return b"".join(self._chunks)
+
+    def close(self):
+        """
+        Closes the pipe of a capture that was never started.
+        """
+        os.close(self._write_fd)
+        os.close(self._read_fd)
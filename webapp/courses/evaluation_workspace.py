@@ -0,0 +1,376 @@
+"""
+Workspaces for running the tests of file upload exercises.
+
+A workspace is a directory under CHECKING_WORKSPACE_ROOT holding the include
+files a test requires, with the access mode and ownership from their
+IncludeFileSettings applied. The directory is given to CHECKING_STUDENT_UID
+and CHECKING_STUDENT_GID when they are set, so that the tested programs can
+work in it when they run as the student user.
+
+Setting up a workspace for every run is a noticeable part of the run time of
+short tests, so each worker process keeps a pool of ready workspaces for the
+tests it has recently run. When a run takes a workspace from the pool, a
+replacement is prepared in the background and the run only has to write the
+files under test.
+
+Workspaces are never reused: the tested program is free to modify them, so
+they are removed after the run.
+
+Tests of compiled languages tend to start with the same stage, e.g. compiling
+the returned sources. A StageCache remembers, for the duration of checking one
+submission, the results of such stages and the files they created or changed
+in the workspace. Only stages that a later stage of the test depends on are
+cached: those prepare the workspace for the rest of the test, while other
+stages typically run the tested program, whose results are not safe to reuse.
+The cache key covers the stage's commands and the contents of the workspace
+before the stage, which includes whatever the earlier stages left there. A
+stage with the same key in a later test is not run again: its products are
+copied into the workspace and its results reused.
+"""
+
+import atexit
+import copy
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings as django_settings
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def chmod_to_mode(chmod_settings):
+    """
+    Converts a symbolic access mode like "rw-r--r--" into a numeric mode.
+    Returns None if the string is not a valid mode.
+    """
+    if len(chmod_settings) != 9:
+        return None
+    mode = 0
+    for i, c in enumerate(chmod_settings):
+        if c not in ("-", "rwx"[i % 3]):
+            return None
+        mode = (mode << 1) | (c != "-")
+    return mode
+
+def _apply_file_settings(fpath, file_info):
+    mode = chmod_to_mode(file_info["chmod"])
+    if mode is not None:
+        os.chmod(fpath, mode)
+    else:
+        print("Invalid access mode {} for file {}".format(file_info["chmod"], fpath))
+
+    student_uid = getattr(django_settings, "CHECKING_STUDENT_UID", None)
+    student_gid = getattr(django_settings, "CHECKING_STUDENT_GID", None)
+    uid = student_uid if file_info["chown"] == "OWNED" and student_uid is not None else -1
+    gid = student_gid if file_info["chgrp"] == "OWNED" and student_gid is not None else -1
+    if uid != -1 or gid != -1:
+        os.chown(fpath, uid, gid)
+
+def _apply_workspace_settings(test_dir):
+    """
+    Gives the workspace to the student user and group, if set, so that the
+    tested programs can enter it and create files in it. The workspace is
+    setgid to keep the files created in it in the student group.
+    """
+    student_uid = getattr(django_settings, "CHECKING_STUDENT_UID", None)
+    student_gid = getattr(django_settings, "CHECKING_STUDENT_GID", None)
+    if student_uid is None and student_gid is None:
+        return
+    os.chown(
+        test_dir,
+        student_uid if student_uid is not None else -1,
+        student_gid if student_gid is not None else -1
+    )
+    os.chmod(test_dir, 0o2770 if student_gid is not None else 0o700)
+
+def prepare_workspace(root, plan, test):
+    """
+    Creates a new workspace directory under root and writes the files the
+    test requires into it.
+    """
+    test_dir = tempfile.mkdtemp(dir=root)
+    _apply_workspace_settings(test_dir)
+    for key in test["files"]:
+        file_info = plan["files"][key]
+        fpath = os.path.join(test_dir, file_info["name"])
+        shutil.copyfile(file_info["path"], fpath)
+        _apply_file_settings(fpath, file_info)
+        print("Wrote required file {} from {}".format(fpath, file_info["fileinfo"]))
+    return test_dir
+
+def remove_workspace(test_dir):
+    shutil.rmtree(test_dir, ignore_errors=True)
+
+
+class WorkspacePool:
+    """
+    Keeps up to size prepared workspaces for each of the max_tests most
+    recently run tests. The workspaces of a test are keyed by the test and
+    the contents and settings of its files, so a changed file never ends up
+    in a workspace prepared for the old one.
+    """
+
+    def __init__(self, root, size, max_tests):
+        self.root = root
+        self.size = size
+        self.max_tests = max_tests
+        self._ready = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1) if size > 0 else None
+
+    @staticmethod
+    def _key(plan, test):
+        return (plan["exercise_id"], plan["instance_id"], test["id"], tuple(
+            (plan["files"][key]["name"], plan["files"][key]["sha256"], plan["files"][key]["chmod"],
+             plan["files"][key]["chown"], plan["files"][key]["chgrp"])
+            for key in test["files"]
+        ))
+
+    def acquire(self, plan, test):
+        """
+        Returns the path of a workspace prepared for the test. The caller owns
+        the workspace and must give it to release when done.
+        """
+        if self._executor is None:
+            return prepare_workspace(self.root, plan, test)
+
+        key = self._key(plan, test)
+        evicted = []
+        test_dir = None
+        with self._lock:
+            ready = self._ready.get(key)
+            if ready is None:
+                self._ready[key] = []
+                while len(self._ready) > self.max_tests:
+                    evicted.extend(self._ready.popitem(last=False)[1])
+            else:
+                self._ready.move_to_end(key)
+                if ready:
+                    test_dir = ready.pop()
+
+        for old_dir in evicted:
+            remove_workspace(old_dir)
+
+        self._executor.submit(self._fill, key, plan, test)
+        if test_dir is None:
+            test_dir = prepare_workspace(self.root, plan, test)
+        return test_dir
+
+    def release(self, test_dir):
+        remove_workspace(test_dir)
+
+    def _fill(self, key, plan, test):
+        while True:
+            with self._lock:
+                ready = self._ready.get(key)
+                if ready is None or len(ready) >= self.size:
+                    return
+            test_dir = prepare_workspace(self.root, plan, test)
+            with self._lock:
+                ready = self._ready.get(key)
+                if ready is not None and len(ready) < self.size:
+                    ready.append(test_dir)
+                    continue
+            remove_workspace(test_dir)
+            return
+
+    def clear(self):
+        with self._lock:
+            ready = [test_dir for dirs in self._ready.values() for test_dir in dirs]
+            self._ready.clear()
+        for test_dir in ready:
+            remove_workspace(test_dir)
+
+
+def snapshot_workspace(test_dir):
+    """
+    Returns the files in the workspace as a dictionary of paths relative to
+    the workspace mapped to their access mode and content hash.
+    """
+    snapshot = {}
+    for dirpath, dirnames, filenames in os.walk(test_dir):
+        dirnames.sort()
+        for filename in filenames:
+            fpath = os.path.join(dirpath, filename)
+            if os.path.islink(fpath) or not os.path.isfile(fpath):
+                continue
+            h = hashlib.sha256()
+            with open(fpath, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    h.update(chunk)
+            snapshot[os.path.relpath(fpath, test_dir)] = (os.stat(fpath).st_mode & 0o7777, h.hexdigest())
+    return snapshot
+
+# Command fields that don't affect running the command
+_UNCACHED_COMMAND_FIELDS = ("id", "expected_outputs")
+
+def _replace_path(value, old, new):
+    if isinstance(value, str):
+        return value.replace(old, new)
+    if isinstance(value, dict):
+        return {k: _replace_path(v, old, new) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_replace_path(v, old, new) for v in value)
+    return value
+
+
+def cached_stage_ids(test):
+    """
+    Returns the ids of the stages of the test plan test whose results can be
+    taken from a StageCache, i.e. the stages other stages depend on.
+    """
+    return {stage["depends_on"] for stage in test["stages"] if stage.get("depends_on") is not None}
+
+def _unreliable(stage_results):
+    return stage_results["fail"] or any(
+        command.get("timedout") or command.get("error")
+        for command in stage_results["commands"].values()
+    )
+
+
+class StageCache:
+    """
+    Results and products of the stages run while checking one submission.
+    Failed stages are not cached: a timeout may have been caused by the load
+    of the checking server and an error by the runner, and a stage that
+    failed stops the test anyway.
+
+    The cache can be shared by the threads running the tests of the
+    submission concurrently: a thread about to run a stage that another
+    thread is running waits for it and reuses its results. Call clear to
+    remove the stored products when the submission has been checked.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self._store_dir = None
+
+    @staticmethod
+    def stage_key(stage, snapshot):
+        commands = [
+            {k: v for k, v in command.items() if k not in _UNCACHED_COMMAND_FIELDS}
+            for command in stage["commands"]
+        ]
+        content = json.dumps([commands, sorted(snapshot.items())], sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def run_stage(self, stage, test_dir, run):
+        """
+        Returns the results of running the stage in the workspace test_dir,
+        calling run() to actually run it unless the results are cached. The
+        workspace paths in cached results are replaced with test_dir.
+        """
+        try:
+            before = snapshot_workspace(test_dir)
+        except OSError as e:
+            # Earlier stages may leave files only the student user can read
+            print("Not caching stage {}: {}".format(stage["name"], e))
+            return run()
+        key = self.stage_key(stage, before)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                results = run()
+                self._store(key, stage, test_dir, before, results)
+                with self._lock:
+                    self.misses += 1
+                return results
+
+        self._restore(entry, test_dir)
+        with self._lock:
+            self.hits += 1
+        print("Reused the results of stage {} from {}".format(stage["name"], entry["test_dir"]))
+        stage_results, stage_json = _replace_path(copy.deepcopy(entry["results"]), entry["test_dir"], test_dir)
+        # The results are keyed by the command ids of the stage that was run
+        command_ids = dict(zip(entry["command_ids"], (command["id"] for command in stage["commands"])))
+        stage_results["commands"] = {
+            command_ids[cmd_id]: cmd_results for cmd_id, cmd_results in stage_results["commands"].items()
+        }
+        return stage_results, stage_json
+
+    def _store(self, key, stage, test_dir, before, results):
+        if _unreliable(results[0]):
+            return
+
+        try:
+            after = snapshot_workspace(test_dir)
+        except OSError as e:
+            print("Not caching stage {}: {}".format(stage["name"], e))
+            return
+        with self._lock:
+            if self._store_dir is None:
+                self._store_dir = tempfile.mkdtemp(dir=self.root)
+        entry_dir = os.path.join(self._store_dir, key)
+        products = {}
+        for rel_path, (mode, digest) in after.items():
+            if before.get(rel_path) == (mode, digest):
+                continue
+            stored_path = os.path.join(entry_dir, rel_path)
+            os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+            shutil.copyfile(os.path.join(test_dir, rel_path), stored_path)
+            stat = os.stat(os.path.join(test_dir, rel_path))
+            products[rel_path] = (mode, stat.st_uid, stat.st_gid)
+        self._entries[key] = {
+            "test_dir": test_dir,
+            "results": copy.deepcopy(results),
+            "command_ids": [command["id"] for command in stage["commands"]],
+            "entry_dir": entry_dir,
+            "products": products,
+            "removed": [rel_path for rel_path in before if rel_path not in after],
+        }
+
+    @staticmethod
+    def _restore(entry, test_dir):
+        for rel_path in entry["removed"]:
+            try:
+                os.remove(os.path.join(test_dir, rel_path))
+            except FileNotFoundError:
+                pass
+        for rel_path, (mode, uid, gid) in entry["products"].items():
+            fpath = os.path.join(test_dir, rel_path)
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            shutil.copyfile(os.path.join(entry["entry_dir"], rel_path), fpath)
+            os.chmod(fpath, mode)
+            # Products of a stage run as the student user must stay theirs
+            if os.geteuid() == 0:
+                os.chown(fpath, uid, gid)
+
+    def clear(self):
+        with self._lock:
+            store_dir, self._store_dir = self._store_dir, None
+            self._entries.clear()
+            self._key_locks.clear()
+        if store_dir is not None:
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+
+def get_workspace_pool():
+    """
+    Returns the workspace pool of this process, creating it on first use so
+    that every worker process gets a pool of its own.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkspacePool(
+                root=getattr(django_settings, "CHECKING_WORKSPACE_ROOT", "/tmp"),
+                size=getattr(django_settings, "CHECKING_WORKSPACE_POOL_SIZE", 0),
+                max_tests=getattr(django_settings, "CHECKING_WORKSPACE_POOL_TESTS", 32),
+            )
+            atexit.register(_pool.clear)
+        return _pool
@@ -0,0 +1,105 @@
+"""
+Caching of pygments syntax highlighting.
+
+Highlighting is one of the most expensive parts of rendering pages with code
+blocks and embedded files and of showing the files returned to file upload
+exercises. The highlighted HTML is stored in the Django cache under a key
+made of the SHA-256 of the code, the lexer (its name, or the file name it is
+guessed from), the formatter options and the pygments version, so the same
+code is highlighted only once no matter where it is shown.
+
+Files on disk are cached by their path, modification time and size instead,
+which saves reading them as well. Code longer than HIGHLIGHT_CACHE_MAX_BYTES
+is highlighted every time to keep single cache entries small.
+"""
+
+import hashlib
+import os
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+
+import pygments
+import pygments.lexers
+from pygments.formatters import HtmlFormatter
+
+
+def _get_cache_key(kind, data, lexer_key, options):
+    h = hashlib.sha256()
+    h.update(data if isinstance(data, bytes) else b"str:" + data.encode("utf-8"))
+    h.update("\0{}\0{}\0{}".format(
+        lexer_key, sorted(options.items()), pygments.__version__
+    ).encode("utf-8"))
+    return "highlight_{}_{}".format(kind, h.hexdigest())
+
+def _cacheable(size):
+    return (
+        getattr(django_settings, "HIGHLIGHT_CACHE", True)
+        and size <= getattr(django_settings, "HIGHLIGHT_CACHE_MAX_BYTES", 256 * 1024)
+    )
+
+def _save(key, highlighted):
+    cache.set(key, highlighted, timeout=getattr(django_settings, "HIGHLIGHT_CACHE_TIMEOUT", None))
+
+def highlight(code, lexer_name, **options):
+    """
+    Highlights code with the lexer of the name as HTML. The options are given
+    to HtmlFormatter. Raises pygments.util.ClassNotFound if there is no such
+    lexer.
+    """
+    if not _cacheable(len(code)):
+        return pygments.highlight(code, pygments.lexers.get_lexer_by_name(lexer_name), HtmlFormatter(**options))
+
+    key = _get_cache_key("code", code, lexer_name, options)
+    highlighted = cache.get(key)
+    if highlighted is None:
+        lexer = pygments.lexers.get_lexer_by_name(lexer_name)
+        highlighted = pygments.highlight(code, lexer, HtmlFormatter(**options))
+        _save(key, highlighted)
+    return highlighted
+
+def highlight_for_filename(filename, code, **options):
+    """
+    Highlights code with the lexer guessed from the file name and the code
+    as HTML. Raises pygments.util.ClassNotFound if no lexer fits.
+    """
+    if not _cacheable(len(code)):
+        lexer = pygments.lexers.guess_lexer_for_filename(filename, code)
+        return pygments.highlight(code, lexer, HtmlFormatter(**options))
+
+    key = _get_cache_key("guessed", code, os.path.basename(filename), options)
+    highlighted = cache.get(key)
+    if highlighted is None:
+        lexer = pygments.lexers.guess_lexer_for_filename(filename, code)
+        highlighted = pygments.highlight(code, lexer, HtmlFormatter(**options))
+        _save(key, highlighted)
+    return highlighted
+
+def highlight_file(path, binary=False, **options):
+    """
+    Highlights the file at the path like highlight_for_filename. The file is
+    read, as UTF-8 text unless binary, only if it has changed since it was
+    last highlighted. Raises ValueError if a text file can't be decoded.
+    """
+    stat = os.stat(path)
+    if not _cacheable(stat.st_size):
+        return _highlight_file(path, binary, options)
+
+    key = _get_cache_key(
+        "file", "{}:{}:{}".format(path, stat.st_mtime_ns, stat.st_size), binary, options
+    )
+    highlighted = cache.get(key)
+    if highlighted is None:
+        highlighted = _highlight_file(path, binary, options)
+        _save(key, highlighted)
+    return highlighted
+
+def _highlight_file(path, binary, options):
+    if binary:
+        with open(path, "rb") as f:
+            contents = f.read()
+    else:
+        with open(path, mode="r", encoding="utf-8") as f:
+            contents = f.read()
+    lexer = pygments.lexers.guess_lexer_for_filename(path, contents)
+    return pygments.highlight(contents, lexer, HtmlFormatter(**options))
@@ -19,6 +19,7 @@ import re
 import itertools
 import operator
 import copy
+import uuid
 #from django.utils.html import escape # Escapes ' characters -> prevents inline parsing
 # Possible solution: Import above as strict_escape and below as body_escape
 from cgi import escape # Use this instead? Security? HTML injection?
@@ -36,6 +37,7 @@ from reversion import revisions as reversion
 from reversion.models import Version
 
 import courses.blockparser as blockparser
+import courses.highlight_cache as highlight_cache
 import courses.models
 import courses.forms
 import feedback.models
@@ -86,6 +88,37 @@ class EmbeddedObjectNotAllowedError(MarkupError):
 class EmbeddedObjectNotFoundError(MarkupError):
     _type = "embedded object not found"
 
+# Line breaks of all the platforms
+line_break_re = re.compile(r"\r\n|\r|\n")
+
+def iter_lines(text, line_break=line_break_re):
+    """
+    Yields the lines of the text one at a time, the same lines that
+    line_break.split(text) returns but without creating a list of them. The
+    text can also be an iterable of strings, e.g. an open file or a generator,
+    which are read only as far as the lines have been consumed.
+    """
+    if isinstance(text, str):
+        start = 0
+        for m in line_break.finditer(text):
+            yield text[start:m.start()]
+            start = m.end()
+        yield text[start:]
+        return
+
+    rest = ""
+    for chunk in text:
+        rest += chunk
+        start = 0
+        for m in line_break.finditer(rest):
+            # A line break at the end of a chunk can continue in the next one
+            if m.end() == len(rest):
+                break
+            yield rest[start:m.start()]
+            start = m.end()
+        rest = rest[start:]
+    yield from line_break.split(rest)
+
 class MarkupParser:
     """
     Static parser class for generating HTML from the used markup block types.
@@ -173,11 +206,17 @@ class MarkupParser:
         return getattr(matchobj, "lastgroup", "paragraph"), matchobj
 
     @classmethod
-    def parse(cls, text, request=None, context=None, embedded_pages=None):
+    def parse(cls, text, request=None, context=None, embedded_pages=None, dynamic=None):
         """
         A generator that gets the text written in the markup language, splits
         it at newlines and yields the parsed text until the whole text has
-        been parsed.
+        been parsed. If dynamic is a DynamicParts, the parts that depend on
+        the user are left as placeholders.
+
+        The text is split into lines as they are parsed and each block is
+        yielded as soon as it has been rendered, so the text can also be an
+        iterable of strings (see iter_lines) that is never held in memory
+        whole. Link targets are resolved in bulk only for str texts.
         """
         if not cls._ready:
             raise ParserUninitializedError("compile() not called")
@@ -185,18 +224,18 @@ class MarkupParser:
         if context is None: context = {}
         if embedded_pages is None: embedded_pages = []
 
-        # TODO: Generator version of splitter to avoid memory & CPU overhead of
-        # first creating a complete list and afterwards iterating through it.
-        # I.e. reduce from O(2n) to O(n)
-        # Note! pypi regex has regex.splititer
-        lines = iter(re.split(r"\r\n|\r|\n", text))
+        # The link targets of the document are resolved together
+        context = dict(context, link_lookup=LinkLookup(text if isinstance(text, str) else ""))
+
+        lines = iter_lines(text)
 
         # Note: stateless single-pass parsing of HTML-like languages is
         # impossible because of the closing tags.
         # TODO: Initialize states from markups
         # TODO: State stack for indents, inline markups, pre, etc.
         state = {"lines": lines, "request": request, "context": context,
-                 "list": [], "embedded_pages": embedded_pages, "table": False}
+                 "list": [], "embedded_pages": embedded_pages, "table": False,
+                 "dynamic": dynamic}
 
         for (block_type, matchobj), block in itertools.groupby(lines, cls._get_line_kind):
             block_markup = cls._markups[block_type]
@@ -226,9 +265,55 @@ class MarkupParser:
         if state["table"]:
             yield '</table>\n'
             
+class DynamicParts:
+    """
+    The parts of a page that are rendered separately for each user, i.e.
+    embedded pages and calendars. When given to MarkupParser.parse, those
+    markups yield a placeholder and store what they need for rendering in
+    the DynamicParts instead, so that the rest of the output can be cached
+    (see page_cache). render replaces the placeholders with the parts
+    rendered for a request.
+    """
+
+    # Embedded pages can embed more pages and calendars
+    MAX_DEPTH = 4
+
+    def __init__(self):
+        self.nonce = uuid.uuid4().hex
+        self.parts = []
+
+    def __len__(self):
+        return len(self.parts)
+
+    def placeholder(self, markup, args):
+        self.parts.append((markup.shortname, args))
+        return "<!--dynamic-{}-{}-->".format(self.nonce, len(self.parts) - 1)
+
+    def render(self, text, request, context):
+        if not self.parts:
+            return text
+
+        pattern = re.compile("<!--dynamic-{}-(\\d+)-->".format(self.nonce))
+
+        def render_part(matchobj):
+            shortname, args = self.parts[int(matchobj.group(1))]
+            try:
+                return MarkupParser._markups[shortname].render_dynamic(args, request, context)
+            except MarkupError as e:
+                return e.html()
+
+        for _ in range(self.MAX_DEPTH):
+            text, count = pattern.subn(render_part, text)
+            if not count:
+                break
+        return text
+
 markups = []
 link_markups = []
 
+# LinkParser has always split lines only at these
+link_line_break_re = re.compile(r"\r\n|\n\r")
+
 class LinkParser(MarkupParser):
     """
     Lite version of MarkupParser. This is used for parsing embedded links to
@@ -247,7 +332,7 @@ class LinkParser(MarkupParser):
         page_links = []
         media_links = []
         
-        lines = iter(re.split(r"\r\n|\n\r", text))
+        lines = iter_lines(text, link_line_break_re)
         
         for (block_type, matchobj), block in itertools.groupby(lines, cls._get_line_kind):
             try:
@@ -259,6 +344,123 @@ class LinkParser(MarkupParser):
                 link_func(block, matchobj, instance, page_links, media_links)
             
         return page_links, media_links
+
+class LinkLookup:
+    """
+    Resolves the pages and media referenced in a document in a few queries.
+    The first time a markup needs a link target, a pre-pass collects all the
+    embedded page slugs and media names of the document with LinkParser and
+    the page slugs and file names of its anchors, and the targets of each
+    kind are fetched in one query. Targets that the pre-pass didn't find are
+    fetched one at a time like before.
+
+    MarkupParser.parse gives the markups a lookup for the document in the
+    context as "link_lookup"; get_link_lookup returns it.
+    """
+
+    def __init__(self, text=""):
+        self.text = text
+        self._names = None
+        self._objects = {}
+
+    def _collect(self):
+        if self._names is not None:
+            return self._names
+
+        page_slugs, media_names = set(), set()
+        file_names = set()
+        if self.text:
+            # LinkParser only splits at \r\n
+            text = "\r\n".join(re.split(r"\r\n|\r|\n", self.text))
+            page_links, media_links = LinkParser.parse(text)
+            page_slugs.update(page_links)
+            media_names.update(media_links)
+            for m in blockparser.tags["anchor"].re.finditer(self.text):
+                server_side = m.group("address").split("#", 1)[0]
+                if server_side.startswith("file:"):
+                    file_names.add(server_side.split("file:", 1)[1])
+                elif server_side == slugify(server_side, allow_unicode=True):
+                    page_slugs.add(server_side)
+
+        self._names = {
+            "page": page_slugs,
+            "file": media_names | file_names,
+            "image": media_names,
+            "embedded_link": page_slugs,
+            "media_link": media_names,
+        }
+        return self._names
+
+    def _lookup(self, kind, key, name, query):
+        """
+        Returns the object of the kind with the name, or None. query gets a
+        list of names and returns a dictionary of the objects found by name.
+        """
+        objects = self._objects.get(key)
+        if objects is None:
+            names = self._collect()[kind]
+            objects = dict.fromkeys(names)
+            if names:
+                objects.update(query(list(names)))
+            self._objects[key] = objects
+        if name not in objects:
+            objects[name] = query([name]).get(name)
+        return objects[name]
+
+    def page(self, slug):
+        page = self._lookup("page", "page", slug, lambda slugs: {
+            page.slug: page for page in courses.models.ContentPage.objects.filter(slug__in=slugs)
+        })
+        if page is None:
+            raise courses.models.ContentPage.DoesNotExist("ContentPage matching query does not exist.")
+        return page
+
+    def file(self, name):
+        file_object = self._lookup("file", "file", name, lambda names: {
+            file_object.name: file_object for file_object in courses.models.File.objects.filter(name__in=names)
+        })
+        if file_object is None:
+            raise courses.models.File.DoesNotExist("File matching query does not exist.")
+        return file_object
+
+    def image(self, name):
+        image = self._lookup("image", "image", name, lambda names: {
+            image.name: image for image in courses.models.Image.objects.filter(name__in=names)
+        })
+        if image is None:
+            raise courses.models.Image.DoesNotExist("Image matching query does not exist.")
+        return image
+
+    def embedded_link(self, slug, instance, parent):
+        key = ("embedded_link", instance.pk, parent.pk)
+        link = self._lookup("embedded_link", key, slug, lambda slugs: {
+            link.embedded_page.slug: link for link in courses.models.EmbeddedLink.objects.filter(
+                embedded_page__slug__in=slugs, instance=instance, parent=parent
+            ).select_related("embedded_page")
+        })
+        if link is None:
+            raise courses.models.EmbeddedLink.DoesNotExist("EmbeddedLink matching query does not exist.")
+        return link
+
+    def media_link(self, name, instance, parent):
+        key = ("media_link", instance.pk, parent.pk)
+        link = self._lookup("media_link", key, name, lambda names: {
+            link.media.name: link for link in courses.models.CourseMediaLink.objects.filter(
+                media__name__in=names, instance=instance, parent=parent
+            ).select_related("media", "media__file", "media__image")
+        })
+        if link is None:
+            raise courses.models.CourseMediaLink.DoesNotExist("CourseMediaLink matching query does not exist.")
+        return link
+
+def get_link_lookup(context):
+    """
+    Returns the link lookup of the document being parsed, or one that fetches
+    link targets one at a time for markup parsed without MarkupParser.
+    """
+    if context is not None and "link_lookup" in context:
+        return context["link_lookup"]
+    return LinkLookup()
             
         
     
@@ -327,12 +529,18 @@ class CalendarMarkup(Markup):
 
     @classmethod
     def block(cls, block, settings, state):
+        if state["dynamic"] is not None:
+            yield state["dynamic"].placeholder(cls, settings)
+        else:
+            yield cls.render_dynamic(settings, state["request"], state["context"])
+
+    @classmethod
+    def render_dynamic(cls, settings, request, context):
         try:
             calendar = courses.models.Calendar.objects.get(name=settings["calendar_name"])
         except courses.models.Calendar.DoesNotExist as e:
             # TODO: Modular errors
-            yield '<div>Calendar {} not found.</div>'.format(settings["calendar_name"])
-            raise StopIteration
+            return '<div>Calendar {} not found.</div>'.format(settings["calendar_name"])
 
         calendar_dates = courses.models.CalendarDate.objects.filter(calendar=calendar)
 
@@ -341,14 +549,14 @@ class CalendarMarkup(Markup):
             for cal_date in calendar_dates
         ]
 
-        user = state["request"].user
+        user = request.user
         user_has_slot = False
         reserved_event_ids = []
 
         if user.is_authenticated:
             for cal_date, cal_reservations in calendar_reservations:
                 try:
-                    found = cal_reservations[0].get(user=state["request"].user)
+                    found = cal_reservations[0].get(user=request.user)
                 except courses.models.CalendarReservation.DoesNotExist as e:
                     continue
                 cal_reservations[1] = True
@@ -366,8 +574,7 @@ class CalendarMarkup(Markup):
         }
         
         t = loader.get_template("courses/calendar.html")
-        rendered_content = t.render(c, state["request"])
-        yield rendered_content
+        return t.render(c, request)
 
     @classmethod
     def settings(cls, matchobj, state):
@@ -417,7 +624,7 @@ class CodeMarkup(Markup):
             # TODO: Raise an error (and close the pre and code tags)
             yield 'Warning: unclosed code block!\n'
         if highlight:
-            highlighted = pygments.highlight(text[:-1], lexer, HtmlFormatter(nowrap=True))
+            highlighted = highlight_cache.highlight(text[:-1], highlight, nowrap=True)
             yield '%s</code>' % highlighted
         else:
             yield text
@@ -452,12 +659,13 @@ class EmbeddedFileMarkup(Markup):
     @classmethod
     def block(cls, block, settings, state):
         instance = state["context"]["instance"]
+        links = get_link_lookup(state["context"])
         
         try:
             try:
-                link = courses.models.CourseMediaLink.objects.get(media__name=settings["file_slug"], instance=instance, parent=state["context"]["content_page"])
+                link = links.media_link(settings["file_slug"], instance, state["context"]["content_page"])
             except courses.models.CourseMediaLink.DoesNotExist as e:
-                file_object = courses.models.File.objects.get(name=settings["file_slug"])
+                file_object = links.file(settings["file_slug"])
             else:
                 if link.revision is None:
                     file_object = link.media.file
@@ -480,20 +688,15 @@ class EmbeddedFileMarkup(Markup):
             highlighted = ""
         else:           
             try:
-                file_contents = open(file_path, mode='r', encoding='utf-8').read()
+                highlighted = highlight_cache.highlight_file(file_path, nowrap=True)
             except ValueError as e:
                 # TODO: Modular errors
                 yield "<div>Unable to decode file %s with utf-8.</div>" % settings["file_slug"]
                 raise StopIteration
-
-            try:
-                lexer = pygments.lexers.guess_lexer_for_filename(file_path, file_contents)
             except pygments.util.ClassNotFound:
                 # TODO: Modular errors
                 yield '<div>Unable to find lexer for file %s.</div>' % settings['file_slug']
                 raise StopIteration
-
-            highlighted = pygments.highlight(file_contents, lexer, HtmlFormatter(nowrap=True))
         
         instance_slug = instance.slug
         course_slug = instance.course.slug
@@ -558,6 +761,7 @@ class EmbeddedPageMarkup(Markup):
         settings = {"page_slug": matchobj.group("page_slug")}
         revision = None
         instance = state["context"]["instance"]
+        links = get_link_lookup(state["context"])
         try:
             revision = int(matchobj.group("revision"))
         except AttributeError:
@@ -567,10 +771,10 @@ class EmbeddedPageMarkup(Markup):
 
         try:
             try:
-                link = courses.models.EmbeddedLink.objects.get(embedded_page__slug=settings["page_slug"], instance=instance, parent=state["context"]["content_page"])
+                link = links.embedded_link(settings["page_slug"], instance, state["context"]["content_page"])
             except courses.models.EmbeddedLink.DoesNotExist as e:
                 # link does not exist yet, get by page slug instead
-                page = courses.models.ContentPage.objects.get(slug=settings["page_slug"])
+                page = links.page(settings["page_slug"])
             else:
                 page = link.embedded_page
                 revision = link.revision
@@ -593,54 +797,73 @@ class EmbeddedPageMarkup(Markup):
             # TODO: Prevent recursion depth > 2
             #embedded_content = page.rendered_markup()
             embedded_content = ""
-            markup_gen = MarkupParser.parse(page.content, state["request"], state["context"])
+            markup_gen = MarkupParser.parse(page.content, state["request"], state["context"],
+                                            dynamic=state["dynamic"])
             for chunk in markup_gen:
                 embedded_content += chunk
             
-            choices = page.get_choices(page, revision=revision)
             question = blockparser.parseblock(escape(page.question), state["context"])
 
-            c = {
-                "emb_content": embedded_content,
-                "embedded": True,
-                "content": page,
-                "content_slug": page.slug,
-                "question": question,
-                "choices": choices,
-                "revision": revision,
-            }
-            try:
-                user = state["request"].user
-            except AttributeError:
+        args = {
+            "page": page,
+            "revision": revision,
+            "embedded_content": embedded_content,
+            "question": question,
+        }
+        if state["dynamic"] is not None:
+            settings["rendered_content"] = state["dynamic"].placeholder(cls, args)
+        else:
+            settings["rendered_content"] = cls.render_dynamic(args, state["request"], state["context"])
+        return settings
+
+    @classmethod
+    def render_dynamic(cls, args, request, context):
+        page = args["page"]
+        revision = args["revision"]
+        embedded_content = args["embedded_content"]
+        instance = context["instance"]
+
+        choices = page.get_choices(page, revision=revision)
+
+        c = {
+            "emb_content": embedded_content,
+            "embedded": True,
+            "content": page,
+            "content_slug": page.slug,
+            "question": args["question"],
+            "choices": choices,
+            "revision": revision,
+        }
+        try:
+            user = request.user
+        except AttributeError:
+            c["sandboxed"] = False
+            c["evaluation"] = "unanswered"
+            c["answer_count"] = 0
+        else:
+            sandboxed = request.path.startswith("/sandbox/")
+            if sandboxed and user.is_authenticated and user.is_active and user.is_staff:
+                c["sandboxed"] = True
+            elif sandboxed and (not user.is_authenticated or not user.is_active or not user.is_staff):
+                return ""
+            else:
                 c["sandboxed"] = False
+
+            if user.is_active and page.is_answerable() and not sandboxed:
+                c["evaluation"] = page.get_user_evaluation(page, user, instance)
+                c["answer_count"] = page.get_user_answers(page, user, instance).count()
+            else:
                 c["evaluation"] = "unanswered"
                 c["answer_count"] = 0
-            else:
-                sandboxed = state["request"].path.startswith("/sandbox/")
-                if sandboxed and user.is_authenticated and user.is_active and user.is_staff:
-                    c["sandboxed"] = True
-                elif sandboxed and (not user.is_authenticated or not user.is_active or not user.is_staff):
-                    settings["rendered_content"] = ""
-                    return settings
-                else:
-                    c["sandboxed"] = False
-
-                if user.is_active and page.is_answerable() and not sandboxed:
-                    c["evaluation"] = page.get_user_evaluation(page, user, instance)
-                    c["answer_count"] = page.get_user_answers(page, user, instance).count()
-                else:
-                    c["evaluation"] = "unanswered"
-                    c["answer_count"] = 0
-                    
-            c.update(state["context"])
-            
-            t = loader.get_template("courses/{page_type}.html".format(
-                page_type=page.get_dashed_type()
-            ))
-            rendered_content = t.render(c, state["request"])
+                
+        c.update(context)
+        
+        t = loader.get_template("courses/{page_type}.html".format(
+            page_type=page.get_dashed_type()
+        ))
+        rendered_content = t.render(c, request)
 
-        settings["rendered_content"] = rendered_content or embedded_content
-        return settings
+        return rendered_content or embedded_content
 
     @classmethod
     def build_links(cls, block, matchobj, instance, page_links, media_links):
@@ -815,7 +1038,9 @@ class EmbeddedScriptMarkup(Markup):
     
     @classmethod
     def build_links(cls, block, matchobj, instance, page_links, media_links):
-        slugs = [matchobj.group("script_slug")] + [m.split("=")[1] for m in matchobj.group("include").split(",")]
+        slugs = [matchobj.group("script_slug")]
+        if matchobj.group("include"):
+            slugs += [m.split("=")[1] for m in matchobj.group("include").split(",")]
         
         for slug in slugs:
             media_links.append(slug)
@@ -951,11 +1176,12 @@ class ImageMarkup(Markup):
     @classmethod
     def block(cls, block, settings, state):
         instance = state["context"]["instance"]
+        links = get_link_lookup(state["context"])
         try:
             try:
-                link = courses.models.CourseMediaLink.objects.get(media__name=settings["image_name"], instance=instance, parent=state["context"]["content_page"])
+                link = links.media_link(settings["image_name"], instance, state["context"]["content_page"])
             except courses.models.CourseMediaLink.DoesNotExist as e:
-                image_object = courses.models.Image.objects.get(name=settings["image_name"])
+                image_object = links.image(settings["image_name"])
             else:
                 if link.revision is None:
                     image_object = link.media.image
@@ -5,16 +5,17 @@
 
 import datetime
 import itertools
+import time
 import operator
 import re
 import os
 from fnmatch import fnmatch
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q, Max
 from django.contrib.auth.models import User, Group
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.urls import reverse
 from django.core.files.storage import FileSystemStorage
 from django.core.exceptions import ValidationError
@@ -25,6 +26,7 @@ import django.conf
 
 from reversion import revisions as reversion
 from reversion.models import Version
+from reversion.signals import post_revision_commit
 
 import pygments
 import magic
@@ -36,6 +38,11 @@ import feedback.models
 
 import courses.markupparser as markupparser
 import courses.blockparser as blockparser
+import courses.answer_matching as answer_matching
+import courses.evaluation_cache as evaluation_cache
+import courses.evaluation_queue as evaluation_queue
+import courses.highlight_cache as highlight_cache
+import courses.page_cache as page_cache
 from utils.files import *
 
 # TODO: Extend the registration system to allow users to enter the profile data!
@@ -541,34 +548,58 @@ class ContentPage(models.Model):
         super().save(*args, **kwargs)        
         
 
+    def _get_content(self, revision=None):
+        if revision is None:
+            return self.content
+        version = Version.objects.get_for_object(self).get(revision_id=revision).field_dict
+        return version["content"]
+
+    def get_static_markup(self, context, revision=None):
+        """
+        Returns the part of the rendered page content that is the same for
+        every user, with placeholders for the rest, and the
+        markupparser.DynamicParts that fill them. The static part is cached
+        per revision, course instance and language by page_cache.
+        """
+        key = page_cache.get_cache_key(
+            self.id, revision, context["instance"].id, translation.get_language()
+        )
+        cached = page_cache.get_rendered(key)
+        if cached is not None:
+            return cached
+
+        # Only what is the same for every user may affect the static part
+        static_context = {
+            key: context[key] for key in page_cache.STATIC_CONTEXT_KEYS if key in context
+        }
+        static_context["content_page"] = self
+        dynamic = markupparser.DynamicParts()
+        rendered = "".join(markupparser.MarkupParser.parse(
+            self._get_content(revision), None, static_context, [], dynamic
+        ))
+        page_cache.save_rendered(key, (rendered, dynamic))
+        return rendered, dynamic
+
     def rendered_markup(self, request=None, context=None, revision=None):
         """
         Uses the included MarkupParser library to render the page content into
-        HTML. If a rendered version already exists in the cache, use that
-        instead.
+        HTML. Within a course instance, the static part of the page comes
+        from the cache and only embedded pages and calendars are rendered for
+        the request.
         """
         # NOTE: Has not worked with context=None for a while
         # NOTE: Not working with request=None either
-        # TODO: Cache
-        # TODO: Separate caching depending on the language!
         # TODO: Take csrf protection into account; use cookies only
         #       - https://docs.djangoproject.com/en/1.7/ref/contrib/csrf/
-        rendered = ""
-        embedded_pages = []
-
-        if revision is None:
-            content = self.content
-        else:
-            version = Version.objects.get_for_object(self).get(revision_id=revision).field_dict
-            content = version["content"]
+        if context.get("instance") is not None and not context.get("tooltip"):
+            rendered, dynamic = self.get_static_markup(context, revision)
+            context["content_page"] = self
+            return dynamic.render(rendered, request, context)
 
         # Render the page
         context["content_page"] = self
-        markup_gen = markupparser.MarkupParser.parse(content, request, context, embedded_pages)
-        for chunk in markup_gen:
-            rendered += chunk
-
-        return rendered
+        markup_gen = markupparser.MarkupParser.parse(self._get_content(revision), request, context, [])
+        return "".join(markup_gen)
     
     def update_embedded_links(self, instance, revision=None):
         """
@@ -1015,6 +1046,7 @@ class TextfieldExercise(ContentPage):
 
         self.content_type = "TEXTFIELD_EXERCISE"
         super(TextfieldExercise, self).save(*args, **kwargs)
+        answer_matching.invalidate_exercise(self.id)
         for instance in CourseInstance.objects.filter(Q(contentgraph__content=self) | Q(contentgraph__content__embedded_pages=self), frozen=False):
             self.update_embedded_links(instance)
 
@@ -1052,13 +1084,15 @@ class TextfieldExercise(ContentPage):
         answer_object.save()
         return answer_object
 
-    def check_answer(self, user, ip, answer, files, answer_object, revision):
-        answers = self.get_choices(self, revision)
+    def get_answer_matcher(self, revision):
+        if revision is None:
+            key = (self.id, "current", answer_matching.get_choices_generation(self.id))
+        else:
+            key = (self.id, revision)
+        return answer_matching.get_matcher(key, lambda: self.get_choices(self, revision))
 
+    def check_answer(self, user, ip, answer, files, answer_object, revision):
         # Determine, if the given answer was correct and which hints/comments to show
-        correct = False
-        hints = []
-        comments = []
         errors = []
         
         if "answer" in answer.keys():
@@ -1066,52 +1100,14 @@ class TextfieldExercise(ContentPage):
         else:
             return {"evaluation": False}
 
-        def re_validate(db_ans, given_ans):
-            m = re.match(db_ans, given_ans)
-            return (m is not None, m)
-        #re_validate = lambda db_ans, given_ans: re.match(db_ans, given_ans) is not None
-        str_validate = lambda db_ans, given_ans: (db_ans == given_ans, None)
-
-        for answer in answers:
-            validate = re_validate if answer.regexp else str_validate
+        result = self.get_answer_matcher(revision).evaluate(given_answer)
+        for choice, e in result.errors:
+            if user.is_staff:
+                errors.append("Contact staff, regexp error '{}' from regexp: {}".format(e, choice.answer))
+            else:
+                errors.append("Contact staff! Regexp error '{}' in exercise '{}'.".format(e, self.name))
 
-            try:
-                match, m = validate(answer.answer, given_answer)
-            except re.error as e:
-                if user.is_staff:
-                    errors.append("Contact staff, regexp error '{}' from regexp: {}".format(e, answer.answer))
-                else:
-                    errors.append("Contact staff! Regexp error '{}' in exercise '{}'.".format(e, self.name))
-                correct = False
-                continue
-
-            sub = lambda text: text
-            if m is not None and m.groupdict():
-                groups = {re.escape("{{{k}}}".format(k=k)): v for k, v in m.groupdict().items() if v is not None}
-                if groups:
-                    pattern = re.compile("|".join((re.escape("{{{k}}}".format(k=k)) for k in m.groupdict().keys())))
-                    sub = lambda text: pattern.sub(lambda mo: groups[re.escape(mo.group(0))], text)
-
-            hint = comment = ""
-            if answer.hint:
-                hint = sub(answer.hint)
-            if answer.comment:
-                comment = sub(answer.comment)
-
-            if match and answer.correct:
-                correct = True
-                if comment:
-                    comments.append(comment)
-            elif match and not answer.correct:
-                if hint:
-                    hints.append(hint)
-                if comment:
-                    comments.append(comment)
-            elif not match and answer.correct:
-                if hint:
-                    hints.append(hint)
-
-        return {"evaluation": correct, "hints": hints, "comments": comments,
+        return {"evaluation": result.correct, "hints": result.hints, "comments": result.comments,
                 "errors": errors}
 
     def get_user_evaluation(self, user, instance, check_group=True):
@@ -1203,14 +1199,22 @@ class FileUploadExercise(ContentPage):
     def check_answer(self, user, ip, answer, files, answer_object, revision):
         lang_code = translation.get_language()
         if revision == "head": revision = None
-        result = rpc_tasks.run_tests.delay(
-            user_id=user.id,
-            instance_id=answer_object.instance.id,
-            exercise_id=self.id,
-            answer_id=answer_object.id,
-            lang_code=lang_code,
-            revision=revision
+        task_id = rpc_tasks.check_duplicate_answer(answer_object, revision)
+        if task_id is not None:
+            return {"task_id": task_id}
+        result = rpc_tasks.run_tests.apply_async(
+            kwargs={
+                "user_id": user.id,
+                "instance_id": answer_object.instance.id,
+                "exercise_id": self.id,
+                "answer_id": answer_object.id,
+                "lang_code": lang_code,
+                "revision": revision,
+                "queued_at": time.time(),
+            },
+            **evaluation_queue.get_checking_options(user, answer_object.instance.id)
         )
+        evaluation_queue.supersede_previous(user.id, self.id, answer_object.instance.id, result.task_id)
         return {"task_id": result.task_id}
 
     def get_user_evaluation(self, user, instance, check_group=True):
@@ -1337,6 +1341,7 @@ class RepeatedTemplateExercise(ContentPage):
         self.content_type = "REPEATED_TEMPLATE_EXERCISE"
         RepeatedTemplateExerciseSession.objects.filter(exercise=self, user=None).delete()
         super(RepeatedTemplateExercise, self).save(*args, **kwargs)
+        answer_matching.invalidate_exercise(self.id)
         for instance in CourseInstance.objects.filter(Q(contentgraph__content=self) | Q(contentgraph__content__embedded_pages=self), frozen=False):
             self.update_embedded_links(instance)
 
@@ -1418,14 +1423,12 @@ class RepeatedTemplateExercise(ContentPage):
         session = answer_object.session
         session_instance = RepeatedTemplateExerciseSessionInstance.objects.filter(session=session, userrepeatedtemplateinstanceanswer__isnull=False).order_by('ordinal_number').last()
         
-        answers = RepeatedTemplateExerciseSessionInstanceAnswer.objects.filter(session_instance=session_instance)
-
-        # Copied from textfield exercise
+        matcher = answer_matching.get_matcher(
+            (self.id, "session_instance", session_instance.id),
+            lambda: RepeatedTemplateExerciseSessionInstanceAnswer.objects.filter(session_instance=session_instance)
+        )
 
         # Determine, if the given answer was correct and which hints/comments to show
-        correct = False
-        hints = []
-        comments = []
         triggers = []
         errors = []
         
@@ -1434,52 +1437,15 @@ class RepeatedTemplateExercise(ContentPage):
         else:
             return {"evaluation": False}
 
-        def re_validate(db_ans, given_ans):
-            m = re.match(db_ans, given_ans)
-            return (m is not None, m)
-        #re_validate = lambda db_ans, given_ans: re.match(db_ans, given_ans) is not None
-        str_validate = lambda db_ans, given_ans: (db_ans == given_ans, None)
-
-        for answer in answers:
-            validate = re_validate if answer.regexp else str_validate
-
-            try:
-                match, m = validate(answer.answer, given_answer)
-            except re.error as e:
-                if user.is_staff:
-                    errors.append("Contact staff, regexp error '{}' from regexp: {}".format(e, answer.answer))
-                else:
-                    errors.append("Contact staff! Regexp error '{}' in exercise '{}'.".format(e, self.name))
-                correct = False
-                continue
-
-            sub = lambda text: text
-            if m is not None and m.groupdict():
-                groups = {re.escape("{{{k}}}".format(k=k)): v for k, v in m.groupdict().items() if v is not None}
-                if groups:
-                    pattern = re.compile("|".join((re.escape("{{{k}}}".format(k=k)) for k in m.groupdict().keys())))
-                    sub = lambda text: pattern.sub(lambda mo: groups[re.escape(mo.group(0))], text)
-
-            hint = comment = ""
-            if answer.hint:
-                hint = sub(answer.hint)
-            if answer.comment:
-                comment = sub(answer.comment)
-            #if answer.triggers:
-                #triggers.extend(answer.triggers)
-
-            if match and answer.correct:
-                correct = True
-                if comment:
-                    comments.append(comment)
-            elif match and not answer.correct:
-                if hint:
-                    hints.append(hint)
-                if comment:
-                    comments.append(comment)
-            elif not match and answer.correct:
-                if hint:
-                    hints.append(hint)
+        result = matcher.evaluate(given_answer)
+        correct = result.correct
+        hints = result.hints
+        comments = result.comments
+        for choice, e in result.errors:
+            if user.is_staff:
+                errors.append("Contact staff, regexp error '{}' from regexp: {}".format(e, choice.answer))
+            else:
+                errors.append("Contact staff! Regexp error '{}' in exercise '{}'.".format(e, self.name))
 
         instance_answer = UserRepeatedTemplateInstanceAnswer.objects.get(session_instance=session_instance)
         instance_answer.correct = correct
@@ -1833,6 +1799,12 @@ class TextfieldExerciseAnswer(models.Model):
         self.answer = self.answer.replace("\r", "")
         super(TextfieldExerciseAnswer, self).save(*args, **kwargs)
 
+def invalidate_answer_matchers(sender, instance, **kwargs):
+    answer_matching.invalidate_exercise(instance.exercise_id)
+
+post_save.connect(invalidate_answer_matchers, sender=TextfieldExerciseAnswer, dispatch_uid="invalidate_answer_matchers_save_lovelace")
+post_delete.connect(invalidate_answer_matchers, sender=TextfieldExerciseAnswer, dispatch_uid="invalidate_answer_matchers_delete_lovelace")
+
 #@reversion.register()
 class MultipleChoiceExerciseAnswer(models.Model):
     exercise = models.ForeignKey(MultipleChoiceExercise, null=True, on_delete=models.SET_NULL)
@@ -1969,6 +1941,22 @@ class Evaluation(models.Model):
     evaluator = models.ForeignKey(User, verbose_name='Who evaluated the answer', blank=True, null=True, on_delete=models.SET_NULL)
     feedback = models.TextField(verbose_name='Feedback given by a teacher', blank=True)
     test_results = models.TextField(verbose_name='Test results in JSON', blank=True) # TODO: JSONField
+    packed_results = models.BinaryField(verbose_name='Compressed test results', blank=True, null=True)
+    timings = models.TextField(verbose_name='Checking phase timings in JSON', blank=True)
+
+    @property
+    def has_test_results(self):
+        return bool(self.packed_results or self.test_results)
+
+class EvaluationOutput(models.Model):
+    """
+    Compressed output of a command in the stored test results of file upload
+    exercise evaluations, shared by all evaluations with the same output.
+    """
+    digest = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    # When an evaluation was last stored with this output
+    last_used = models.DateTimeField(auto_now=True, db_index=True)
 
 ## TODO: Should these actually be proxied like the exercise types?
 class UserAnswer(models.Model):
@@ -2047,18 +2035,17 @@ class FileUploadExerciseReturnFile(models.Model):
     def get_content(self):
         if not self.get_type()[1]:
             path = self.fileinfo.path
-            with open(path, 'rb') as f:
-                contents = f.read()
-                try:
-                    lexer = pygments.lexers.guess_lexer_for_filename(path, contents)
-                except pygments.util.ClassNotFound:
-                    return contents
-                else:
-                    return pygments.highlight(contents, lexer, pygments.formatters.HtmlFormatter(nowrap=True))
+            try:
+                return highlight_cache.highlight_file(path, binary=True, nowrap=True)
+            except pygments.util.ClassNotFound:
+                with open(path, 'rb') as f:
+                    return f.read()
         return ""
 
 class UserFileUploadExerciseAnswer(UserAnswer):
     exercise = models.ForeignKey(FileUploadExercise, blank=True, null=True, on_delete=models.SET_NULL)
+    # Hash over the returned files and the test plan, see evaluation_cache
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
 
     def __str__(self):
         return "Answer by %s" % (self.user.username)
@@ -2083,11 +2070,9 @@ class UserFileUploadExerciseAnswer(UserAnswer):
                 type_info = returned_file.get_type()
                 if not type_info[1]:
                     try:
-                        lexer = pygments.lexers.guess_lexer_for_filename(path, contents)
+                        contents = highlight_cache.highlight_for_filename(path, contents, nowrap=True)
                     except pygments.util.ClassNotFound:
                         pass
-                    else:
-                        contents = pygments.highlight(contents, lexer, pygments.formatters.HtmlFormatter(nowrap=True))
                 returned_files[returned_file.filename()] = type_info + (contents,)
         return returned_files
 
@@ -2158,6 +2143,59 @@ class UserCodeReplaceExerciseAnswer(UserAnswer):
     def __str__(self):
         return given_answer
 
+def invalidate_file_exercise_caches(sender, revision, versions, **kwargs):
+    """
+    Drops the cached test plans and reference results of all the file upload
+    exercises that were changed in the revision and runs the reference again
+    once the revision has been committed.
+    """
+    exercise_ids = evaluation_cache.get_revision_exercise_ids(versions)
+    for exercise_id in exercise_ids:
+        evaluation_cache.invalidate_exercise(exercise_id)
+        if getattr(settings, "CHECKING_REFERENCE_CACHE", True):
+            transaction.on_commit(
+                lambda exercise_id=exercise_id: rpc_tasks.precache_reference_results.delay(exercise_id, revision.id)
+            )
+
+post_revision_commit.connect(invalidate_file_exercise_caches, dispatch_uid="invalidate_file_exercise_caches_lovelace")
+
+def invalidate_page_caches(sender, revision, versions, **kwargs):
+    """
+    Drops the cached renders of the pages changed in the revision, the pages
+    that embed them and the pages that link the media changed in it.
+    """
+    page_ids = page_cache.get_revision_page_ids(versions)
+    if page_ids:
+        page_cache.invalidate_pages(page_ids)
+
+post_revision_commit.connect(invalidate_page_caches, dispatch_uid="invalidate_page_caches_lovelace")
+
+def remember_link_name(sender, instance, **kwargs):
+    if instance.pk is None or page_cache.get_link_name(instance) is None:
+        return
+    saved = sender._base_manager.filter(pk=instance.pk).first()
+    instance._saved_link_name = page_cache.get_link_name(saved) if saved is not None else None
+
+def invalidate_links_on_save(sender, instance, created, **kwargs):
+    """
+    Drops the cached renders of all pages when a page or a media file is
+    created or the name links refer to it by changes, since the rendered
+    links show whether their targets exist.
+    """
+    link_name = page_cache.get_link_name(instance)
+    if link_name is None:
+        return
+    if created or getattr(instance, "_saved_link_name", None) != link_name:
+        page_cache.invalidate_links()
+
+def invalidate_links_on_delete(sender, instance, **kwargs):
+    if page_cache.get_link_name(instance) is not None:
+        page_cache.invalidate_links()
+
+pre_save.connect(remember_link_name, dispatch_uid="remember_link_name_lovelace")
+post_save.connect(invalidate_links_on_save, dispatch_uid="invalidate_links_on_save_lovelace")
+post_delete.connect(invalidate_links_on_delete, dispatch_uid="invalidate_links_on_delete_lovelace")
+
 class InvalidExerciseAnswerException(Exception):
     """
     This exception is cast when an exercise answer cannot be processed.
@@ -0,0 +1,146 @@
+"""
+Caching of rendered content pages.
+
+Rendering a page with MarkupParser is split in two. The static part, which
+is the same for every user, is rendered once per page, revision, course
+instance and language and stored in the Django cache. The parts that depend
+on the user, i.e. embedded pages with the user's answers and calendars with
+their reservations, are left as placeholders in the static part and rendered
+for each request (see markupparser.DynamicParts).
+
+Every page has a cache generation like the file upload exercises of
+evaluation_cache. Committing a reversion revision that changes a page or a
+media file starts a new generation for the page, the pages that embed it and
+the pages that link the media file. Freezing or saving a visible course
+instance renders the pages of the instance in advance.
+
+The rendered links show whether their targets exist, so there is also a link
+generation shared by all the pages. Creating or deleting a page or a media
+file, or changing the name links refer to it by, starts a new one. Entries
+expire after PAGE_RENDER_CACHE_TIMEOUT in any case.
+"""
+
+import uuid
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.utils import translation
+
+from courses import models as cm
+
+# The context given to the markup parser when rendering the static part
+STATIC_CONTEXT_KEYS = ("course", "course_slug", "instance", "instance_slug")
+
+
+def get_page_generation(page_id):
+    key = "rendered_page_gen_{}".format(page_id)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        cache.set(key, generation, timeout=None)
+    return generation
+
+def get_link_generation():
+    generation = cache.get("rendered_page_links_gen")
+    if generation is None:
+        generation = uuid.uuid4().hex
+        cache.set("rendered_page_links_gen", generation, timeout=None)
+    return generation
+
+def get_cache_key(page_id, revision, instance_id, lang_code):
+    return "rendered_page_{page}_{revision}_{instance}_{lang}_{generation}_{links}".format(
+        page=page_id,
+        revision=revision,
+        instance=instance_id,
+        lang=lang_code,
+        generation=get_page_generation(page_id),
+        links=get_link_generation(),
+    )
+
+def get_rendered(key):
+    """
+    Returns the cached static part of a page and its dynamic parts, or None.
+    """
+    if not getattr(django_settings, "PAGE_RENDER_CACHE", True):
+        return None
+    return cache.get(key)
+
+def save_rendered(key, rendered):
+    if not getattr(django_settings, "PAGE_RENDER_CACHE", True):
+        return
+    cache.set(key, rendered, timeout=getattr(django_settings, "PAGE_RENDER_CACHE_TIMEOUT", 60 * 60 * 24))
+
+def invalidate_pages(page_ids):
+    """
+    Starts a new generation for the pages and the pages embedding them,
+    directly or through other embedded pages.
+    """
+    affected = set(page_ids)
+    children = set(affected)
+    while children:
+        parents = set(cm.EmbeddedLink.objects.filter(
+            embedded_page__in=children
+        ).values_list("parent_id", flat=True))
+        parents.discard(None)
+        children = parents - affected
+        affected |= children
+    for page_id in affected:
+        cache.set("rendered_page_gen_{}".format(page_id), uuid.uuid4().hex, timeout=None)
+
+def invalidate_links():
+    """
+    Starts a new link generation, which drops the cached renders of all the
+    pages.
+    """
+    cache.set("rendered_page_links_gen", uuid.uuid4().hex, timeout=None)
+
+def get_link_name(obj):
+    """
+    Returns the name links in content refer to obj by if it is a page or a
+    media file, or None if it is neither.
+    """
+    if isinstance(obj, cm.ContentPage):
+        return obj.slug
+    if isinstance(obj, cm.CourseMedia):
+        return obj.name
+    return None
+
+def get_revision_page_ids(versions):
+    """
+    Finds out which pages are affected by the objects saved in a reversion
+    revision.
+    """
+    page_ids = set()
+    media_ids = set()
+    for version in versions:
+        model = version.content_type.model_class()
+        if model is None:
+            continue
+        if issubclass(model, cm.ContentPage):
+            page_ids.add(int(version.object_id))
+        elif issubclass(model, cm.CourseMedia):
+            media_ids.add(int(version.object_id))
+    if media_ids:
+        page_ids.update(cm.CourseMediaLink.objects.filter(
+            media__in=media_ids
+        ).values_list("parent_id", flat=True))
+    page_ids.discard(None)
+    return page_ids
+
+def warm_instance(instance):
+    """
+    Renders the static parts of all the pages of a course instance in every
+    language, unless they are cached already.
+    """
+    links = cm.ContentGraph.objects.filter(instance=instance).select_related("content")
+    for link in links:
+        page = link.content
+        for lang_code, name in django_settings.LANGUAGES:
+            with translation.override(lang_code):
+                context = {
+                    "course": instance.course,
+                    "course_slug": instance.course.slug,
+                    "instance": instance,
+                    "instance_slug": instance.slug,
+                }
+                page.get_static_markup(context, link.revision)
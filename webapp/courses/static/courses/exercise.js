@@ -153,7 +153,10 @@ function exercise_success(data, result_div, error_div, form_parent) {
                             '/' + total + '</progress>');
         }
     }
-    if (data.redirect) {
+    if (data.stream && window.EventSource) {
+        var context = result_div.parent();
+        stream_progress(data.stream, data.redirect, context);
+    } else if (data.redirect) {
         var context = result_div.parent();
         poll_progress(data.redirect, context);
     }
@@ -192,6 +195,36 @@ function poll_progress(url, context) {
     }, 100);
 }
 
+// Receives the progress of the checking as server-sent events. Falls back to
+// long-polling the progress url if the stream is cut before the evaluation.
+function stream_progress(stream_url, poll_url, context) {
+    var source = new EventSource(stream_url);
+    var result_div = context.children("div.result");
+    var error_div = context.children("div.error");
+    source.onmessage = function(event) {
+        var data = JSON.parse(event.data);
+        if (data.evaluation_url) {
+            source.close();
+            $.ajax({
+                url: data.evaluation_url,
+                context: context,
+                success: function(data, text_status, jqxhr_obj) {
+                    exercise_success(data, result_div, error_div, $(this));
+                },
+                error: function(xhr, status, type) {
+                    exercise_error(status, type, error_div, $(this));
+                }
+            });
+        } else {
+            exercise_success({metadata: data.metadata}, result_div, error_div, context);
+        }
+    };
+    source.onerror = function(event) {
+        source.close();
+        poll_progress(poll_url, context);
+    };
+}
+
 // TODO: WebSockets – migrate to Django Channels
 
 // http://stackoverflow.com/questions/7335780/how-to-post-a-django-form-with-ajax-jquery
@@ -231,7 +264,12 @@ function add_exercise_form_callbacks() {
                 },
                 error: function(xhr, status, type) {
                     submit_element.prop("disabled", false);
-                    exercise_error(status, type, error_div, form_parent);
+                    if (xhr.status == 429 && xhr.responseJSON) {
+                        // Rejected by the submission rate limit
+                        exercise_success(xhr.responseJSON, result_div, error_div, form_parent);
+                    } else {
+                        exercise_error(status, type, error_div, form_parent);
+                    }
                 }
             });
         });
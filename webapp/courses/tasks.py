@@ -6,10 +6,14 @@ replace exercises.
 from __future__ import absolute_import
 
 import random
+import uuid
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from itertools import chain as iterchain
 
 from django.db import IntegrityError, transaction
+from django.db import connection as db_connection
+from django.db.models import Q
 from django.utils import translation
 from django.conf import settings as django_settings
 from django.contrib.auth.models import User
@@ -17,8 +21,6 @@ from django.contrib.auth.models import User
 from reversion import revisions as reversion
 from reversion.models import Version
 
-import redis
-
 import json
 
 # Result generation dependencies
@@ -40,6 +42,7 @@ import resource
 import subprocess
 
 from celery import shared_task, chain, group
+from celery.signals import task_postrun
 
 # The test data
 #from courses.models import FileExerciseTest, FileExerciseTestStage,\
@@ -56,6 +59,17 @@ from celery import shared_task, chain, group
 
 from courses import models as cm
 from courses import evaluation_sec as sec
+from courses import evaluation_cache
+from courses import evaluation_diff
+from courses import evaluation_plan
+from courses import evaluation_progress
+from courses import evaluation_queue
+from courses import evaluation_runner
+from courses import evaluation_storage
+from courses import evaluation_store
+from courses import evaluation_timing
+from courses import evaluation_workspace
+from courses import page_cache
 from courses.evaluation_utils import *
 
 # TODO: Improve by following the guidelines here:
@@ -67,6 +81,9 @@ JSON_INFO = 2
 JSON_ERROR = 3
 JSON_DEBUG = 4
 
+# Appended to output that was cut at CHECKING_OUTPUT_MAX_BYTES
+OUTPUT_TRUNCATED_MARKER = "\n[Output truncated after {} bytes]"
+
 @shared_task(name="add")
 def add(a, b):
     """
@@ -75,8 +92,17 @@ def add(a, b):
     
     return a+b
 
+def report_progress(task, current, total):
+    """
+    Updates the progress of a checking task both in the Celery result backend
+    and in the task's progress channel.
+    """
+    meta = {"current": current, "total": total}
+    task.update_state(state="PROGRESS", meta=meta)
+    evaluation_progress.publish_progress(task.request.id, "PROGRESS", meta)
+
 @shared_task(name="courses.run-fileexercise-tests", bind=True)
-def run_tests(self, user_id, instance_id, exercise_id, answer_id, lang_code, revision):
+def run_tests(self, user_id, instance_id, exercise_id, answer_id, lang_code, revision, queued_at=None):
     # TODO: Actually, just receive the relevant ids for fetching the Django
     #       models here instead of in the Django view.
     # http://celery.readthedocs.org/en/latest/userguide/tasks.html#database-transactions
@@ -100,45 +126,114 @@ def run_tests(self, user_id, instance_id, exercise_id, answer_id, lang_code, rev
     #       - readable file
     #       - as command line parameters!
     #       - in env?
+    # A newer answer from the same user may have replaced this one
+    if not evaluation_queue.claim_task(self.request.id):
+        print("Skipping superseded checking task {}".format(self.request.id))
+        return
+
+    if queued_at is not None:
+        evaluation_queue.record_queue_wait(queued_at, (self.request.delivery_info or {}).get("priority"))
+
     translation.activate(lang_code)
 
-    try:
-        exercise_object = cm.FileUploadExercise.objects.get(id=exercise_id)
+    # See evaluation_timing for the phases
+    timer = evaluation_timing.PhaseTimer()
 
-        if revision is not None:
-            old_exercise_object = Version.objects.get_for_object(exercise_object).get(revision=revision)._object_version.object
-            exercise_object = old_exercise_object
-    except cm.FileUploadExercise.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
+    with timer.phase("lookup"):
+        try:
+            exercise_object = cm.FileUploadExercise.objects.get(id=exercise_id)
 
-    self.update_state(state="PROGRESS", meta={"current":4, "total":10})
-    user_object = User.objects.get(id=user_id)
-    print("user: %s" % (user_object.username))
-    
-    # Get the test data
-    # TODO: Use prefetch_related?
-    
-    #tests = cm.FileExerciseTest.objects.filter(exercise=exercise_id)
-    tests = exercise_object.fileexercisetest_set.all()
+            if revision is not None:
+                old_exercise_object = Version.objects.get_for_object(exercise_object).get(revision=revision)._object_version.object
+                exercise_object = old_exercise_object
+        except cm.FileUploadExercise.DoesNotExist as e:
+            # TODO: Log weird request
+            return # TODO: Find a way to signal the failure to the user
 
-    student_results = {}
-    reference_results = {}
-    
-    # Run all the tests for both the returned and reference code
-    for i, test in enumerate(tests):
-        self.update_state(state="PROGRESS", meta={"current": i, "total": len(tests)})
+        report_progress(self, 4, 10)
+        user_object = User.objects.get(id=user_id)
+        print("user: %s" % (user_object.username))
+
+        try:
+            answer_object = cm.UserFileUploadExerciseAnswer.objects.get(id=answer_id)
+        except cm.UserFileUploadExerciseAnswer.DoesNotExist as e:
+            # TODO: Log weird request
+            return # TODO: Find a way to signal the failure to the user
+
+    # Note: requires a shared/cloned file system!
+    with timer.phase("files"):
+        student_files = answer_object.get_returned_files_raw()
+
+    with timer.phase("plan"):
+        # Get the test data
+        plan = evaluation_plan.get_test_plan(exercise_id, instance_id, revision)
+        tests = plan["tests"]
+
+        # Reference results that have already been computed for this revision
+        reference_key = None
+        cached_reference = {}
+        if getattr(django_settings, "CHECKING_REFERENCE_CACHE", True):
+            reference_key = evaluation_cache.get_reference_cache_key(plan)
+            cached_reference = evaluation_cache.get_reference_results(reference_key)
+        new_reference = {}
+
+    max_runs = get_max_concurrent_runs()
+    concurrent_pairs = getattr(django_settings, "CHECKING_CONCURRENT_PAIRS", False)
+
+    # Stages shared by the tests, e.g. compiling the returned sources, are
+    # only run once per submission
+    stage_cache = None
+    if getattr(django_settings, "CHECKING_STAGE_CACHE", True):
+        stage_cache = evaluation_workspace.StageCache(
+            getattr(django_settings, "CHECKING_WORKSPACE_ROOT", "/tmp")
+        )
 
-        # TODO: The student's code can be run in parallel with the reference
-        results, all_json = run_test(test.id, answer_id, instance_id, exercise_id, student=True, revision=revision)
-        student_results.update(results)
+    tests_start = time.perf_counter()
+    try:
+        if max_runs > 1:
+            student_results, reference_results = run_tests_concurrently(
+                self, tests, answer_id, instance_id, exercise_id, lang_code, revision,
+                max_runs, concurrent_pairs, cached_reference, new_reference, student_files, stage_cache
+            )
+        else:
+            student_results = {}
+            reference_results = {}
 
-        if not all_json:
-            results, all_json = run_test(test.id, answer_id, instance_id, exercise_id, revision=revision)
+            # Run all the tests for both the returned and reference code
+            for i, test in enumerate(tests):
+                report_progress(self, i, len(tests))
 
-        # if reference is not needed just put the student results there
-        # TODO: change generate results to not depend on reference existing
-        reference_results.update(results)
+                results, all_json = run_test(test["id"], answer_id, instance_id, exercise_id, student=True,
+                                             revision=revision, student_files=student_files,
+                                             stage_cache=stage_cache)
+                student_results.update(results)
+
+                if not all_json:
+                    if test["id"] in cached_reference:
+                        results = cached_reference[test["id"]]
+                    else:
+                        results, all_json = run_test(test["id"], answer_id, instance_id, exercise_id, revision=revision,
+                                                     stage_cache=stage_cache)
+                        new_reference[test["id"]] = results
+
+                # if reference is not needed just put the student results there
+                # TODO: change generate results to not depend on reference existing
+                reference_results.update(results)
+    finally:
+        if stage_cache is not None:
+            print("Stage cache: {} hits, {} misses".format(stage_cache.hits, stage_cache.misses))
+            stage_cache.clear()
+
+    if reference_key is not None and new_reference:
+        cached_reference.update(new_reference)
+        evaluation_cache.save_reference_results(reference_key, cached_reference)
+    timer.add("tests", time.perf_counter() - tests_start)
+    # The reference results are stored per test like the results of run_test
+    reference_runs = {k: v for results in new_reference.values() for k, v in results.items()}
+    for test_results in (student_results, reference_runs):
+        setup, execution = evaluation_timing.sum_test_times(test_results)
+        timer.add("setup", setup)
+        timer.add("execution", execution)
 
     #print(student_results.items())
     #print(reference_results.items())
@@ -149,30 +244,34 @@ def run_tests(self, user_id, instance_id, exercise_id, answer_id, lang_code, rev
     # Ultimate encoding: http://en.wikipedia.org/wiki/Code_page_437
     # Determine the result and generate JSON accordingly
     # TODO: Do this concurrently, interleaved with the actual test running!
-    evaluation = generate_results(results, exercise_id)
+    with timer.phase("results"):
+        evaluation = generate_results(results, exercise_id)
+
+    with timer.phase("serialize"):
+        evaluation_json = json.dumps(evaluation)
 
     # Save the rendered results into Redis
     task_id = self.request.id
-    r = redis.StrictRedis(**django_settings.REDIS_RESULT_CONFIG)
-    r.set(task_id, json.dumps(evaluation), ex=django_settings.REDIS_RESULT_EXPIRE)
+    with timer.phase("store"):
+        evaluation_store.set_result(task_id, evaluation_json)
 
     # Save the results to database
-    result_string = json.dumps(results)
     correct = evaluation["correct"]
     points = exercise_object.default_points
     
-    evaluation_obj = cm.Evaluation(test_results=result_string,
-                                   points=points,
-                                   correct=correct)
-    evaluation_obj.save()
-    
-    try:
-        answer_object = cm.UserFileUploadExerciseAnswer.objects.get(id=answer_id)
-    except cm.UserFileUploadExerciseAnswer.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
-    answer_object.evaluation = evaluation_obj
-    answer_object.save()
+    with timer.phase("save"):
+        evaluation_obj = cm.Evaluation(points=points,
+                                       correct=correct)
+        evaluation_storage.store_results(evaluation_obj, results)
+        evaluation_obj.timings = json.dumps(timer.as_dict())
+        evaluation_obj.save()
+        
+        answer_object.evaluation = evaluation_obj
+        answer_object.save()
+
+    timings = timer.as_dict()
+    print("Checking phases: " + ", ".join("{} {:.3f} s".format(name, seconds) for name, seconds in timings.items()))
+    evaluation_timing.record_timings(exercise_id, timings)
 
     return evaluation_obj.id
     
@@ -181,6 +280,161 @@ def run_tests(self, user_id, instance_id, exercise_id, answer_id, lang_code, rev
     # - save the results directly into db? (is this worker contained enough?)
     # - send the results to a more privileged Celery worker for saving into db?
 
+@task_postrun.connect(sender=run_tests)
+def publish_checking_result(sender=None, task_id=None, retval=None, state=None, **kwargs):
+    """
+    Publishes the final message to the progress channel of a checking task,
+    whether the task succeeded, returned early or failed.
+    """
+    if evaluation_queue.is_superseded(task_id):
+        # The SUPERSEDED message has already been published
+        return
+    evaluation_id = retval if state == "SUCCESS" else None
+    evaluation_progress.publish_progress(task_id, state, evaluation_id=evaluation_id)
+
+def check_duplicate_answer(answer_object, revision):
+    """
+    Computes the submission hash of a file upload exercise answer and looks
+    for an earlier evaluation of the same files for the same exercise revision
+    and instance. If there is one, a copy of it is saved as the evaluation of
+    the answer without running any tests, and published as the final progress
+    message of a new task id. The progress views then handle it like any
+    finished checking task.
+
+    Returns the task id, or None if the answer has to be checked.
+    """
+    plan = evaluation_plan.get_test_plan(answer_object.exercise_id, answer_object.instance_id, revision)
+    student_files = answer_object.get_returned_files_raw()
+    answer_object.content_hash = evaluation_cache.compute_submission_hash(plan, student_files)
+    answer_object.save(update_fields=["content_hash"])
+
+    if not getattr(django_settings, "CHECKING_DUPLICATE_SHORTCUT", True):
+        return None
+
+    earlier = evaluation_cache.find_duplicate_evaluation(answer_object)
+    evaluation_cache.count_duplicate_lookup(earlier is not None)
+    if earlier is None:
+        return None
+
+    evaluation_obj = cm.Evaluation(points=earlier.points,
+                                   correct=earlier.correct)
+    evaluation_storage.copy_results(earlier, evaluation_obj)
+    evaluation_obj.save()
+
+    answer_object.evaluation = evaluation_obj
+    answer_object.save(update_fields=["evaluation"])
+
+    task_id = str(uuid.uuid4())
+    evaluation_progress.publish_progress(task_id, "SUCCESS", evaluation_id=evaluation_obj.id)
+    return task_id
+
+def _run_test_in_thread(lang_code, *args, **kwargs):
+    """
+    Runs one test in a thread of the concurrent checking pool. The active
+    translation and the database connection are both thread local, so the
+    language has to be activated again and the connection Django opened for
+    this thread must be closed when the test is done.
+    """
+    translation.activate(lang_code)
+    try:
+        return run_test(*args, **kwargs)
+    finally:
+        db_connection.close()
+
+_serial_fallback_warned = False
+
+def get_max_concurrent_runs():
+    """
+    Returns how many test runs one checking task may run at the same time.
+    Forking the commands with a preexec_fn from several threads of the worker
+    is not safe, so concurrent runs require the sandbox runner service and
+    the tests are run one after another without it.
+    """
+    global _serial_fallback_warned
+
+    max_runs = getattr(django_settings, "CHECKING_MAX_CONCURRENT_RUNS", 1)
+    if max_runs > 1 and not getattr(django_settings, "CHECKING_RUNNER_SOCKET", None):
+        if not _serial_fallback_warned:
+            print("CHECKING_MAX_CONCURRENT_RUNS is {} but CHECKING_RUNNER_SOCKET is not set, "
+                  "running the tests one at a time".format(max_runs))
+            _serial_fallback_warned = True
+        return 1
+    return max_runs
+
+def run_tests_concurrently(task, tests, answer_id, instance_id, exercise_id, lang_code, revision,
+                           max_runs, concurrent_pairs=False, cached_reference=None, new_reference=None,
+                           student_files=None, stage_cache=None):
+    """
+    Runs the tests of a file exercise in a pool of at most max_runs threads.
+    The sandboxed processes do the actual work, so the threads mostly just
+    wait for them.
+
+    The reference run of a test is normally started only after the student's
+    run has shown that the test doesn't consist of JSON output only. If
+    concurrent_pairs is set, the reference is started at the same time as the
+    student's run and thrown away if it turns out to be unnecessary.
+
+    Reference results found in cached_reference are used instead of running
+    the reference, and the reference runs that had to be made are added to
+    new_reference. The threads share the stage_cache of the submission.
+
+    Returns the student and reference results in the same form as the serial
+    loop in run_tests.
+    """
+    if cached_reference is None:
+        cached_reference = {}
+    if new_reference is None:
+        new_reference = {}
+
+    student_results = {}
+    reference_results = {}
+    total = len(tests)
+    completed = 0
+
+    report_progress(task, 0, total)
+    with ThreadPoolExecutor(max_workers=max_runs) as executor:
+        student_runs = {}
+        reference_runs = {}
+        for test in tests:
+            student_run = executor.submit(
+                _run_test_in_thread, lang_code, test["id"], answer_id, instance_id, exercise_id,
+                student=True, revision=revision, student_files=student_files, stage_cache=stage_cache
+            )
+            student_runs[student_run] = test["id"]
+            if concurrent_pairs and test["id"] not in cached_reference:
+                reference_runs[test["id"]] = executor.submit(
+                    _run_test_in_thread, lang_code, test["id"], answer_id, instance_id, exercise_id,
+                    revision=revision, stage_cache=stage_cache
+                )
+
+        for student_run in as_completed(student_runs):
+            test_id = student_runs[student_run]
+            results, all_json = student_run.result()
+            student_results.update(results)
+
+            if all_json or test_id in cached_reference:
+                # if reference is not needed just put the student results there
+                reference_results.update(results if all_json else cached_reference[test_id])
+                if test_id in reference_runs:
+                    reference_runs.pop(test_id).cancel()
+                completed += 1
+                report_progress(task, completed, total)
+            elif test_id not in reference_runs:
+                reference_runs[test_id] = executor.submit(
+                    _run_test_in_thread, lang_code, test_id, answer_id, instance_id, exercise_id,
+                    revision=revision, stage_cache=stage_cache
+                )
+
+        reference_tests = {reference_run: test_id for test_id, reference_run in reference_runs.items()}
+        for reference_run in as_completed(reference_tests):
+            results, all_json = reference_run.result()
+            reference_results.update(results)
+            new_reference[reference_tests[reference_run]] = results
+            completed += 1
+            report_progress(task, completed, total)
+
+    return student_results, reference_results
+
 def generate_results(results, exercise_id):
     evaluation = {}
     correct = True
@@ -206,6 +460,7 @@ def generate_results(results, exercise_id):
         current_test = {
             "test_id": test_id,
             "name": student_t["name"],
+            "setup_time": student_t.get("setup_time"),
             "correct": True,
             "stages": [],
         }
@@ -306,7 +561,7 @@ def generate_results(results, exercise_id):
                         cmd_correct = False
 
                     if student_stdout or reference_stdout:
-                        stdout_diff = difflib.HtmlDiff().make_table(
+                        stdout_diff = evaluation_diff.make_diff_table(
                             fromlines=student_stdout.splitlines(), tolines=reference_stdout.splitlines(),
                             fromdesc="Your program's output", todesc="Expected output"
                         )
@@ -323,7 +578,7 @@ def generate_results(results, exercise_id):
                         cmd_correct = False
 
                     if student_stderr or reference_stderr:
-                        stderr_diff = difflib.HtmlDiff().make_table(
+                        stderr_diff = evaluation_diff.make_diff_table(
                             fromlines=student_stderr.splitlines(), tolines=reference_stderr.splitlines(),
                             fromdesc="Your program's errors", todesc="Expected errors"
                         )
@@ -346,190 +601,106 @@ def generate_results(results, exercise_id):
     return evaluation
 
 @shared_task(name="courses.run-test", bind=True)
-def run_test(self, test_id, answer_id, instance_id, exercise_id, student=False, revision=None):
+def run_test(self, test_id, answer_id, instance_id, exercise_id, student=False, revision=None,
+             student_files=None, stage_cache=None):
     """
-    Runs all the stages of the given test.
+    Runs all the stages of the given test. Stages that other stages depend on
+    are not run again if they are found in the stage_cache of the submission.
     """
     
     print("Revision:", revision)
-    
-    try:
-        test = cm.FileExerciseTest.objects.get(id=test_id)
 
-        if revision is not None:
-            old_test = Version.objects.get_for_object(test).get(revision=revision)._object_version.object
-            test = old_test
-            
-    except cm.FileExerciseTest.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
-
-    try:
-        #stages = cm.FileExerciseTestStage.objects.filter(test=test_id)
-        stages = test.fileexerciseteststage_set.all()
-        
-        if revision is not None:
-            old_stages = []
-            for stage in stages:
-                try:
-                    Version.objects.get_for_object(stage).get(revision=revision)._object_version.object
-                except Version.DoesNotExist:
-                    pass
-                else:
-                    old_stages.append(stage)
-            stages = old_stages
-            
-    except cm.FileExerciseTestStage.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
-
-    try:
-        # TODO: Fallback file names for those that don't have translations?
-        exercise_file_objects = cm.FileExerciseTestIncludeFile.objects.filter(exercise=exercise_id)
-
-        if revision is not None:
-            old_exercise_file_objects = []
-            
-            for ex_file in exercise_file_objects:
-                try:
-                    old_file = Version.objects.get_for_object(ex_file).get(revision=revision)._object_version.object
-                except Version.DoesNotExist:
-                    pass
-                else:
-                    old_exercise_file_objects.append(old_file)
-            exercise_file_objects = old_exercise_file_objects
-            
-    except cm.FileExerciseTestIncludeFile.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
+    plan = evaluation_plan.get_test_plan(exercise_id, instance_id, revision)
 
     try:
-        # TODO: Fallback file names for those that don't have translations?
-        # PATCH: removed instance from filtering so that checking doesn't break
-        # for cloned instances (while waiting for instance file rework)
-        instance_file_links = cm.InstanceIncludeFileToExerciseLink.objects.filter(
-            exercise=exercise_id
-        )
-
-        #if revision is not None:
-        #    old_instance_file_links = [
-        #        Version.objects.get_for_object(instance_file_link).get(revision=revision)._object_version.object
-        #        for instance_file_link in instance_file_links
-        #        ]
-        #    instance_file_links = old_instance_file_links
-    except cm.InstanceIncludeFileToExerciseLink.DoesNotExist as e:
+        test = evaluation_plan.get_plan_test(plan, test_id)
+    except KeyError as e:
         # TODO: Log weird request
         return # TODO: Find a way to signal the failure to the user
 
     # Note: requires a shared/cloned file system!
     if student:
-        try:
-            answer_object = cm.UserFileUploadExerciseAnswer.objects.get(id=answer_id)
-        except cm.UserFileUploadExerciseAnswer.DoesNotExist as e:
-            # TODO: Log weird request
-            return # TODO: Find a way to signal the failure to the user
-        
-        files_to_check = answer_object.get_returned_files_raw()
+        if student_files is None:
+            try:
+                answer_object = cm.UserFileUploadExerciseAnswer.objects.get(id=answer_id)
+            except cm.UserFileUploadExerciseAnswer.DoesNotExist as e:
+                # TODO: Log weird request
+                return # TODO: Find a way to signal the failure to the user
+            student_files = answer_object.get_returned_files_raw()
+        files_to_check = student_files
         #print("".join("%s:\n%s" % (n, c) for n, c in files_to_check.items()))
     else:
-        files_to_check = {f.file_settings.name: f.get_file_contents()
-                          for f in exercise_file_objects
-                          if f.file_settings.purpose == "REFERENCE"}
+        files_to_check = {plan["files"][key]["name"]: evaluation_plan.read_plan_file(plan, key)
+                          for key in plan["reference_files"]}
         #print("".join("%s:\n%s" % (n, c) for n, c in files_to_check.items()))
 
-    # TODO: Replace with the directory of the ramdisk
-    temp_dir_prefix = os.path.join("/", "tmp")
+    temp_dir_prefix = getattr(django_settings, "CHECKING_WORKSPACE_ROOT", "/tmp")
+    workspace_pool = evaluation_workspace.get_workspace_pool()
 
-    test_results = {test_id: {"fail": True, "name": test.name, "stages": {}}}
-    with tempfile.TemporaryDirectory(dir=temp_dir_prefix) as test_dir:
+    test_results = {test_id: {"fail": True, "name": test["name"], "stages": {}}}
+    setup_start = time.time()
+    test_dir = workspace_pool.acquire(plan, test)
+    try:
         # Write the files under test
-        # Do this first to prevent overwriting of included/instance files
+        # The required files of the test take precedence over files with the
+        # same name, so those are not overwritten
+        required_names = {plan["files"][key]["name"] for key in test["files"]}
         for name, contents in files_to_check.items():
+            if name in required_names:
+                continue
             fpath = os.path.join(test_dir, name)
             with open(fpath, "wb") as fd:
                 fd.write(contents)
             print("Wrote file under test %s" % (fpath))
-            # TODO: chmod, chown, chgrp
-
-        # Write the exercise files required by this test
-        for name, fileinfo, contents in ((f.file_settings.name, f.fileinfo, f.get_file_contents())
-                               for f in exercise_file_objects
-                               if f in test.required_files.all() and
-                               f.file_settings.purpose in ("INPUT", "WRAPPER", "TEST", "LIBRARY")):
-            print(name)
-            fpath = os.path.join(test_dir, name)
-            with open(fpath, "wb") as fd:
-                fd.write(contents)
-            #print("Wrote required exercise file {}".format(fpath))
-            print("Wrote required exercise file {} from {}".format(fpath, fileinfo))
-            # TODO: chmod, chown, chgrp
-
-        for if_link in instance_file_links:
-            if if_link.include_file in test.required_instance_files.all():                
-                settings = if_link.file_settings
-                if settings.purpose in ("INPUT", "WRAPPER", "TEST", "LIBRARY"):
-                    name = settings.name
-                    instance_link = cm.InstanceIncludeFileToInstanceLink.objects.get(include_file=if_link.include_file, instance__id=instance_id)
-                    
-                    if instance_link.revision is None:
-                        file_obj = if_link.include_file
-                    else:
-                        file_obj = Version.objects.get_for_object(if_link.include_file).get(revision=instance_link.revision)._object_version.object
-                        
-                    contents = file_obj.get_file_contents()
-                    fpath = os.path.join(test_dir, name)
-                    
-                    with open(fpath, "wb") as fd:
-                        fd.write(contents)
-                    print("Wrote required instance file {} from {}".format(fpath, file_obj.fileinfo))
+
+        setup_time = time.time() - setup_start
+        test_results[test_id]["setup_time"] = setup_time
+        print("Set up test directory {} in {:.4f} s".format(test_dir, setup_time))
 
         all_json = True
+        cached_stages = evaluation_workspace.cached_stage_ids(test) if stage_cache is not None else set()
 
         # TODO: Replace with chaining
-        for i, stage in enumerate(stages):
+        for i, stage in enumerate(test["stages"]):
             #self.update_state(state="PROGRESS",
                               #meta={"current": i, "total": len(stages)})
-            stage_results, stage_json = run_stage(stage.id, test_dir, temp_dir_prefix,
-                                      list(files_to_check.keys()), revision=revision)
-            test_results[test_id]["stages"][stage.id] = stage_results
-            test_results[test_id]["stages"][stage.id]["name"] = stage.name
-            test_results[test_id]["stages"][stage.id]["ordinal_number"] = stage.ordinal_number
+            if stage["id"] in cached_stages:
+                stage_results, stage_json = stage_cache.run_stage(
+                    stage, test_dir,
+                    lambda: run_stage(stage, test_dir, temp_dir_prefix, list(files_to_check.keys()))
+                )
+            else:
+                stage_results, stage_json = run_stage(stage, test_dir, temp_dir_prefix,
+                                                      list(files_to_check.keys()))
+            test_results[test_id]["stages"][stage["id"]] = stage_results
+            test_results[test_id]["stages"][stage["id"]]["name"] = stage["name"]
+            test_results[test_id]["stages"][stage["id"]]["ordinal_number"] = stage["ordinal_number"]
 
             if not stage_json:
                 all_json = False
 
             if stage_results["fail"] == True:
                 break
-
-            # TODO: Read the directory and save the stage results in cache
-            cache_results = False # TODO: Determine this by looking at dependencies
-            if cache_results == True:
-                test_dir_contents = os.listdir(test_dir)
-                for fp in test_dir_contents:
-                    with open(fp, "rb") as fd:
-                        contents = fd.read()
         else:
             test_results[test_id]["fail"] = False
 
         # TODO: Read the expected output files (check the cache first?)
         test_dir_contents = os.listdir(test_dir)
+    finally:
+        workspace_pool.release(test_dir)
 
     return test_results, all_json
 
 @shared_task(name="courses.run-stage", bind=True)
-def run_stage(self, stage_id, test_dir, temp_dir_prefix, files_to_check, revision=None):
+def run_stage(self, stage, test_dir, temp_dir_prefix, files_to_check):
     """
     Runs all the commands of this stage and collects the return values and the
-    outputs.
+    outputs. The stage is a stage dictionary from the test plan.
     """
 
     all_json = True
 
-    try:
-        commands = cm.FileExerciseTestCommand.objects.filter(stage=stage_id)
-    except cm.FileExerciseTestCommand.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
+    commands = stage["commands"]
 
     stage_results = {
         "fail": False,
@@ -537,14 +708,13 @@ def run_stage(self, stage_id, test_dir, temp_dir_prefix, files_to_check, revisio
     }
 
     if len(commands) == 0:
-        return stage_results
+        return stage_results, all_json
 
     # TODO: Use this, but make appropriate changes elsewhere.
     """
     cmd_chain = chain(
         run_command_chainable.s(
-            {"id":cmd.id, "input_text":cmd.input_text, "return_value":cmd.return_value},
-            temp_dir_prefix, test_dir, files_to_check
+            cmd, temp_dir_prefix, test_dir, files_to_check
         )
         for cmd in commands
     )
@@ -558,21 +728,12 @@ def run_stage(self, stage_id, test_dir, temp_dir_prefix, files_to_check, revisio
     """
     # DEBUG #
     for i, cmd in enumerate(commands):
-        if revision is not None:
-            try:
-                old_cmd = Version.objects.get_for_object(cmd).get(revision=revision)._object_version.object
-                cmd = old_cmd
-            except Version.DoesNotExist:
-                return
-            
         results = run_command_chainable(
-            {"id":cmd.id, "input_text":cmd.input_text, "return_value":cmd.return_value},
-            temp_dir_prefix, test_dir, files_to_check, stage_results=stage_results,
-            revision=revision
+            cmd, temp_dir_prefix, test_dir, files_to_check, stage_results=stage_results
         )
         stage_results.update(results)
         
-        if not cmd.json_output:
+        if not cmd["json_output"]:
             all_json = False
 
         if results.get('fail'):
@@ -635,40 +796,28 @@ def run_stage(self, stage_id, test_dir, temp_dir_prefix, files_to_check, revisio
 
 
 @shared_task(name="courses.run-command-chain-block")
-def run_command_chainable(cmd, temp_dir_prefix, test_dir, files_to_check, stage_results=None, revision=None):
+def run_command_chainable(cmd, temp_dir_prefix, test_dir, files_to_check, stage_results=None):
     cmd_id, cmd_input_text, cmd_return_value = cmd["id"], cmd["input_text"], cmd["return_value"]
     if stage_results is None or "commands" not in stage_results.keys():
         stage_results = {"commands": {}}
 
-    stdout = tempfile.TemporaryFile(dir=temp_dir_prefix)
-    stderr = tempfile.TemporaryFile(dir=temp_dir_prefix)
-    stdin = tempfile.TemporaryFile(dir=temp_dir_prefix)
-    stdin.write(bytearray(cmd_input_text, "utf-8"))
-    stdin.seek(0)
-    
-    proc_results = run_command(cmd_id, stdin, stdout, stderr, test_dir, files_to_check, revision=revision)
+    proc_results, read_stdout, read_stderr = run_command(
+        cmd, cmd_input_text.encode("utf-8"), test_dir, files_to_check, temp_dir_prefix
+    )
     
-    stdout.seek(0)
     #proc_results["stdout"] = base64.standard_b64encode(stdout.read()).decode("ASCII")
-    read_stdout = stdout.read()
-    try:
-        proc_results["stdout"] = read_stdout.decode("utf-8")
-        proc_results["binary_stdout"] = False
-    except UnicodeDecodeError as e:
-        proc_results["stdout"] = cp437_decoder(read_stdout)
-        proc_results["binary_stdout"] = True
-    stdout.close()
-
-    stderr.seek(0)
+    proc_results["stdout"], proc_results["binary_stdout"] = decode_output(
+        read_stdout, proc_results["stdout_truncated"]
+    )
+    if proc_results["stdout_truncated"]:
+        proc_results["stdout"] += OUTPUT_TRUNCATED_MARKER.format(len(read_stdout))
+
     #proc_results["stderr"] = base64.standard_b64encode(stderr.read()).decode("ASCII")
-    read_stderr = stderr.read()
-    try:
-        proc_results["stderr"] = read_stderr.decode("utf-8")
-        proc_results["binary_stderr"] = False
-    except UnicodeDecodeError as e:
-        proc_results["stderr"] = cp437_decoder(read_stderr)
-        proc_results["binary_stderr"] = True
-    stderr.close()
+    proc_results["stderr"], proc_results["binary_stderr"] = decode_output(
+        read_stderr, proc_results["stderr_truncated"]
+    )
+    if proc_results["stderr_truncated"]:
+        proc_results["stderr"] += OUTPUT_TRUNCATED_MARKER.format(len(read_stderr))
 
     if proc_results.get('fail'):
         stage_results['fail'] = True
@@ -682,30 +831,26 @@ def run_command_chainable(cmd, temp_dir_prefix, test_dir, files_to_check, stage_
     return stage_results
 
 @shared_task(name="courses.run-command")
-def run_command(cmd_id, stdin, stdout, stderr, test_dir, files_to_check, revision=None):
-    """
-    Runs the current command of this stage by automated fork & exec.
+def run_command(command, stdin, test_dir, files_to_check, temp_dir_prefix=None):
     """
-    
-    try:
-        command = cm.FileExerciseTestCommand.objects.get(id=cmd_id)
+    Runs the current command of this stage by automated fork & exec, either
+    through the sandbox runner service at CHECKING_RUNNER_SOCKET or, if it's
+    not set, in this process. The command is a command dictionary from the
+    test plan and stdin the input bytes given to it.
 
-        if revision is not None:
-            old_command = Version.objects.get_for_object(command).get(revision=revision)._object_version.object
-            command = old_command
-    except cm.FileExerciseTestCommand.DoesNotExist as e:
-        # TODO: Log weird request
-        return # TODO: Find a way to signal the failure to the user
+    Returns the results of the run and the captured stdout and stderr, each
+    of which is cut at CHECKING_OUTPUT_MAX_BYTES.
+    """
 
     # TODO: More codes (e.g., $TRANSLATION)
-    cmd = command.command_line.replace(
+    cmd = command["command_line"].replace(
         "$RETURNABLES",
         " ".join(shlex.quote(f) for f in files_to_check)
     ).replace(
         "$CWD",
         test_dir
     )
-    timeout = command.timeout.total_seconds()
+    timeout = command["timeout"]
     env = { # Remember that some information (like PATH) may come from other sources
         'PWD': test_dir,
         'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
@@ -716,94 +861,143 @@ def run_command(cmd_id, stdin, stdout, stderr, test_dir, files_to_check, revisio
     shell_like_cmd = " ".join(shlex.quote(arg) for arg in args)
 
     proc_results = {
-        'ordinal_number': command.ordinal_number,
-        'expected_retval': command.return_value,
-        'input_text': command.input_text,
-        'significant_stdout': command.significant_stdout,
-        'significant_stderr': command.significant_stderr,
-        'json_output': command.json_output,
+        'ordinal_number': command["ordinal_number"],
+        'expected_retval': command["return_value"],
+        'input_text': command["input_text"],
+        'significant_stdout': command["significant_stdout"],
+        'significant_stderr': command["significant_stderr"],
+        'json_output': command["json_output"],
         'command_line': shell_like_cmd,
     }
     print("Running: {cmdline}".format(cmdline=shell_like_cmd))
 
-    # TODO
-    # If additional resource limits have been provided, generate a customised
-    # process demotion function. Otherwise, use the default.
-    #demote_process = sec.get_demote_process_fun()
-    demote_process = sec.default_demote_process
+    spec = {
+        "args": args,
+        "cwd": env["PWD"],
+        "env": env,
+        "stdin": stdin,
+        "timeout": timeout,
+        "temp_dir": temp_dir_prefix,
+        "limits": {
+            "cgroup_root": getattr(django_settings, "CHECKING_CGROUP_ROOT", None),
+            "memory_max": getattr(django_settings, "CHECKING_CGROUP_MEMORY_MAX", 512 * 1024 ** 2),
+            "pids_max": getattr(django_settings, "CHECKING_CGROUP_PIDS_MAX", 40),
+            "cpu_max": getattr(django_settings, "CHECKING_CGROUP_CPU_MAX", "100000 100000"),
+            "max_output": getattr(django_settings, "CHECKING_OUTPUT_MAX_BYTES", 256 * 1024),
+            "output_limit_kill": getattr(django_settings, "CHECKING_OUTPUT_LIMIT_KILL", False),
+        },
+    }
 
-    start_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
-    start_time = time.time()
+    runner_socket = getattr(django_settings, "CHECKING_RUNNER_SOCKET", None)
     try:
-        proc = subprocess.Popen(
-            args=args, bufsize=-1, executable=None,
-            stdin=stdin, stdout=stdout, stderr=stderr, # Standard fds
-            preexec_fn=demote_process,                 # Demote before fork
-            close_fds=True,                            # Don't inherit fds
-            shell=False,                               # Don't run in shell
-            cwd=env['PWD'], env=env,
-            universal_newlines=False                   # Binary stdout
-        )
-    except (FileNotFoundError, PermissionError) as e:
-        # In case the executable is not found or permission to run the
-        # file didn't exist.
-        
+        if runner_socket:
+            usage, read_stdout, read_stderr = evaluation_runner.request(runner_socket, spec)
+        else:
+            usage, read_stdout, read_stderr = evaluation_runner.execute(spec)
+    except evaluation_runner.RunnerError as e:
+        usage = {"error": str(e)}
+
+    if "error" in usage:
+        # In case the executable is not found, permission to run the file
+        # didn't exist or the runner service is unavailable.
+
         # TODO: Use the proper way to deal with exceptions in Celery tasks
         proc_results.update({
             'retval': None,
             'timedout': False,
             'killed': False,
             'runtime': 0,
-            'error': str(e),
+            'usermodetime': 0,
+            'kernelmodetime': 0,
+            'max_rss': 0,
+            'exit_signal': None,
+            'oom_killed': False,
+            'stdout_truncated': False,
+            'stderr_truncated': False,
+            'output_limit_killed': False,
+            'error': usage["error"],
             'fail': True,
         })
-        return proc_results
-    
-    proc_retval = None
-    proc_timedout = False
-    proc_killed = False
-    
-    try:
-        proc.wait(timeout=timeout)
-        proc_runtime = time.time() - start_time
-        proc_retval = proc.returncode
-    except subprocess.TimeoutExpired:
-        proc_runtime = time.time() - start_time
-        proc_retval = None
-        proc_timedout = True
-        proc.terminate() # Try terminating the process nicely
-        time.sleep(0.5)  # Grace period to allow the process to terminate
-    
-    # TODO: Clean up by halting all action (forking etc.) by the student's process
-    # with SIGSTOP and by killing the frozen processes with SIGKILL
-    #sec.secure_kill()
-    #proc_killed = True
-
-    proc_runtime = proc_runtime or (time.time() - start_time)
-    proc_retval = proc_retval or proc.returncode
-    # Collect statistics on CPU time consumed by the student's process
-    # Consider implementing wait3 and wait4 for subprocess
-    # http://stackoverflow.com/a/7050436/2096560
-    end_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
-    ru_utime = end_rusage.ru_utime - start_rusage.ru_utime
-    ru_stime = end_rusage.ru_stime - start_rusage.ru_stime
+        return proc_results, b"", b""
 
     proc_results.update({
-        'retval': proc_retval,
-        'timedout': proc_timedout,
-        'killed': proc_killed,
-        'runtime': proc_runtime,
-        'usermodetime': ru_utime,
-        'kernelmodetime': ru_stime,
+        'retval': None if usage["timedout"] else usage["returncode"],
+        'timedout': usage["timedout"],
+        'killed': usage["killed"],
+        'runtime': usage["runtime"],
+        'usermodetime': usage["usermodetime"],
+        'kernelmodetime': usage["kernelmodetime"],
+        'max_rss': usage["max_rss"],
+        'exit_signal': usage["exit_signal"],
+        'oom_killed': usage["oom_killed"],
+        'stdout_truncated': usage["stdout_truncated"],
+        'stderr_truncated': usage["stderr_truncated"],
+        'output_limit_killed': usage["stopped"],
     })
+    print("Finished in {runtime:.3f} s (user {usermodetime:.3f} s, system {kernelmodetime:.3f} s), "
+          "max RSS {max_rss} KiB, return value {returncode}, signal {exit_signal}".format(**usage))
     
-    #stdout.seek(0)
-    print("\n".join(l.decode("utf-8") for l in stdout.readlines()))
-    #stderr.seek(0)
-    print("\n".join(l.decode("utf-8") for l in stderr.readlines()))
-    #time.sleep(15)
+    print(read_stdout.decode("utf-8", errors="replace"))
+    print(read_stderr.decode("utf-8", errors="replace"))
+
+    return proc_results, read_stdout, read_stderr
+
+@shared_task(name="courses.precache-reference-results", bind=True)
+def precache_reference_results(self, exercise_id, revision=None):
+    """
+    Runs the reference implementation of a file upload exercise for every
+    course instance that uses the exercise and stores the results in the
+    reference result cache, so that the first answers to a freshly saved
+    exercise don't have to wait for the reference runs.
+    """
+    if not getattr(django_settings, "CHECKING_REFERENCE_CACHE", True):
+        return
+
+    try:
+        exercise = cm.FileUploadExercise.objects.get(id=exercise_id)
+    except cm.FileUploadExercise.DoesNotExist as e:
+        return
+
+    if revision is None:
+        revision = Version.objects.get_for_object(exercise).latest("revision__date_created").revision_id
+
+    # Exercises that only have JSON outputting testers never use the reference
+    if not cm.FileExerciseTestCommand.objects.filter(stage__test__exercise=exercise_id, json_output=False).exists():
+        return
+
+    # Test plans are translated; warm up the cache for the default language
+    translation.activate(django_settings.LANGUAGE_CODE)
+
+    instances = cm.CourseInstance.objects.filter(
+        Q(contentgraph__content=exercise) | Q(contentgraph__content__embedded_pages=exercise)
+    ).distinct()
+    for instance in instances:
+        plan = evaluation_plan.get_test_plan(exercise_id, instance.id, revision)
+        reference_key = evaluation_cache.get_reference_cache_key(plan)
+        cached_reference = evaluation_cache.get_reference_results(reference_key)
+        for test in plan["tests"]:
+            if test["id"] in cached_reference:
+                continue
+            results, all_json = run_test(test["id"], None, instance.id, exercise_id, revision=revision)
+            cached_reference[test["id"]] = results
+        evaluation_cache.save_reference_results(reference_key, cached_reference)
+
+@shared_task(name="courses.warm-page-cache")
+def warm_page_cache(instance_id):
+    """
+    Renders the static parts of the pages of a course instance into the page
+    cache, so that the first visitors of a published instance don't have to
+    wait for the rendering.
+    """
+    if not getattr(django_settings, "PAGE_RENDER_CACHE", True):
+        return
+
+    try:
+        instance = cm.CourseInstance.objects.get(id=instance_id)
+    except cm.CourseInstance.DoesNotExist as e:
+        return
 
-    return proc_results
+    page_cache.warm_instance(instance)
 
 # TODO: Subtask division:
 #       - Run all tests:
@@ -0,0 +1,92 @@
+"""
+Tests for matching given answers against the answer choices of textfield and
+repeated template exercises.
+"""
+
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase, TestCase
+
+from courses import answer_matching
+from courses.models import TextfieldExerciseAnswer
+from courses.tests.testhelpers import create_textfield_exercise
+
+
+def choice(answer, correct=False, regexp=True, hint="", comment=""):
+    return SimpleNamespace(answer=answer, correct=correct, regexp=regexp, hint=hint, comment=comment)
+
+
+class AnswerMatchingTests(SimpleTestCase):
+
+    def test_correct_and_hints(self):
+        matcher = answer_matching.AnswerMatcher([
+            choice(r"^4\s*$", correct=True, comment="Well done"),
+            choice(r"^(?P<number>\d+)$", hint="{number} is not right"),
+            choice("five", regexp=False, hint="Use digits"),
+        ])
+
+        result = matcher.evaluate("4")
+        self.assertTrue(result.correct)
+        self.assertEqual(result.comments, ["Well done"])
+        self.assertEqual(result.hints, ["4 is not right"])
+
+        result = matcher.evaluate("5")
+        self.assertFalse(result.correct)
+        self.assertEqual(result.hints, ["5 is not right"])
+        self.assertTrue(result.hinted)
+
+        result = matcher.evaluate("five")
+        self.assertFalse(result.correct)
+        self.assertEqual(result.hints, ["Use digits"])
+        self.assertEqual([c.answer for c, error in result.matches], ["five"])
+
+    def test_broken_regexp(self):
+        matcher = answer_matching.AnswerMatcher([choice("x", correct=True, regexp=False), choice("(")])
+        result = matcher.evaluate("x")
+        self.assertFalse(result.correct)
+        self.assertEqual(len(result.errors), 1)
+        self.assertEqual(result.matches[1][0].answer, "(")
+        self.assertTrue(result.matches[1][1])
+
+    def test_evaluate_many(self):
+        matcher = answer_matching.AnswerMatcher([choice(r"^a+$", correct=True)])
+        results = matcher.evaluate_many(["a", "aa", "b", "a"])
+        self.assertEqual(set(results.keys()), {"a", "aa", "b"})
+        self.assertTrue(results["aa"].correct)
+        self.assertFalse(results["b"].correct)
+
+    def test_matcher_cache(self):
+        calls = []
+        def get_choices():
+            calls.append(1)
+            return [choice("a", correct=True)]
+
+        first = answer_matching.get_matcher((-1, 1), get_choices)
+        self.assertIs(answer_matching.get_matcher((-1, 1), get_choices), first)
+        self.assertEqual(len(calls), 1)
+        answer_matching.get_matcher((-1, None), get_choices)
+        answer_matching.get_matcher((-1, None), get_choices)
+        self.assertEqual(len(calls), 3)
+
+        answer_matching.invalidate_exercise(-1)
+        self.assertIsNot(answer_matching.get_matcher((-1, 1), get_choices), first)
+        answer_matching.invalidate_exercise(-1)
+
+    def test_choices_generation(self):
+        generation = answer_matching.get_choices_generation(-1)
+        self.assertEqual(answer_matching.get_choices_generation(-1), generation)
+        answer_matching.invalidate_exercise(-1)
+        self.assertNotEqual(answer_matching.get_choices_generation(-1), generation)
+
+
+class CurrentChoicesTests(TestCase):
+
+    def test_current_matcher_cached(self):
+        exercise = create_textfield_exercise()
+        matcher = exercise.get_answer_matcher(None)
+        self.assertIs(exercise.get_answer_matcher(None), matcher)
+        self.assertFalse(matcher.evaluate("other answer").correct)
+
+        TextfieldExerciseAnswer(exercise=exercise, answer="other answer", correct=True).save()
+        matcher = exercise.get_answer_matcher(None)
+        self.assertTrue(matcher.evaluate("other answer").correct)
@@ -0,0 +1,85 @@
+"""
+Tests that the single-pass inline markup parser produces the same HTML as the
+multi-pass parser it replaced.
+"""
+
+import random
+
+from django.test import TestCase
+
+from courses import blockparser
+from courses import markupparser
+from courses.tests.testhelpers import *
+
+GOLDEN = [
+    ("Some ''more'' text here",
+     "Some <em>more</em> text here"),
+    ("'''Even more''' text here",
+     "<strong>Even more</strong> text here"),
+    ("There's also a [[https://docs.python.org/3/|link to Python 3 documentation]]",
+     "There's also a <a href=\"https://docs.python.org/3/\" target=\"_blank\">link to Python 3 documentation</a>"),
+    ("And a [!hint=sample-highlight!]triggerable highlight[!hint!]",
+     "And a <mark class=\"hint-inactive\" id=\"hint-id-sample-highlight\">triggerable highlight</mark>"),
+    ("Press `{enter}` or !!!this!!! {{{x = 1}}}",
+     "Press <kbd>↵ Enter</kbd> or <mark>this</mark> <code>x = 1</code>"),
+    ("'''''bold italic''''' and '''bold ''italic'' inside'''",
+     "<strong><em>bold italic</em></strong> and <strong>bold <em>italic</em> inside</strong>"),
+]
+
+# Markup that makes up the blocks of the random comparison
+ATOMS = [
+    "'", "''", "'''", "{{{", "}}}", "{{{#!python ", "!!!", "!", "`", "[[", "]]", "|",
+    "[!hint=h!]", "[!hint!]", "[!term=t!]", "[!term!]", "a", "b c", "{enter}",
+    "http://example.com", " ", "[", "]", "{", "}",
+]
+
+
+class BlockParserTests(TestCase):
+
+    def assertSameAsMultipass(self, block):
+        self.assertEqual(
+            blockparser.parseblock(block),
+            blockparser.parseblock_multipass(block),
+            "different HTML for {!r}".format(block)
+        )
+
+    def test_golden_output(self):
+        for block, html in GOLDEN:
+            self.assertEqual(blockparser.parseblock(block), html)
+            self.assertEqual(blockparser.parseblock_multipass(block), html)
+
+    def test_course_content(self):
+        for content in (plain_content, media_content):
+            for line in content.splitlines():
+                self.assertSameAsMultipass(line)
+
+    def test_random_markup(self):
+        rng = random.Random(0)
+        for _ in range(5000):
+            block = "".join(rng.choice(ATOMS) for _ in range(rng.randint(1, 12)))
+            self.assertSameAsMultipass(block)
+
+    def test_tokenizer_fallback(self):
+        self.assertIsNotNone(blockparser.tokenize("'''bold''' and ''italic''"))
+        self.assertIsNone(blockparser.tokenize("'''bold ''italic'' inside'''"))
+        self.assertIsNone(blockparser.tokenize("unfinished ''italic"))
+
+
+class LinkLookupTests(TestCase):
+
+    def test_links_resolved_together(self):
+        course, instance = create_course_with_instance()
+        create_frontpage()
+        create_plain_page()
+        text = "\n".join([
+            "A link to the [[front-page]] and [[plain-lecture-page|the plain page]].",
+            "",
+            "* [[front-page|Again]] in a list",
+            "A [[missing-page]] and an [[https://example.com|external link]].",
+        ])
+        context = {"course": course, "instance": instance}
+
+        with self.assertNumQueries(1):
+            html = "".join(markupparser.MarkupParser.parse(text, None, context))
+        self.assertEqual(html.count("BROKEN LINK"), 1)
+        self.assertEqual(html.count("href=\"https://example.com\""), 1)
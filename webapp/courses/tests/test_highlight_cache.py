@@ -0,0 +1,48 @@
+"""
+Tests for the cache of syntax highlighted code and files.
+"""
+
+import os
+import tempfile
+
+import pygments
+import pygments.lexers
+from pygments.formatters import HtmlFormatter
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from courses import highlight_cache
+
+CODE = "for i in range(3):\n    print(i)\n"
+
+
+class HighlightCacheTests(SimpleTestCase):
+
+    def test_code_cached(self):
+        expected = pygments.highlight(CODE, pygments.lexers.get_lexer_by_name("python"), HtmlFormatter(nowrap=True))
+        self.assertEqual(highlight_cache.highlight(CODE, "python", nowrap=True), expected)
+
+        key = highlight_cache._get_cache_key("code", CODE, "python", {"nowrap": True})
+        self.assertEqual(cache.get(key), expected)
+        cache.set(key, "cached")
+        self.assertEqual(highlight_cache.highlight(CODE, "python", nowrap=True), "cached")
+        self.assertEqual(highlight_cache.highlight(CODE, "python3", nowrap=True), expected)
+        cache.delete(key)
+
+    def test_unknown_lexer(self):
+        with self.assertRaises(pygments.util.ClassNotFound):
+            highlight_cache.highlight(CODE, "no-such-language", nowrap=True)
+
+    def test_file_cached_until_changed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "example.py")
+            with open(path, "w") as f:
+                f.write(CODE)
+
+            first = highlight_cache.highlight_file(path, nowrap=True)
+            self.assertIn("print", first)
+            with open(path, "w") as f:
+                f.write("x")
+            os.utime(path, ns=(0, 0))
+            self.assertNotEqual(highlight_cache.highlight_file(path, nowrap=True), first)
@@ -0,0 +1,53 @@
+"""
+Tests for splitting documents into lines as they are parsed.
+"""
+
+import io
+import random
+
+from django.test import SimpleTestCase
+
+from courses import markupparser
+
+DOCUMENT = "\r\n".join([
+    "= Heading =",
+    "",
+    "Some ''text'' on",
+    "two lines",
+    "* a list item",
+    "** an indented one",
+    "|| a || table ||",
+    "",
+    "The end",
+])
+
+
+class LineStreamingTests(SimpleTestCase):
+
+    def test_lines_like_split(self):
+        rng = random.Random(0)
+        for line_break in (markupparser.line_break_re, markupparser.link_line_break_re):
+            for _ in range(2000):
+                text = "".join(rng.choice(["a", " ", "\r", "\n", "\r\n", "\n\r"]) for _ in range(rng.randint(0, 12)))
+                expected = line_break.split(text)
+                self.assertEqual(list(markupparser.iter_lines(text, line_break)), expected)
+
+                cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, 3)))
+                chunks = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+                self.assertEqual(list(markupparser.iter_lines(iter(chunks), line_break)), expected)
+
+    def test_parse_streamed_document(self):
+        expected = "".join(markupparser.MarkupParser.parse(DOCUMENT))
+        stream = io.StringIO(DOCUMENT, newline="")
+        self.assertEqual("".join(markupparser.MarkupParser.parse(stream)), expected)
+
+    def test_lines_read_lazily(self):
+        read = []
+        def chunks():
+            for line in DOCUMENT.splitlines(True):
+                read.append(line)
+                yield line
+
+        blocks = markupparser.MarkupParser.parse(chunks())
+        self.assertIn("<h1", next(blocks))
+        self.assertLess(len(read), len(DOCUMENT.splitlines()))
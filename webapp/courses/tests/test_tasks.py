@@ -2,13 +2,30 @@ import datetime
 import json
 import redis
 import shutil
+import subprocess
+import tempfile
 import time
+import zlib
 from django.core import files
+from django.core.cache import cache
 from django.conf import settings
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import translation
 from courses.models import *
-from courses.tasks import add, run_tests
+from courses.tasks import add, run_tests, run_test, check_duplicate_answer, get_max_concurrent_runs
+from courses import evaluation_cache
+from courses import evaluation_diff
+from courses import evaluation_plan
+from courses import evaluation_progress
+from courses import evaluation_queue
+from courses import evaluation_runner
+from courses import evaluation_storage
+from courses import evaluation_store
+from courses import evaluation_timing
+from courses import evaluation_workspace
+from courses import views
 from courses.tests.testhelpers import *
 from reversion import revisions as reversion
 
@@ -61,6 +78,10 @@ def answer():
     return "{answer}"
 """
 
+TEST_ANSWER_STDOUT = """
+print("{answer}")
+"""
+
 TEST_ANSWER_EXC = """
 def answer():
     raise RunTimeError
@@ -77,6 +98,12 @@ def answer():
     print("imma bork you")
 """
 
+TEST_ANSWER_PRINTS_LOTS = """
+def answer():
+    for i in range(10000):
+        print("imma bork you")
+"""
+
 
 
 class TaskTimeoutError(Exception):
@@ -131,6 +158,53 @@ def create_answerable_exercise():
     
     return exercise, revision
 
+def create_stdout_exercise():
+    """
+    Creates a file upload exercise whose test compares the stdout of the
+    answer to that of the reference instead of using a JSON checker.
+    """
+    with reversion.create_revision():
+        exercise = FileUploadExercise(
+            name="stdout file upload exercise",
+            content="some content",
+            default_points=1,
+        )
+        exercise.save()
+
+        file_settings = IncludeFileSettings()
+        file_settings.name = "test_answer.py"
+        file_settings.purpose = "REFERENCE"
+        file_settings.save()
+
+        reference = FileExerciseTestIncludeFile()
+        reference.exercise = exercise
+        reference.default_name = "test_answer.py"
+        reference.fileinfo = files.base.ContentFile(TEST_ANSWER_STDOUT.format(answer="correct"), "test_answer.py")
+        reference.file_settings = file_settings
+        reference.save()
+
+        test = FileExerciseTest()
+        test.exercise = exercise
+        test.name = "stdout test"
+        test.save()
+
+        stage = FileExerciseTestStage()
+        stage.test = test
+        stage.name = "stdout test stage"
+        stage.ordinal_number = 1
+        stage.save()
+
+        command = FileExerciseTestCommand()
+        command.stage = stage
+        command.command_line = "python3 test_answer.py"
+        command.significant_stdout = True
+        command.ordinal_number = 1
+        command.save()
+
+    revision = Version.objects.get_for_object(exercise).latest("revision__date_created").revision_id
+
+    return exercise, revision
+
 def create_answerable_file_upload_exercise_page(exercise):
     page = Lecture(
         name="answerable upload exercise page",
@@ -220,11 +294,11 @@ class TaskTests(TestCase):
         task = add.s(1, 1).apply()
         self.assertEqual(task.result, 2)
 
-    def _submit_file_upload_answer(self, answer_id):
+    def _submit_file_upload_answer(self, answer_id, exercise=None):
         result = run_tests.s(
             user_id=self.user.id,
             instance_id=self.instance.id,
-            exercise_id=self.exercise.id,
+            exercise_id=(exercise or self.exercise).id,
             answer_id=answer_id,
             lang_code=translation.get_language(),
             revision=None
@@ -243,6 +317,21 @@ class TaskTests(TestCase):
         log = result_json["test_tree"]["log"]
         self.assertEqual(log[0]["runs"][0]["output"][0]["flag"], 1)
 
+    def test_file_upload_answering_stdout(self):
+        """
+        Tests checking answers to a test that compares the stdout of the
+        answer to that of the reference, first running the reference and then
+        taking it from the reference cache.
+        """
+
+        exercise, revision = create_stdout_exercise()
+        add_content_graph(create_answerable_file_upload_exercise_page(exercise), self.instance, 7)
+        for answer_str, correct in (("correct", True), ("incorrect", False)):
+            answer = create_answer(TEST_ANSWER_STDOUT.format(answer=answer_str), self.user, self.instance, exercise, revision)
+            result, evaluation_obj = self._submit_file_upload_answer(answer.id, exercise)
+            self.r.delete(result.task_id)
+            self.assertEqual(evaluation_obj.correct, correct)
+
     def test_file_upload_answering_incorrect(self):
         answer = create_answer(TEST_ANSWER_CODE.format(answer="incorrect"), self.user, self.instance, self.exercise, self.revision)
         result, evaluation_obj = self._submit_file_upload_answer(answer.id)
@@ -269,6 +358,31 @@ class TaskTests(TestCase):
         self.r.delete(result.task_id)
         self.assertEqual(result_json["test_tree"]["log"], [])
         self.assertEqual(result_json["test_tree"]["tests"][0]["stages"][0]["commands"][0]["timedout"], True)
+        self.assertEqual(result_json["test_tree"]["tests"][0]["stages"][0]["commands"][0]["exit_signal"], "SIGTERM")
+
+    def test_file_upload_answer_progress(self):
+        answer = create_answer(TEST_ANSWER_CODE.format(answer="correct"), self.user, self.instance, self.exercise, self.revision)
+        result, evaluation_obj = self._submit_file_upload_answer(answer.id)
+        self.r.delete(result.task_id)
+        progress = evaluation_progress.wait_for_progress(result.task_id, timeout=0)
+        self.assertEqual(progress["state"], "SUCCESS")
+        self.assertEqual(progress["evaluation_id"], evaluation_obj.id)
+        messages = [m for m in evaluation_progress.iter_progress(result.task_id, since=0, timeout=1)]
+        self.assertEqual(messages, [progress])
+        evaluation_progress.clear_progress(result.task_id)
+
+    def test_file_upload_answer_resource_usage(self):
+        answer = create_answer(TEST_ANSWER_CODE.format(answer="correct"), self.user, self.instance, self.exercise, self.revision)
+        result, evaluation_obj = self._submit_file_upload_answer(answer.id)
+        self.r.delete(result.task_id)
+        test_results = json.loads(evaluation_obj.test_results)
+        for test in test_results["student"].values():
+            for stage in test["stages"].values():
+                for command in stage["commands"].values():
+                    self.assertIsNone(command["exit_signal"])
+                    self.assertGreater(command["max_rss"], 0)
+                    self.assertGreater(command["runtime"], 0)
+                    self.assertGreaterEqual(command["usermodetime"] + command["kernelmodetime"], 0)
 
     def test_file_upload_answer_broken_checker(self):
         """
@@ -299,19 +413,494 @@ class TaskTests(TestCase):
         self.assertEqual(result_json["test_tree"]["log"], [])
         self.assertEqual(len(result_json["test_tree"]["errors"]), 1)
 
+    def test_test_plan_query_count(self):
+        """
+        Tests that building the test plan takes a fixed number of queries
+        regardless of the size of the exercise, and that a cached plan takes
+        none.
+        """
 
+        with CaptureQueriesContext(connection) as queries:
+            evaluation_plan.build_test_plan(self.exercise.id, self.instance.id, self.revision)
+        query_count = len(queries)
+        self.assertLessEqual(query_count, evaluation_plan.PLAN_QUERY_BUDGET)
+
+        with reversion.create_revision():
+            for test in FileExerciseTest.objects.filter(exercise=self.exercise):
+                test.save()
+            for include_file in FileExerciseTestIncludeFile.objects.filter(exercise=self.exercise):
+                include_file.save()
+            for i in range(3):
+                test = FileExerciseTest(exercise=self.exercise, name="extra test {}".format(i))
+                test.save()
+                for j in range(2):
+                    stage = FileExerciseTestStage(test=test, name="extra stage", ordinal_number=j + 1)
+                    stage.save()
+                    for k in range(2):
+                        FileExerciseTestCommand(
+                            stage=stage, command_line="true", ordinal_number=k + 1
+                        ).save()
+            self.exercise.save()
+        revision = Version.objects.get_for_object(self.exercise).latest("revision__date_created").revision_id
+
+        with CaptureQueriesContext(connection) as queries:
+            plan = evaluation_plan.build_test_plan(self.exercise.id, self.instance.id, revision)
+        self.assertEqual(len(queries), query_count)
+        self.assertEqual(len(plan["tests"]), 4)
+
+        evaluation_plan.get_test_plan(self.exercise.id, self.instance.id, revision)
+        with self.assertNumQueries(0):
+            evaluation_plan.get_test_plan(self.exercise.id, self.instance.id, revision)
+
+    def test_workspace_pool(self):
+        """
+        Tests that workspaces from the pool contain the required files of the
+        test with their access modes applied and that released workspaces
+        are removed.
+        """
 
+        self.assertEqual(evaluation_workspace.chmod_to_mode("rw-r--r--"), 0o644)
+        self.assertEqual(evaluation_workspace.chmod_to_mode("rwxrwxrwx"), 0o777)
+        self.assertIsNone(evaluation_workspace.chmod_to_mode("rw-rw-rw"))
+        self.assertIsNone(evaluation_workspace.chmod_to_mode("wr-rw-rw-"))
+
+        plan = evaluation_plan.build_test_plan(self.exercise.id, self.instance.id, self.revision)
+        test = plan["tests"][0]
+        pool = evaluation_workspace.WorkspacePool(settings.CHECKING_WORKSPACE_ROOT, 1, 1)
+        try:
+            for i in range(3):
+                test_dir = pool.acquire(plan, test)
+                checker_path = os.path.join(test_dir, "test_checker.py")
+                with open(checker_path) as f:
+                    self.assertEqual(f.read(), TEST_CHECKER_CODE)
+                self.assertEqual(os.stat(checker_path).st_mode & 0o777, 0o666)
+                pool.release(test_dir)
+                self.assertFalse(os.path.exists(test_dir))
+        finally:
+            pool.clear()
+
+    def test_concurrent_runs_require_runner(self):
+        with self.settings(CHECKING_MAX_CONCURRENT_RUNS=4, CHECKING_RUNNER_SOCKET=None):
+            self.assertEqual(get_max_concurrent_runs(), 1)
+        with self.settings(CHECKING_MAX_CONCURRENT_RUNS=4, CHECKING_RUNNER_SOCKET="/run/runner.sock"):
+            self.assertEqual(get_max_concurrent_runs(), 4)
+
+    def test_workspace_ownership(self):
+        """
+        Tests that workspaces are given to the student user and group when
+        they are set, so that a program run as the student user can create
+        files in them.
+        """
 
+        plan = evaluation_plan.build_test_plan(self.exercise.id, self.instance.id, self.revision)
+        test = plan["tests"][0]
+        # Only root can give the workspace to another user
+        student_uid = 65534 if os.geteuid() == 0 else None
+        student_gid = os.getgid()
+        with self.settings(CHECKING_STUDENT_UID=student_uid, CHECKING_STUDENT_GID=student_gid):
+            test_dir = evaluation_workspace.prepare_workspace(settings.CHECKING_WORKSPACE_ROOT, plan, test)
+        try:
+            stat = os.stat(test_dir)
+            self.assertEqual(stat.st_mode & 0o7777, 0o2770)
+            self.assertEqual(stat.st_gid, student_gid)
+            if student_uid is not None:
+                self.assertEqual(stat.st_uid, student_uid)
+                output_path = os.path.join(test_dir, "output.txt")
+                subprocess.run(
+                    ["touch", output_path], check=True,
+                    preexec_fn=lambda: evaluation_runner._drop_privileges(student_uid, student_gid)
+                )
+                self.assertEqual(os.stat(output_path).st_uid, student_uid)
+        finally:
+            evaluation_workspace.remove_workspace(test_dir)
+
+    @override_settings(CHECKING_OUTPUT_MAX_BYTES=1000)
+    def test_file_upload_answer_output_limit(self):
+        answer = create_answer(TEST_ANSWER_PRINTS_LOTS, self.user, self.instance, self.exercise, self.revision)
+        result, evaluation_obj = self._submit_file_upload_answer(answer.id)
+        self.assertEqual(evaluation_obj.correct, False)
+        result_json = json.loads(self.r.get(result.task_id).decode("utf-8"))
+        self.r.delete(result.task_id)
+        command = result_json["test_tree"]["tests"][0]["stages"][0]["commands"][0]
+        self.assertEqual(command["stdout_truncated"], True)
+        self.assertTrue(command["stdout"].endswith("[Output truncated after 1000 bytes]"))
+
+    def test_result_store(self):
+        evaluation_store.set_results({"test_result_store_1": "one", "test_result_store_2": "two"})
+        self.assertEqual(evaluation_store.pop_result("test_result_store_1"), b"one")
+        self.assertIsNone(evaluation_store.pop_result("test_result_store_1"))
+        self.assertEqual(self.r.ttl("test_result_store_2"), settings.REDIS_RESULT_EXPIRE)
+        self.r.delete("test_result_store_2")
+        metrics = evaluation_store.get_metrics()
+        self.assertGreaterEqual(metrics["hits"], 1)
+        self.assertGreaterEqual(metrics["misses"], 1)
+        self.assertLessEqual(metrics["connections"], metrics["max_connections"])
+
+    def test_bounded_output_diff(self):
+        import prettydiff.difflib as difflib
+        reference = ["line {}".format(i) for i in range(200)]
+        student = list(reference)
+        student[100] = "line 100 wrong"
+        self.assertEqual(
+            evaluation_diff.make_diff_table(student, reference),
+            difflib.HtmlDiff().make_table(student, reference)
+        )
+        differ = evaluation_diff.BoundedHtmlDiff(max_cells=100, max_lines=10)
+        table = differ.make_table(["a{}".format(i) for i in range(50)], ["b{}".format(i) for i in range(50)])
+        self.assertTrue(differ.summarized)
+        self.assertIn("40&nbsp;more&nbsp;differing&nbsp;lines", table)
+
+    def test_duplicate_answer(self):
+        code = TEST_ANSWER_CODE.format(answer="correct")
+        answer = create_answer(code, self.user, self.instance, self.exercise, self.revision)
+        stats = evaluation_cache.get_duplicate_stats()
+        self.assertIsNone(check_duplicate_answer(answer, None))
+        result, evaluation_obj = self._submit_file_upload_answer(answer.id)
+        self.r.delete(result.task_id)
+        evaluation_progress.clear_progress(result.task_id)
+
+        duplicate = create_answer(code, self.user, self.instance, self.exercise, self.revision)
+        task_id = check_duplicate_answer(duplicate, None)
+        self.assertIsNotNone(task_id)
+        duplicate.refresh_from_db()
+        self.assertEqual(duplicate.content_hash, answer.content_hash)
+        self.assertNotEqual(duplicate.evaluation_id, evaluation_obj.id)
+        self.assertEqual(duplicate.evaluation.test_results, evaluation_obj.test_results)
+        self.assertEqual(duplicate.evaluation.correct, True)
+        progress = evaluation_progress.get_progress(task_id)
+        self.assertEqual(progress["state"], "SUCCESS")
+        self.assertEqual(progress["evaluation_id"], duplicate.evaluation_id)
+        evaluation_progress.clear_progress(task_id)
+
+        new_stats = evaluation_cache.get_duplicate_stats()
+        self.assertEqual(new_stats["hits"], stats["hits"] + 1)
+        self.assertEqual(new_stats["misses"], stats["misses"] + 1)
+
+    def test_stage_cache(self):
+        """
+        Tests that a stage another stage depends on is run only once with the
+        same stage cache, and that failed stages and stages nothing depends on
+        are not cached.
+        """
+
+        stage = {"id": 1, "name": "compile", "ordinal_number": 1, "depends_on": None,
+                 "commands": [{"id": 10, "command_line": "make", "expected_outputs": []}]}
+        test = {"stages": [stage, {"id": 2, "name": "run", "ordinal_number": 2, "depends_on": 1, "commands": []}]}
+        self.assertEqual(evaluation_workspace.cached_stage_ids(test), {1})
+
+        runs = []
+        def make(test_dir, fail=False):
+            def run():
+                runs.append(test_dir)
+                with open(os.path.join(test_dir, "program"), "w") as f:
+                    f.write("built")
+                return {"fail": fail, "commands": {10: {"stdout": test_dir, "timedout": False}}}, True
+            return run
+
+        stage_cache = evaluation_workspace.StageCache(settings.CHECKING_WORKSPACE_ROOT)
+        test_dirs = [tempfile.mkdtemp(dir=settings.CHECKING_WORKSPACE_ROOT) for i in range(3)]
+        try:
+            stage_cache.run_stage(stage, test_dirs[0], make(test_dirs[0], fail=True))
+            stage_cache.run_stage(stage, test_dirs[1], make(test_dirs[1]))
+            results, _ = stage_cache.run_stage(stage, test_dirs[2], make(test_dirs[2]))
+            self.assertEqual(runs, test_dirs[:2])
+            self.assertEqual(stage_cache.hits, 1)
+            self.assertEqual(results["commands"][10]["stdout"], test_dirs[2])
+            with open(os.path.join(test_dirs[2], "program")) as f:
+                self.assertEqual(f.read(), "built")
+        finally:
+            stage_cache.clear()
+            for test_dir in test_dirs:
+                shutil.rmtree(test_dir)
+
+        answer = create_answer(TEST_ANSWER_CODE.format(answer="correct"), self.user, self.instance, self.exercise, self.revision)
+        plan = evaluation_plan.get_test_plan(self.exercise.id, self.instance.id, None)
+        test = plan["tests"][0]
+        self.assertEqual(evaluation_workspace.cached_stage_ids(test), set())
+        stage_cache = evaluation_workspace.StageCache(settings.CHECKING_WORKSPACE_ROOT)
+        try:
+            run_test(test["id"], answer.id, self.instance.id, self.exercise.id, student=True,
+                     stage_cache=stage_cache)
+            self.assertEqual((stage_cache.hits, stage_cache.misses), (0, 0))
+        finally:
+            stage_cache.clear()
+
+    def test_file_upload_answer_runner_service(self):
+        """
+        Tests checking an answer with the commands run by the sandbox runner
+        service.
+        """
+
+        socket_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(socket_dir, "runner.sock")
+        runner = subprocess.Popen([
+            sys.executable, "-m", "courses.evaluation_runner",
+            "--socket", socket_path, "--workers", "2",
+        ])
+        try:
+            for i in range(50):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.1)
+            answer = create_answer(TEST_ANSWER_CODE.format(answer="correct"), self.user, self.instance, self.exercise, self.revision)
+            with self.settings(CHECKING_RUNNER_SOCKET=socket_path):
+                result, evaluation_obj = self._submit_file_upload_answer(answer.id)
+            self.assertEqual(evaluation_obj.correct, True)
+            result_json = json.loads(self.r.get(result.task_id).decode("utf-8"))
+            self.r.delete(result.task_id)
+            command = result_json["test_tree"]["tests"][0]["stages"][0]["commands"][0]
+            self.assertGreater(command["max_rss"], 0)
+        finally:
+            runner.terminate()
+            runner.wait(5)
+            shutil.rmtree(socket_dir)
+
+    def test_worker_heartbeat(self):
+        """
+        Tests that only workers consuming the checking queue count as
+        available checking workers.
+        """
+
+        key = evaluation_progress.HEARTBEAT_KEY.format(queue=settings.CHECKING_QUEUE)
+        cache.delete(key)
+        evaluation_progress.write_heartbeat("other-worker", ["default", "privileged"])
+        self.assertIn("errors", evaluation_progress.get_worker_status())
+        evaluation_progress.write_heartbeat("checking-worker", [settings.CHECKING_QUEUE])
+        self.assertEqual(evaluation_progress.get_worker_status()["hostname"], "checking-worker")
+        cache.delete(key)
+
+    def test_checking_queue(self):
+        bucket = evaluation_queue.TokenBucket("test", 0.001, 2)
+        bucket.reset(1)
+        self.assertEqual([bucket.take(1) for i in range(3)], [True, True, False])
+        self.assertTrue(bucket.take(2))
+        bucket.reset(1)
+        bucket.reset(2)
+
+        student = User.objects.create_user(username="queue_student", password="test")
+        evaluation_queue.get_user_bucket().reset(student.id)
+        evaluation_queue.get_instance_bucket().reset(self.instance.id)
+        with self.settings(CHECKING_QUEUE_USER_BURST=1, CHECKING_QUEUE_USER_RATE=0.001):
+            self.assertEqual(evaluation_queue.get_checking_priority(student, self.instance.id),
+                             evaluation_queue.PRIORITY_NORMAL)
+            self.assertEqual(evaluation_queue.get_checking_priority(student, self.instance.id),
+                             evaluation_queue.PRIORITY_USER_OVER)
+        self.assertEqual(evaluation_queue.get_checking_priority(self.user, self.instance.id),
+                         evaluation_queue.PRIORITY_STAFF)
+        evaluation_queue.get_user_bucket().reset(student.id)
+        evaluation_queue.get_instance_bucket().reset(self.instance.id)
+
+        self.r.delete(evaluation_queue.QUEUE_WAIT_KEY)
+        answer = create_answer(TEST_ANSWER_CODE.format(answer="correct"), self.user, self.instance, self.exercise, self.revision)
+        result = run_tests.s(
+            user_id=self.user.id,
+            instance_id=self.instance.id,
+            exercise_id=self.exercise.id,
+            answer_id=answer.id,
+            lang_code=translation.get_language(),
+            revision=None,
+            queued_at=time.time() - 2,
+        ).apply()
+        result.get()
+        result.forget()
+        self.r.delete(result.task_id)
+        stats = evaluation_queue.get_queue_wait_stats()
+        self.assertEqual(stats["count"], 1)
+        self.assertGreaterEqual(stats["p95"], 2)
+        self.r.delete(evaluation_queue.QUEUE_WAIT_KEY)
+
+    @override_settings(CHECKING_SUBMISSION_RATE=0.001, CHECKING_SUBMISSION_BURST=2)
+    def test_submission_admission(self):
+        student = User.objects.create_user(username="admission_student", password="test")
+        bucket = evaluation_queue.get_submission_bucket()
+        bucket.reset("{}_{}".format(student.id, self.exercise.id))
+        self.assertIsNone(evaluation_queue.admit_submission(student, self.exercise.id))
+        self.assertIsNone(evaluation_queue.admit_submission(student, self.exercise.id))
+        self.assertEqual(evaluation_queue.admit_submission(student, self.exercise.id), 1000)
+        self.assertIsNone(evaluation_queue.admit_submission(self.user, self.exercise.id))
+        bucket.reset("{}_{}".format(student.id, self.exercise.id))
+
+    def test_superseded_answer(self):
+        self.assertIsNone(evaluation_queue.supersede_previous(self.user.id, self.exercise.id, self.instance.id, "old-task"))
+        self.assertEqual(
+            evaluation_queue.supersede_previous(self.user.id, self.exercise.id, self.instance.id, "new-task"),
+            "old-task"
+        )
+        self.assertFalse(evaluation_queue.claim_task("old-task"))
+        self.assertEqual(evaluation_progress.get_progress("old-task")["state"], "SUPERSEDED")
+        self.assertTrue(evaluation_queue.claim_task("new-task"))
+
+        # A task that has started can't be superseded anymore
+        self.assertIsNone(evaluation_queue.supersede_previous(self.user.id, self.exercise.id, self.instance.id, "newest-task"))
+        self.assertFalse(evaluation_queue.is_superseded("new-task"))
+
+        self.r.delete(
+            "checking_latest_task_{}_{}_{}".format(self.user.id, self.exercise.id, self.instance.id),
+            "checking_claim_old-task", "checking_claim_new-task",
+        )
+        evaluation_progress.clear_progress("old-task")
 
+    def test_checking_timings(self):
+        """
+        Tests that the phase timings of a checking task are saved with the
+        evaluation and added to the histograms of the exercise.
+        """
 
+        evaluation_timing.reset_timings(self.exercise.id)
+        answer = create_answer(TEST_ANSWER_CODE.format(answer="correct"), self.user, self.instance, self.exercise, self.revision)
+        result, evaluation_obj = self._submit_file_upload_answer(answer.id)
+        self.r.delete(result.task_id)
 
+        timings = evaluation_timing.parse_timings(evaluation_obj)
+        for phase in ("lookup", "files", "plan", "tests", "setup", "execution", "results", "serialize", "store"):
+            self.assertIn(phase, timings)
+            self.assertGreaterEqual(timings[phase], 0)
+        self.assertGreater(timings["execution"], 0)
 
+        histograms = {histogram["phase"]: histogram for histogram in evaluation_timing.get_timing_histograms(self.exercise.id)}
+        self.assertEqual(histograms["save"]["count"], 1)
+        self.assertEqual(sum(count for bound, count in histograms["tests"]["buckets"]), 1)
+        self.assertIn(self.exercise.id, evaluation_timing.get_timed_exercise_ids())
+        evaluation_timing.reset_timings(self.exercise.id)
 
+    def test_compact_result_storage(self):
+        """
+        Tests that test results are stored compressed with the outputs moved
+        out and shared between evaluations, and that they load back as they
+        were.
+        """
 
+        with override_settings(CHECKING_COMPACT_RESULTS=True, CHECKING_STORED_OUTPUT_INLINE_BYTES=0):
+            first_answer = create_answer(TEST_ANSWER_CODE.format(answer="correct"), self.user, self.instance, self.exercise, self.revision)
+            result, first = self._submit_file_upload_answer(first_answer.id)
+            self.r.delete(result.task_id)
+            output_count = EvaluationOutput.objects.count()
+            second_answer = create_answer(TEST_ANSWER_CODE.format(answer="correct"), self.user, self.instance, self.exercise, self.revision)
+            result, second = self._submit_file_upload_answer(second_answer.id)
+            self.r.delete(result.task_id)
+
+        self.assertEqual(first.test_results, "")
+        self.assertTrue(first.has_test_results)
+        self.assertGreater(output_count, 0)
+        self.assertEqual(EvaluationOutput.objects.count(), output_count)
+
+        results = evaluation_storage.load_results(second)
+        for side in ("student", "reference"):
+            for test in results[side].values():
+                for stage in test["stages"].values():
+                    for command in stage["commands"].values():
+                        self.assertIsInstance(command["stdout"], str)
+                        self.assertIsInstance(command["stderr"], str)
+
+        # Outputs no evaluation refers to are deleted once they haven't been
+        # used for the grace period
+        EvaluationOutput.objects.create(digest="0" * 64, data=zlib.compress(b"orphan"))
+        self.assertEqual(evaluation_storage.delete_orphaned_outputs(), 0)
+        self.assertEqual(evaluation_storage.delete_orphaned_outputs(grace=datetime.timedelta(0)), 1)
+        self.assertEqual(EvaluationOutput.objects.count(), output_count)
+
+        # Missing outputs are reported instead of shown as empty
+        digest = EvaluationOutput.objects.values_list("digest", flat=True).first()
+        EvaluationOutput.objects.filter(digest=digest).delete()
+        results = evaluation_storage.load_results(second)
+        outputs = [
+            command[key]
+            for side in ("student", "reference") for test in results[side].values()
+            for stage in test["stages"].values() for command in stage["commands"].values()
+            for key in ("stdout", "stderr")
+        ]
+        self.assertIn(evaluation_storage.OUTPUT_MISSING_MARKER.format(digest), outputs)
+
+        # Outputs over the cap are cut
+        results = {"student": {"1": {"stages": {"1": {"commands": {"1": {"stdout": "x" * 1000, "stderr": ""}}}}}}}
+        packed, outputs = evaluation_storage.pack_results(results, inline_bytes=2000, max_bytes=100)
+        self.assertEqual(outputs, {})
+        self.assertEqual(results["student"]["1"]["stages"]["1"]["commands"]["1"]["stdout"], "x" * 1000)
+        evaluation = Evaluation(packed_results=packed)
+        stdout = evaluation_storage.load_results(evaluation)["student"]["1"]["stages"]["1"]["commands"]["1"]["stdout"]
+        self.assertTrue(stdout.startswith("x" * 100 + "\n"))
+
+    def test_evaluation_report_cache(self):
+        """
+        Tests that the rendered report of an evaluation is cached under the
+        evaluation, revision and language and reused.
+        """
 
+        answer = create_answer(TEST_ANSWER_CODE.format(answer="correct"), self.user, self.instance, self.exercise, self.revision)
+        result, evaluation_obj = self._submit_file_upload_answer(answer.id)
+        self.r.delete(result.task_id)
 
+        request = RequestFactory().get("/")
+        request.user = self.user
+        lang_code = translation.get_language()
+        context = {"course_slug": "", "instance_slug": self.instance.slug, "instance": self.instance}
+        self.assertIsNone(evaluation_cache.get_report(evaluation_obj.id, answer.revision, lang_code))
+        report = views.get_evaluation_report(request, evaluation_obj, answer.revision, context)
+        self.assertEqual(evaluation_cache.get_report(evaluation_obj.id, answer.revision, lang_code), report)
+        self.assertIn("file_tabs", report)
+
+        # The grading comes from the evaluation, not from the cached report
+        evaluation_obj.points = 0
+        data = views.compile_evaluation_data(views.get_evaluation_report(request, evaluation_obj, answer.revision, context), evaluation_obj)
+        self.assertEqual(data["points"], 0)
+        self.assertEqual(data["file_tabs"], report["file_tabs"])
+        cache.delete(evaluation_cache.get_report_cache_key(evaluation_obj.id, answer.revision, lang_code))
+
+    def test_reference_cache_skips_unreliable(self):
+        """
+        Tests that reference results with a timed out command or a command
+        that couldn't be run are not cached.
+        """
 
+        # Cached like in run_tests: test ids mapped to the results of run_test
+        def results(test_id, **command):
+            return {test_id: {"stages": {"1": {"commands": {"1": dict({"timedout": False}, **command)}}}}}
 
+        key = "reference_results_test_unreliable"
+        evaluation_cache.save_reference_results(key, {
+            1: results(1),
+            2: results(2, timedout=True),
+            3: results(3, error="Runner unavailable", fail=True),
+        })
+        self.assertEqual(set(evaluation_cache.get_reference_results(key).keys()), {1})
+        cache.delete(key)
+
+    def test_duplicate_of_failed_run(self):
+        """
+        Tests that an evaluation whose commands couldn't be run is not reused
+        for a resubmission of the same files.
+        """
+
+        code = TEST_ANSWER_CODE.format(answer="correct")
+        answer = create_answer(code, self.user, self.instance, self.exercise, self.revision)
+        check_duplicate_answer(answer, None)
+        with self.settings(CHECKING_RUNNER_SOCKET="/nonexistent/runner.sock"):
+            result, evaluation_obj = self._submit_file_upload_answer(answer.id)
+        self.r.delete(result.task_id)
+        evaluation_progress.clear_progress(result.task_id)
 
+        duplicate = create_answer(code, self.user, self.instance, self.exercise, self.revision)
+        self.assertIsNone(check_duplicate_answer(duplicate, None))
+
+    def test_duplicate_of_failed_reference(self):
+        """
+        Tests that an evaluation whose reference run timed out is not reused
+        for a resubmission of the same files.
+        """
+
+        code = TEST_ANSWER_CODE.format(answer="correct")
+        answer = create_answer(code, self.user, self.instance, self.exercise, self.revision)
+        check_duplicate_answer(answer, None)
+        result, evaluation_obj = self._submit_file_upload_answer(answer.id)
+        self.r.delete(result.task_id)
 
+        results = evaluation_storage.load_results(evaluation_obj)
+        for test in results["reference"].values():
+            for stage in test["stages"].values():
+                for command in stage["commands"].values():
+                    command["timedout"] = True
+        evaluation_storage.store_results(evaluation_obj, results)
+        evaluation_obj.save()
 
+        duplicate = create_answer(code, self.user, self.instance, self.exercise, self.revision)
+        self.assertIsNone(check_duplicate_answer(duplicate, None))
@@ -14,6 +14,7 @@ import shutil
 from django.conf import settings
 from django.test import TestCase
 from courses.models import *
+from courses import page_cache
 from courses.tests.testhelpers import *
 
 
@@ -84,6 +85,10 @@ class ViewTests(TestCase):
         add_content_graph(test_page_link_term, test_instance, 10)
         test_instance.frontpage = test_frontpage        
         test_instance.save()
+
+    def setUp(self):
+        # Renders cached by earlier tests would skip the templates checked here
+        page_cache.invalidate_pages(ContentPage.objects.values_list("id", flat=True))
         
     def test_index_page_view(self):
         """
@@ -135,7 +140,51 @@ class ViewTests(TestCase):
         self.assertTemplateUsed(response, "courses/contentpage.html")
         self.assertTemplateUsed(response, "courses/lecture.html")
         self.assertTemplateUsed(response, "courses/embedded-codefile.html")
+
+    def test_page_render_cache(self):
+        """
+        Tests that the static part of a page is rendered only once and
+        rendered again after the page or the pages it may link have changed.
+        """
+
+        page = ContentPage.objects.get(slug="media-lecture-page")
+        first = self.client.get(test_urls.media_page_url)
+        second = self.client.get(test_urls.media_page_url)
+        self.assertEqual(second.status_code, 200)
+        self.assertTemplateNotUsed(second, "courses/embedded-codefile.html")
+        self.assertEqual(first.context["rendered_content"], second.context["rendered_content"])
+
+        page_cache.invalidate_pages([page.id])
+        response = self.client.get(test_urls.media_page_url)
+        self.assertTemplateUsed(response, "courses/embedded-codefile.html")
+
+        # Renaming any page may break or fix the links of the page
+        other = ContentPage.objects.exclude(id=page.id).first()
+        other.slug = "renamed-page"
+        other.save()
+        response = self.client.get(test_urls.media_page_url)
+        self.assertTemplateUsed(response, "courses/embedded-codefile.html")
+        response = self.client.get(test_urls.media_page_url)
+        self.assertTemplateNotUsed(response, "courses/embedded-codefile.html")
         
+    def test_page_cache_nested_embeds(self):
+        """
+        Tests that changing a page invalidates the pages embedding it through
+        other embedded pages.
+        """
+
+        top, middle, bottom = ContentPage.objects.all()[:3]
+        instance = CourseInstance.objects.first()
+        EmbeddedLink.objects.create(parent=top, embedded_page=middle, ordinal_number=1, instance=instance)
+        EmbeddedLink.objects.create(parent=middle, embedded_page=bottom, ordinal_number=1, instance=instance)
+        # A cycle must not keep the invalidation going
+        EmbeddedLink.objects.create(parent=bottom, embedded_page=top, ordinal_number=1, instance=instance)
+
+        generations = [page_cache.get_page_generation(page.id) for page in (top, middle, bottom)]
+        page_cache.invalidate_pages([bottom.id])
+        for page, generation in zip((top, middle, bottom), generations):
+            self.assertNotEqual(page_cache.get_page_generation(page.id), generation)
+
     def test_page_with_checkbox_exercise(self):
         """
         Tests that a page with an embedded checkbox exercise can be loaded and
@@ -56,6 +56,8 @@ urlpatterns = [
     path("<course:course>/<instance:instance>/<content:content>/<revision:revision>/exercise-session/", views.get_repeated_template_session, name="get_repeated_template_session"),
     path("<course:course>/<instance:instance>/<content:content>/<revision:revision>/progress/<slug:task_id>/",
         views.check_progress, name="check_progress"),
+    path("<course:course>/<instance:instance>/<content:content>/<revision:revision>/progress/<slug:task_id>/stream/",
+        views.check_progress_stream, name="check_progress_stream"),
     path("<course:course>/<instance:instance>/<content:content>/<revision:revision>/evaluation/<slug:task_id>/",
         views.file_exercise_evaluation, name="file_exercise_evaluation"),
 ]
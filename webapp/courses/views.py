@@ -6,13 +6,11 @@ import json
 from cgi import escape
 from collections import namedtuple
 
-import redis
-
 import magic
 
 from django.http import HttpResponse, JsonResponse, HttpResponseRedirect,\
     HttpResponseNotFound, HttpResponseForbidden, HttpResponseNotAllowed,\
-    HttpResponseServerError, HttpResponseBadRequest
+    HttpResponseServerError, HttpResponseBadRequest, StreamingHttpResponse
 from django.db import transaction
 from django.db.models import Q
 from django.template import Template, loader, engines
@@ -31,7 +29,11 @@ from reversion.models import Version
 
 from lovelace.celery import app as celery_app
 import courses.tasks as rpc_tasks
-from courses.tasks import get_celery_worker_status
+from courses import evaluation_cache
+from courses import evaluation_progress
+from courses import evaluation_queue
+from courses import evaluation_storage
+from courses import evaluation_store
 
 from courses.models import *
 from courses.forms import *
@@ -311,6 +313,17 @@ def check_answer(request, course, instance, content, revision):
     files = request.FILES
 
     exercise = content
+
+    # Answers that are checked by the workers are subject to admission control
+    if exercise.content_type == "FILE_UPLOAD_EXERCISE":
+        retry_after = evaluation_queue.admit_submission(user, exercise.id)
+        if retry_after is not None:
+            response = JsonResponse({
+                'errors': _('You are sending answers too quickly. Please wait %d seconds and try again.') % (retry_after),
+                'retry_after': retry_after,
+            }, status=429)
+            response["Retry-After"] = str(retry_after)
+            return response
     
     try:
         answer_object = exercise.save_answer(content, user, ip, answer, files, instance, revision)
@@ -388,7 +401,7 @@ def get_repeated_template_session(request, course, instance, content, revision):
                 if revision == "head": revision = None
                 # TODO: DO NOTHING AND FORGET THE TASK IF CELERY IS NOT WORKING!
                 # TODO: Add an expire date
-                celery_status = rpc_tasks.get_celery_worker_status()
+                celery_status = evaluation_progress.get_worker_status()
                 if 'errors' in celery_status.keys():
                     data = {
                         'ready': True,
@@ -452,26 +465,87 @@ def get_repeated_template_session(request, course, instance, content, revision):
 
 @ensure_enrolled_or_staff
 def check_progress(request, course, instance, content, revision, task_id):
-    # Based on https://djangosnippets.org/snippets/2898/
+    """
+    Reports the progress of a checking task, or the evaluation once the task
+    is done. GET requests are long-polled: the response is held until the
+    task reports something newer than the sequence number given in the since
+    parameter, or until CHECKING_PROGRESS_LONG_POLL seconds have passed.
+    """
     # TODO: Check permissions
-    task = celery_app.AsyncResult(id=task_id)
-    info = task.info
-    if task.ready():
-        return file_exercise_evaluation(request, course, instance, content, revision, task_id, task)
+    try:
+        since = int(request.GET.get("since", 0))
+    except ValueError:
+        since = 0
+    if request.method == "GET":
+        timeout = getattr(settings, "CHECKING_PROGRESS_LONG_POLL", 10)
     else:
-        celery_status = get_celery_worker_status()
-        if "errors" in celery_status:
-            data = celery_status
+        timeout = 0
+
+    progress = evaluation_progress.wait_for_progress(task_id, since, timeout)
+    if progress is not None and progress["state"] in evaluation_progress.FINAL_STATES:
+        return file_exercise_evaluation(request, course, instance, content, revision, task_id, progress=progress)
+
+    celery_status = evaluation_progress.get_worker_status()
+    if "errors" in celery_status:
+        data = celery_status
+    else:
+        url_kwargs = {
+            'course': course,
+            'instance': instance,
+            'content': content,
+            'revision': revision,
+            'task_id': task_id,
+        }
+        progress_url = reverse('courses:check_progress', kwargs=url_kwargs)
+        if progress is None:
+            data = {"state": "PENDING", "metadata": None, "redirect": progress_url}
         else:
-            progress_url = reverse('courses:check_progress',
-                                   kwargs={'course': course,
-                                           'instance': instance,
-                                           'content': content,
-                                           'revision': revision,
-                                           'task_id': task_id,})
-            if not info: info = task.info # Try again in case the first time was too early
-            data = {"state": task.state, "metadata": info, "redirect": progress_url}
-        return JsonResponse(data)
+            data = {
+                "state": progress["state"],
+                "metadata": progress["metadata"],
+                "redirect": "{}?since={}".format(progress_url, progress["seq"]),
+            }
+        if getattr(settings, "CHECKING_PROGRESS_STREAM", False):
+            data["stream"] = reverse('courses:check_progress_stream', kwargs=url_kwargs)
+    return JsonResponse(data)
+
+@ensure_enrolled_or_staff
+def check_progress_stream(request, course, instance, content, revision, task_id):
+    """
+    Streams the progress of a checking task as server-sent events. The final
+    event carries the URL the evaluation can be fetched from.
+
+    A stream holds a worker and a Redis connection while it is open, so it
+    is only available when CHECKING_PROGRESS_STREAM is set.
+    """
+    # TODO: Check permissions
+    if not getattr(settings, "CHECKING_PROGRESS_STREAM", False):
+        return HttpResponseNotFound()
+    evaluation_url = reverse('courses:file_exercise_evaluation',
+                             kwargs={'course': course,
+                                     'instance': instance,
+                                     'content': content,
+                                     'revision': revision,
+                                     'task_id': task_id,})
+    try:
+        since = int(request.META.get("HTTP_LAST_EVENT_ID", 0))
+    except ValueError:
+        since = 0
+    timeout = getattr(settings, "CHECKING_PROGRESS_STREAM_TIMEOUT", 120)
+
+    def events():
+        for progress in evaluation_progress.iter_progress(task_id, since, timeout):
+            if progress is None:
+                yield ": keep-alive\n\n"
+                continue
+            if progress["state"] in evaluation_progress.FINAL_STATES:
+                progress["evaluation_url"] = evaluation_url
+            yield "id: {}\ndata: {}\n\n".format(progress["seq"], json.dumps(progress))
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
 
 def get_answer_count_meta(answer_count):
     # TODO: Maybe refactor
@@ -479,20 +553,38 @@ def get_answer_count_meta(answer_count):
     return t.render({'answer_count': answer_count})
     
     
-def file_exercise_evaluation(request, course, instance, content, revision, task_id, task=None):
+def file_exercise_evaluation(request, course, instance, content, revision, task_id, task=None, progress=None):
+    if progress is None:
+        progress = evaluation_progress.get_progress(task_id)
     if task is None:
-        task = AsyncResult(task_id)
-    evaluation_id = task.get()
+        task = celery_app.AsyncResult(task_id)
+    if progress is not None and progress["state"] in evaluation_progress.FINAL_STATES:
+        evaluation_id = progress["evaluation_id"]
+    else:
+        evaluation_id = task.get()
     task.forget() # TODO: IMPORTANT! Also forget all the subtask results somehow? in tasks.py?
+    evaluation_progress.clear_progress(task_id)
+    if progress is not None and progress["state"] == "SUPERSEDED":
+        return JsonResponse({
+            'errors': _("This answer was not checked, because you sent a newer answer to the same exercise before checking started.")
+        })
+    if evaluation_id is None:
+        return JsonResponse({
+            'errors': _("Checking program was unable to finish due to an error. Contact course staff.")
+        })
     evaluation_obj = Evaluation.objects.get(id=evaluation_id)
     answer_count = content.get_user_answers(content, request.user, instance).count()
     answer_count_str = get_answer_count_meta(answer_count)
 
-    r = redis.StrictRedis(**settings.REDIS_RESULT_CONFIG)
-    evaluation_json = r.get(task_id).decode("utf-8")
-    evaluation_tree = json.loads(evaluation_json)
-    r.delete(task_id)
-    task.forget()
+    # The report is rendered here, when the student gets the results, and
+    # cached for viewing the answer later
+    evaluation_json = evaluation_store.pop_result(task_id)
+    if evaluation_json is not None:
+        evaluation_tree = json.loads(evaluation_json.decode("utf-8"))
+    else:
+        # The rendered results have expired, they are generated again if the
+        # report isn't cached
+        evaluation_tree = None
 
     msg_context = {
         'course_slug': course.slug,
@@ -501,10 +593,12 @@ def file_exercise_evaluation(request, course, instance, content, revision, task_
         'content_page': content
     }
 
-    data = compile_evaluation_data(request, evaluation_tree, evaluation_obj, msg_context)
+    report = get_evaluation_report(request, evaluation_obj, evaluation_obj.useranswer.revision, msg_context,
+                                   evaluation_tree)
+    data = compile_evaluation_data(report, evaluation_obj)
     
-    if evaluation_tree['test_tree'].get('errors', []):
-        if evaluation_tree['timedout']:
+    if report['has_errors']:
+        if report['timedout']:
             data['errors'] = _("The program took too long to execute and was terminated. Check your code for too slow solutions.")
         else:
             #print(evaluation_tree['test_tree']['errors'])        
@@ -515,7 +609,11 @@ def file_exercise_evaluation(request, course, instance, content, revision, task_
     
     return JsonResponse(data)
 
-def compile_evaluation_data(request, evaluation_tree, evaluation_obj, context=None):
+def render_evaluation_report(request, evaluation_tree, context=None):
+    """
+    Renders the parts of the results of a file upload exercise evaluation that
+    only depend on the test results.
+    """
     log = evaluation_tree["test_tree"].get("log", [])
 
     messages = [
@@ -545,31 +643,54 @@ def compile_evaluation_data(request, evaluation_tree, evaluation_obj, context=No
         'debug_json': debug_json,
         'evaluation_tree': evaluation_tree["test_tree"],
     }
+    t_messages = loader.get_template('courses/exercise-evaluation-messages.html')
+    return {
+        'file_tabs': t_file.render(c_file, request),
+        'messages': t_messages.render({'log': log}),
+        'hints': hints,
+        'triggers': triggers,
+        'has_errors': bool(evaluation_tree['test_tree'].get('errors', [])),
+        'timedout': evaluation_tree['timedout'],
+    }
+
+def get_evaluation_report(request, evaluation_obj, revision, context=None, evaluation_tree=None):
+    """
+    Returns the rendered report of a file upload exercise evaluation from the
+    cache, or renders and caches it. The evaluation tree is generated from the
+    stored test results if it's not given.
+    """
+    lang_code = translation.get_language()
+    report = evaluation_cache.get_report(evaluation_obj.id, revision, lang_code)
+    if report is None:
+        if evaluation_tree is None:
+            evaluation_tree = rpc_tasks.generate_results(evaluation_storage.load_results(evaluation_obj), 0)
+        report = render_evaluation_report(request, evaluation_tree, context)
+        evaluation_cache.save_report(evaluation_obj.id, revision, lang_code, report)
+    return report
+
+def compile_evaluation_data(report, evaluation_obj):
+    """
+    Combines the rendered report with the current grading of the evaluation,
+    which a teacher may have changed after the report was cached.
+    """
     t_exercise = loader.get_template("courses/exercise-evaluation.html")
     c_exercise = {
         'evaluation': evaluation_obj.correct,
     }
-    t_messages = loader.get_template('courses/exercise-evaluation-messages.html')
     data = {
-        'file_tabs': t_file.render(c_file, request),
+        'file_tabs': report['file_tabs'],
         'result': t_exercise.render(c_exercise),
         'evaluation': evaluation_obj.correct,
         'points': evaluation_obj.points,
-        'messages': t_messages.render({'log': log}),
-        'hints': hints,
-        'triggers': triggers,
+        'messages': report['messages'],
+        'hints': report['hints'],
+        'triggers': report['triggers'],
     }
     
     return data
     
 @ensure_owner_or_staff
 def get_file_exercise_evaluation(request, user, course, instance, exercise, answer):
-    from .tasks import generate_results
-
-    results_json = answer.evaluation.test_results
-    results_dict = json.loads(results_json)
-
-    evaluation_tree = generate_results(results_dict, 0)
     evaluation_obj = answer.evaluation
 
     msg_context = {
@@ -579,7 +700,8 @@ def get_file_exercise_evaluation(request, user, course, instance, exercise, answ
         'content_page': exercise
     }
 
-    data = compile_evaluation_data(request, evaluation_tree, evaluation_obj, msg_context)
+    report = get_evaluation_report(request, evaluation_obj, answer.revision, msg_context)
+    data = compile_evaluation_data(report, evaluation_obj)
 
     if not request.user.is_staff:
         data["triggers"] = []
@@ -780,8 +902,6 @@ def content(request, course, instance, content, **kwargs):
             term_div_data,
             timeout=None
         )
-            
-    rendered_content = ""
 
     # TODO: Admin link should point to the correct version!
 
@@ -794,20 +914,14 @@ def content(request, course, instance, content, **kwargs):
         #version_list = reversion.get_for_object(content).order_by('revision_id')
         # TODO: New form? Version.objects.get_for_object(term)[0].revision.
         version = Version.objects.get_for_object(content).get(revision_id=revision).field_dict
-        old_content = version["content"]
         question = version["question"]
-        
-        # Render the old version of the page
-        markup_gen = markupparser.MarkupParser.parse(old_content, request, context)
-        for chunk in markup_gen:
-            rendered_content += chunk
     else:
         question = blockparser.parseblock(escape(content.question), {"course": course})
 
     choices = answers = content.get_choices(content, revision=revision)
 
-    if not rendered_content:
-        rendered_content = content.rendered_markup(request, context)
+    # Renders the old version of the page if the revision is set
+    rendered_content = content.rendered_markup(request, context, revision)
 
     c = {
         'course': course,
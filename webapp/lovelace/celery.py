@@ -4,6 +4,7 @@ import os
 
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import worker_ready
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lovelace.settings')
@@ -37,3 +38,10 @@ def setup_periodic_tasks(sender, **kwargs):
             'options': {'expires': 150.0,}, # We don't need these tasks hanging around
         },
     }
+
+@worker_ready.connect
+def start_worker_heartbeat(sender, **kwargs):
+    # Views check the heartbeat of the checking queue to tell whether checking
+    # workers are available
+    from courses.evaluation_progress import start_heartbeat
+    start_heartbeat(sender.app.amqp.queues.consume_from.keys(), sender.hostname)
@@ -218,6 +218,9 @@ SECRET_KEY = '$34r(o@3yfyr-=v8*ndtqm6^ti0=p%cyt&amp;a*giv-1w%q21r4ae'
 # Redis settings
 REDIS_RESULT_CONFIG = {"host": "localhost", "port": 6379, "db": 0}
 REDIS_RESULT_EXPIRE = 60
+# Options of the connection pool shared by each process for the result store.
+# Every open checking progress stream holds one connection of the pool.
+REDIS_RESULT_POOL = {"max_connections": 100, "socket_timeout": 10, "socket_connect_timeout": 5}
 REDIS_LONG_EXPIRE = 60 * 60 * 24 * 7
 
 # Celery settings
@@ -227,9 +230,25 @@ CELERY_TASK_DEFAULT_QUEUE = "default"
 CELERY_TASK_DEFAULT_ROUTING_KEY = "default"
 CELERY_QUEUES = (
     Queue("default", Exchange("default"), routing_key="default"),
-    Queue("privileged", Exchange("privileged"), routing_key="privileged")
+    Queue("privileged", Exchange("privileged"), routing_key="privileged"),
+    # Answer checking, see courses/evaluation_queue.py. Run a dedicated worker
+    # for this queue with runchecking.sh.
+    Queue("checking", Exchange("checking"), routing_key="checking",
+          queue_arguments={"x-max-priority": 10}),
 )
+# Priorities only work if workers don't reserve a batch of tasks in advance
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
 CELERY_ROUTES = {
+    "courses.run-fileexercise-tests": {
+        "queue": "checking",
+        "exchange": "checking",
+        "routing_key": "checking"
+    },
+    "courses.precache-reference-results": {
+        "queue": "checking",
+        "exchange": "checking",
+        "routing_key": "checking"
+    },
     "teacher_tools.*": {
         "queue": "privileged",
         "exchange": "privileged",
@@ -242,6 +261,111 @@ CELERY_ROUTES = {
     }
 }
 
+# File exercise checking settings
+# How many test runs (student or reference) one checking task may run at the
+# same time. With 1 the tests are run one after another. Concurrent runs
+# require CHECKING_RUNNER_SOCKET; without it the tests are run one at a time.
+CHECKING_MAX_CONCURRENT_RUNS = 1
+# Start the reference run of a test at the same time as the student's run
+# instead of waiting for the student's run to finish. The reference run is
+# wasted for tests that only produce JSON output.
+CHECKING_CONCURRENT_PAIRS = False
+# Cache the results of reference runs per exercise revision in the Django cache
+# and run the reference ahead of time whenever a file exercise is saved.
+CHECKING_REFERENCE_CACHE = True
+# Reuse the evaluation of an earlier answer with byte-identical files to the
+# same exercise revision and instance instead of checking the files again.
+CHECKING_DUPLICATE_SHORTCUT = True
+# Directory the test workspaces are created in. A tmpfs mount (e.g. /dev/shm)
+# avoids touching the disk when writing the files of each test run.
+CHECKING_WORKSPACE_ROOT = "/tmp"
+# How many workspaces with the include files already written are kept ready
+# for each test, and for how many tests. 0 disables the workspace pool.
+CHECKING_WORKSPACE_POOL_SIZE = 2
+CHECKING_WORKSPACE_POOL_TESTS = 32
+# Run a stage only once per submission when another test has already run the
+# same commands on a workspace with the same contents, e.g. a compile stage
+# shared by all tests, and copy the files it produced instead. Only stages
+# that another stage depends on are cached.
+CHECKING_STAGE_CACHE = True
+# User and group id the tested programs run as. Include files are chowned
+# according to their ownership settings when these are set.
+CHECKING_STUDENT_UID = None
+CHECKING_STUDENT_GID = None
+# Directory of a cgroup v2 subtree delegated to the checking worker, e.g.
+# /sys/fs/cgroup/lovelace. Each command then runs in a cgroup of its own with
+# the limits below and is killed as a whole. Without it (or when cgroups are
+# unavailable) only the rlimits in courses.evaluation_sec are used.
+CHECKING_CGROUP_ROOT = None
+CHECKING_CGROUP_MEMORY_MAX = 512 * 1024 ** 2
+CHECKING_CGROUP_PIDS_MAX = 40
+CHECKING_CGROUP_CPU_MAX = "100000 100000"
+# How many bytes of stdout and stderr are kept of each command. Longer output
+# is truncated, and the command is stopped right away if the flag is set.
+CHECKING_OUTPUT_MAX_BYTES = 256 * 1024
+CHECKING_OUTPUT_LIMIT_KILL = False
+# Storage of the test results of evaluations (see courses/evaluation_storage.py).
+# Compact results are compressed, outputs over INLINE_BYTES are stored once
+# per distinct output, and stored outputs are cut at MAX_BYTES.
+CHECKING_COMPACT_RESULTS = True
+CHECKING_STORED_OUTPUT_INLINE_BYTES = 512
+CHECKING_STORED_OUTPUT_MAX_BYTES = 64 * 1024
+# Cache the rendered reports of evaluations for viewing old answers, for
+# TIMEOUT seconds.
+CHECKING_REPORT_CACHE = True
+CHECKING_REPORT_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+# Unix socket of the sandbox runner service (see courses/evaluation_runner.py
+# and runrunner.sh). When set, the commands of file exercise tests are run by
+# the service instead of being forked from the Celery worker.
+CHECKING_RUNNER_SOCKET = None
+# Budget of the stdout/stderr diffs shown to students. Differing parts larger
+# than this, or taking longer, are compared line by line and only
+# CHECKING_DIFF_MAX_LINES lines of them are shown.
+CHECKING_DIFF_MAX_CELLS = 250000
+CHECKING_DIFF_MAX_CHARS = 100000
+CHECKING_DIFF_TIME_BUDGET = 1.0
+CHECKING_DIFF_MAX_LINES = 500
+# Queue of the checking tasks and the token buckets that set their priority.
+# Each course instance may send RATE answers per second, and up to BURST at
+# once, before its answers are queued behind other instances' answers. Users
+# over their own share are queued behind everyone.
+CHECKING_QUEUE = "checking"
+CHECKING_QUEUE_INSTANCE_RATE = 1.0
+CHECKING_QUEUE_INSTANCE_BURST = 30
+CHECKING_QUEUE_USER_RATE = 0.1
+CHECKING_QUEUE_USER_BURST = 5
+# Admission control of file exercise answers: each user may send RATE answers
+# per second to each exercise, and up to BURST at once. Answers over the limit
+# are rejected with HTTP 429.
+CHECKING_SUBMISSION_LIMIT = True
+CHECKING_SUBMISSION_RATE = 0.2
+CHECKING_SUBMISSION_BURST = 5
+# How long a progress request waits for news from the checking task, and how
+# long a progress stream (server-sent events) is kept open without any.
+CHECKING_PROGRESS_LONG_POLL = 10
+CHECKING_PROGRESS_STREAM_TIMEOUT = 120
+# Send the progress of checking as server-sent events instead of long-polling.
+# Each open stream holds a server worker and a Redis connection, so only enable
+# this behind an asynchronous server, e.g. gunicorn with gevent workers.
+CHECKING_PROGRESS_STREAM = False
+
+# Number of compiled answer matchers of textfield and repeated template
+# exercises kept in each process (see courses/answer_matching.py)
+ANSWER_MATCHER_CACHE_SIZE = 512
+
+# Cache the parts of rendered content pages that are the same for every user
+# per page revision, course instance and language (see courses/page_cache.py),
+# and for how long. Renders are dropped when the page or its links change, but
+# expire anyway in case a change is not noticed.
+PAGE_RENDER_CACHE = True
+PAGE_RENDER_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Cache syntax highlighted code and files for TIMEOUT seconds (see
+# courses/highlight_cache.py). Code longer than MAX_BYTES isn't cached.
+HIGHLIGHT_CACHE = True
+HIGHLIGHT_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+HIGHLIGHT_CACHE_MAX_BYTES = 256 * 1024
+
 # Cache settings
 CACHES = {
     "default": {
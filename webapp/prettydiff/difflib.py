@@ -1834,6 +1834,15 @@ class HtmlDiff(object):
                     todata = ('',' ')
                 yield fromdata,todata,flag
 
+    def _make_diffs(self,fromlines,tolines,context_lines):
+        """Returns the mdiff style iterator of side by side from/to data
+
+        Subclasses can override this to compute the differences in some other
+        way while keeping the HTML output.
+        """
+        return _mdiff(fromlines,tolines,context_lines,linejunk=self._linejunk,
+                      charjunk=self._charjunk)
+
     def _collect_lines(self,diffs):
         """Collects mdiff output into separate lists
 
@@ -1968,8 +1977,7 @@ class HtmlDiff(object):
             context_lines = numlines
         else:
             context_lines = None
-        diffs = _mdiff(fromlines,tolines,context_lines,linejunk=self._linejunk,
-                      charjunk=self._charjunk)
+        diffs = self._make_diffs(fromlines,tolines,context_lines)
 
         # set up iterator to wrap lines that exceed desired width
         if self._wrapcolumn:
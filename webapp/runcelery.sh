@@ -1,2 +1,2 @@
 #!/usr/bin/env bash
-celery -A lovelace worker --loglevel=info
+celery -A lovelace worker -Q default,privileged --loglevel=info
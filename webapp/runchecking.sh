@@ -0,0 +1,2 @@
+#!/usr/bin/env bash
+celery -A lovelace worker -Q checking -n checking@%h --loglevel=info
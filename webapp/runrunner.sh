@@ -0,0 +1,2 @@
+#!/usr/bin/env bash
+python -m courses.evaluation_runner --socket /tmp/lovelace-runner.sock --workers 4
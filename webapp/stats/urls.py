@@ -6,6 +6,7 @@ app_name="stats"
 
 urlpatterns = [
     path("single-exercise/<content:exercise>/", views.single_exercise, name="single_exercise"),
+    path("checking-timings/", views.checking_timings, name="checking_timings"),
     #path("course-users/<course:course>/(?P<content_to_search>[^/]+)/(?P<year>\d{4})\-(?P<month>\d{2})\-(?P<day>\d{2})/#$", views.course_users, name="course_users"),
     #url(r"^all-exercises/(?P<course_name>[^/]+)/$", views.all_exercises, name="all_exercises"),
     #url(r"^user-task/(?P<user_name>[^/]+)/(?P<task_name>.+)/$", views.user_task, name="user_task"),
@@ -8,6 +8,7 @@ import redis
 from celery import chain
 from django.conf import settings
 from django.core.cache import cache
+from django.db.models import Count, Max
 from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidden, JsonResponse
 from django.template import loader
 from django.urls import reverse
@@ -21,6 +22,8 @@ import datetime
 from courses.models import *
 from .models import *
 import stats.tasks as stat_tasks
+from courses import answer_matching
+from courses import evaluation_timing
 
 from utils.access import ensure_responsible
 
@@ -78,39 +81,10 @@ def course_instances_linked(exercise):
 
 ########################################################### 
 
-def textfield_eval(given, answers):
-    given_answer = given.replace("\r", "")
-    correct = False
-    hinted = False
-    commented = False
-    matches = []
-
-    re_validate = lambda db_ans, given_ans: re.match(db_ans, given_ans) is not None
-    str_validate = lambda db_ans, given_ans: db_ans == given_ans
-    
-    for answer in answers:
-        validate = re_validate if answer.regexp else str_validate
-        
-        try:
-            match = validate(answer.answer, given_answer)
-        except re.error as e:
-            matches.append((answer.answer, "{}".format(e)))
-            correct = False
-            continue
-
-        if match and answer.correct:
-            correct = True
-            matches.append((answer.answer, ""))
-            if answer.comment:
-                commented = True
-        elif match and not answer.correct:
-            matches.append((answer.answer, ""))
-            if answer.hint:
-                hinted = True
-            if answer.comment:
-                commented = True
-                    
-    return (correct, hinted, matches)
+def textfield_eval(given, matcher):
+    result = matcher.evaluate(given.replace("\r", ""))
+    matches = [(choice.answer, error) for choice, error in result.matches]
+    return (result.correct, result.hinted, matches)
 
 def answers_average(answer_count, user_count):
     """
@@ -286,8 +260,9 @@ def textfield_exercise(exercise, users, course_inst=None, revision=None):
 
     answers = UserTextfieldExerciseAnswer.objects.filter(exercise=exercise, user__in=users, instance=course_inst)
     basic_stats, piechart = exercise_basic_answer_stats(exercise, users, answers, course_inst)
-    given_answers = list(answers.values_list("given_answer", flat=True))
-    given_answers_set = set(given_answers)
+    given_answers = answers.values("given_answer").annotate(
+        count=Count("id"), latest=Max("answer_date")
+    ).order_by()
 
     answer_data = []
     incorrect_given = 0
@@ -295,17 +270,18 @@ def textfield_exercise(exercise, users, course_inst=None, revision=None):
     incorrect_unique = 0
     hinted_incorrect_unique = 0
     choices = exercise.get_choices(exercise, revision)
-    for answer in given_answers_set:
-        count = given_answers.count(answer)
-        correct, hinted, matches = textfield_eval(answer, choices)
+    matcher = answer_matching.AnswerMatcher(choices)
+    for given in given_answers:
+        answer = given["given_answer"]
+        count = given["count"]
+        correct, hinted, matches = textfield_eval(answer, matcher)
         if not correct:
             incorrect_unique += 1
             incorrect_given += count
             if hinted:
                 hinted_incorrect_unique += 1
                 hinted_incorrect_given += count
-        latest = answers.filter(given_answer=answer).latest('answer_date').answer_date
-        answer_data.append((answer, count, correct, hinted, latest, matches))
+        answer_data.append((answer, count, correct, hinted, given["latest"], matches))
     answer_data = sorted(answer_data, key=lambda x: x[1], reverse=True)
 
     try:
@@ -408,6 +384,7 @@ def single_exercise(request, exercise):
     elif tasktype == "TEXTFIELD_EXERCISE":
         return exercise_answer_stats(request, ctx, exercise, textfield_exercise, "textfield-stats.html")
     elif tasktype == "FILE_UPLOAD_EXERCISE":
+        ctx["timings"] = evaluation_timing.get_timing_histograms(exercise.id)
         return exercise_answer_stats(request, ctx, exercise, file_upload_exercise, "file-upload-stats.html")
     elif tasktype == "REPEATED_TEMPLATE_EXERCISE":
         return exercise_answer_stats(request, ctx, exercise, repeated_template_exercise, "repeated-template-stats.html")
@@ -620,6 +597,36 @@ def users_course(request, course_slug, instance_slug):
     }
     return HttpResponse(t.render(c, request))
 
+def checking_timings(request):
+    """
+    Shows the checking phase timings of all file upload exercises, slowest
+    exercises first.
+    """
+    if not (request.user.is_authenticated and request.user.is_active and request.user.is_staff):
+        return HttpResponseForbidden("Only logged in admins can view checking timings!")
+
+    exercise_ids = evaluation_timing.get_timed_exercise_ids()
+    exercises = FileUploadExercise.objects.in_bulk(exercise_ids)
+    rows = []
+    for exercise_id in exercise_ids:
+        histograms = evaluation_timing.get_timing_histograms(exercise_id)
+        if exercise_id not in exercises or not histograms:
+            continue
+        phases = {histogram["phase"]: histogram for histogram in histograms}
+        total = sum(
+            histogram["mean"] for histogram in histograms
+            if histogram["phase"] not in ("setup", "execution")
+        )
+        rows.append((exercises[exercise_id], total, [phases.get(phase) for phase in evaluation_timing.PHASES]))
+    rows.sort(key=lambda row: row[1], reverse=True)
+
+    t = loader.get_template("stats/checking-timings.html")
+    c = {
+        "phases": evaluation_timing.PHASES,
+        "rows": rows,
+    }
+    return HttpResponse(t.render(c, request))
+
 class ZeroUsersException(Exception):
     pass
 